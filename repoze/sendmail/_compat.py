@@ -4,15 +4,21 @@ import codecs
 
 try:
     text_type = unicode
+    string_types = basestring
     def from_octets(seq_of_ints):
         return ''.join([chr(x) for x in seq_of_ints])
+    def u(x):
+        return x.decode('unicode_escape')
 except NameError: #pragma NO COVER
     PY_2 = False
     text_type = str
+    string_types = str
     def b(x):
         return codecs.latin_1_encode(x)[0]
     def from_octets(seq_of_ints):
         return bytes(seq_of_ints)
+    def u(x):
+        return x
 else:
     PY_2 = True
     b = str
@@ -36,3 +42,18 @@ if PY_2: # pragma: no cover
     encodestring = base64.encodestring
 else: # pragma: no cover
     encodestring = base64.encodebytes
+
+try:
+    from Queue import Queue, Full
+except ImportError: #pragma NO COVER Python 3
+    from queue import Queue, Full
+
+try:
+    from email.generator import BytesGenerator
+except ImportError: #pragma NO COVER Python 2
+    from email.generator import Generator as BytesGenerator
+
+try:
+    from email.parser import BytesParser
+except ImportError: #pragma NO COVER Python 2
+    from email.parser import Parser as BytesParser
@@ -0,0 +1,441 @@
+##############################################################################
+#
+# Copyright (c) 2003 Zope Corporation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""
+`asyncio` versions of `SMTPMailer` and `QueueProcessor`.
+
+Many SMTP sessions run concurrently on the event loop's thread; file system
+work is done in the loop's default executor.  Requires Python 3.7 or later.
+"""
+import asyncio
+import base64
+import re
+import socket
+import ssl as _ssl
+import smtplib
+from email.message import Message
+from smtplib import SMTPAuthenticationError
+from smtplib import SMTPDataError
+from smtplib import SMTPException
+from smtplib import SMTPRecipientsRefused
+from smtplib import SMTPResponseException
+from smtplib import SMTPSenderRefused
+from smtplib import SMTPServerDisconnected
+
+from repoze.sendmail.encoding import encode_message
+from repoze.sendmail.maildir import Maildir
+from repoze.sendmail.mailer import _read_raw
+from repoze.sendmail.mx import DeferredRecipients
+from repoze.sendmail.queue import QueueProcessor
+
+CRLF = b'\r\n'
+
+_EOL = re.compile(br'\r\n|\n|\r(?!\n)')
+_LEADING_PERIOD = re.compile(br'(?m)^\.')
+
+
+def _data(message):
+    # Normalize line endings and dot-stuff `message` for the DATA command,
+    # as `smtplib.SMTP.data` does.
+    data = _LEADING_PERIOD.sub(b'..', _EOL.sub(CRLF, message))
+    if not data.endswith(CRLF):
+        data += CRLF
+    return data + b'.' + CRLF
+
+
+class _AsyncSMTP(object):
+    """A minimal SMTP client session over an asyncio stream.
+
+    The methods behave like those of `smtplib.SMTP`, and raise the same
+    exceptions.
+    """
+    def __init__(self, reader, writer, timeout=None):
+        self.reader = reader
+        self.writer = writer
+        self.timeout = timeout
+        self.esmtp_features = {}
+        self.does_esmtp = False
+
+    async def getreply(self):
+        lines = []
+        while True:
+            line = await asyncio.wait_for(self.reader.readline(),
+                                          self.timeout)
+            if not line:
+                self.close()
+                raise SMTPServerDisconnected('Connection unexpectedly closed')
+            try:
+                code = int(line[:3])
+            except ValueError:
+                code = -1
+            lines.append(line[4:].strip(b' \t\r\n'))
+            if line[3:4] != b'-':
+                return code, b'\n'.join(lines)
+
+    async def command(self, cmd, args=''):
+        if args:
+            cmd = '%s %s' % (cmd, args)
+        self.writer.write(cmd.encode('ascii') + CRLF)
+        await self.writer.drain()
+        return await self.getreply()
+
+    async def ehlo(self, name):
+        self.esmtp_features = {}
+        code, msg = await self.command('EHLO', name)
+        if code != 250:
+            return code, msg
+        self.does_esmtp = True
+        for line in msg.decode('latin-1').split('\n')[1:]:
+            parts = line.split(None, 1)
+            if parts:
+                self.esmtp_features[parts[0].lower()] = (
+                    parts[1] if len(parts) > 1 else '')
+        return code, msg
+
+    async def helo(self, name):
+        return await self.command('HELO', name)
+
+    def has_extn(self, opt):
+        return opt.lower() in self.esmtp_features
+
+    async def starttls(self, context, server_hostname):
+        code, msg = await self.command('STARTTLS')
+        if code != 220:
+            raise SMTPResponseException(code, msg)
+        start_tls = getattr(self.writer, 'start_tls', None)
+        if start_tls is not None:
+            await start_tls(context, server_hostname=server_hostname)
+        else: #pragma NO COVER Python < 3.11
+            loop = asyncio.get_running_loop()
+            transport = self.writer.transport
+            transport = await loop.start_tls(
+                transport, transport.get_protocol(), context,
+                server_hostname=server_hostname)
+            # The reader is fed by the protocol, which the new transport
+            # keeps; only the writer needs to know about it.
+            self.writer._transport = transport
+        # As required by RFC 3207, forget what was learnt before.
+        self.esmtp_features = {}
+        self.does_esmtp = False
+        return code, msg
+
+    async def login(self, user, password):
+        methods = self.esmtp_features.get('auth', '').upper().split()
+        if 'PLAIN' in methods:
+            token = ('\0%s\0%s' % (user, password)).encode('utf-8')
+            code, msg = await self.command(
+                'AUTH', 'PLAIN ' + base64.b64encode(token).decode('ascii'))
+        elif 'LOGIN' in methods:
+            code, msg = await self.command('AUTH', 'LOGIN')
+            for value in (user, password):
+                if code != 334:
+                    break
+                self.writer.write(
+                    base64.b64encode(value.encode('utf-8')) + CRLF)
+                await self.writer.drain()
+                code, msg = await self.getreply()
+        else:
+            raise SMTPException('No suitable authentication method found.')
+        if code not in (235, 503):
+            raise SMTPAuthenticationError(code, msg)
+        return code, msg
+
+    async def _refused(self, code):
+        # Leave the session usable for the next message, as smtplib does.
+        if code == 421:
+            self.close()
+        else:
+            await self.rset()
+
+    async def sendmail(self, fromaddr, toaddrs, msg):
+        code, resp = await self.command(
+            'MAIL', 'FROM:%s' % smtplib.quoteaddr(fromaddr))
+        if code != 250:
+            await self._refused(code)
+            raise SMTPSenderRefused(code, resp, fromaddr)
+        senderrs = {}
+        for addr in toaddrs:
+            code, resp = await self.command(
+                'RCPT', 'TO:%s' % smtplib.quoteaddr(addr))
+            if code not in (250, 251):
+                senderrs[addr] = (code, resp)
+            if code == 421:
+                self.close()
+                raise SMTPRecipientsRefused(senderrs)
+        if len(senderrs) == len(toaddrs):
+            await self.rset()
+            raise SMTPRecipientsRefused(senderrs)
+        code, resp = await self.command('DATA')
+        if code == 354:
+            self.writer.write(_data(msg))
+            await self.writer.drain()
+            code, resp = await self.getreply()
+        if code != 250:
+            await self._refused(code)
+            raise SMTPDataError(code, resp)
+        return senderrs
+
+    async def rset(self):
+        try:
+            return await self.command('RSET')
+        except SMTPServerDisconnected:
+            pass
+
+    async def quit(self):
+        try:
+            return await self.command('QUIT')
+        finally:
+            self.close()
+
+    def close(self):
+        self.writer.close()
+
+
+class AsyncSMTPMailer(object):
+    """Like `repoze.sendmail.mailer.SMTPMailer`, but `send` and `send_raw`
+    are coroutines.
+
+    At most `concurrency` SMTP sessions are open at once; further messages
+    wait for one of them to finish.  Unlike `SMTPMailer`, TLS certificates
+    are verified, against `ssl_context` if one is given.
+    """
+    timeout = 10
+    local_hostname = None
+
+    def __init__(self, hostname='localhost', port=25,
+                 username=None, password=None,
+                 no_tls=False, force_tls=False, ssl=False, ssl_context=None,
+                 concurrency=10):
+        self.hostname = hostname
+        self.port = port
+        self.username = username
+        self.password = password
+        self.force_tls = force_tls
+        self.no_tls = no_tls
+        self.ssl = ssl
+        self.ssl_context = ssl_context
+        self.concurrency = concurrency
+        self._semaphore = None
+
+    def _context(self):
+        if self.ssl_context is None:
+            self.ssl_context = _ssl.create_default_context()
+        return self.ssl_context
+
+    async def _open_connection(self):
+        if self.ssl:
+            return await asyncio.open_connection(
+                self.hostname, self.port, ssl=self._context())
+        return await asyncio.open_connection(self.hostname, self.port)
+
+    async def _connect(self):
+        """Open a session and get it ready for sending: greet the server,
+        start TLS and log in as configured.
+        """
+        if self.local_hostname is None:
+            loop = asyncio.get_running_loop()
+            self.local_hostname = await loop.run_in_executor(
+                None, socket.getfqdn)
+        reader, writer = await asyncio.wait_for(self._open_connection(),
+                                                self.timeout)
+        connection = _AsyncSMTP(reader, writer, self.timeout)
+        try:
+            code, response = await connection.getreply()
+            if code != 220:
+                raise SMTPResponseException(code, response)
+
+            # send EHLO
+            code, response = await connection.ehlo(self.local_hostname)
+            if code < 200 or code >= 300:
+                code, response = await connection.helo(self.local_hostname)
+                if code < 200 or code >= 300:
+                    raise RuntimeError(
+                            'Error sending HELO to the SMTP server '
+                            '(code=%s, response=%s)' % (code, response))
+
+            # encryption support
+            have_tls = connection.has_extn('starttls')
+            if not have_tls and self.force_tls:
+                raise RuntimeError(
+                    'TLS is not available but TLS is required')
+
+            if have_tls and not self.no_tls and not self.ssl:
+                await connection.starttls(self._context(), self.hostname)
+                await connection.ehlo(self.local_hostname)
+
+            if connection.does_esmtp:
+                if self.username is not None and self.password is not None:
+                    await connection.login(self.username, self.password)
+            elif self.username:
+                raise RuntimeError(
+                        'Mailhost does not support ESMTP but a username '
+                        'is configured')
+        except:
+            connection.close()
+            raise
+        return connection
+
+    async def send(self, fromaddr, toaddrs, message):
+        if not isinstance(message, Message):
+            raise ValueError(
+               'Message must be instance of email.message.Message')
+        await self.send_raw(fromaddr, toaddrs, encode_message(message))
+
+    async def send_raw(self, fromaddr, toaddrs, message):
+        message = _read_raw(message)
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+        async with self._semaphore:
+            connection = await self._connect()
+            try:
+                refused = await connection.sendmail(fromaddr, toaddrs,
+                                                    message)
+            except:
+                connection.close()
+                raise
+            try:
+                await connection.quit()
+            except (SMTPException, _ssl.SSLError, EnvironmentError,
+                    asyncio.TimeoutError):
+                # something weird happened while quiting
+                connection.close()
+            return refused
+
+
+class AsyncQueueProcessor(QueueProcessor):
+    """Like `repoze.sendmail.queue.QueueProcessor`, but `send_messages` is a
+    coroutine which sends up to `concurrency` messages at once.
+
+    `mailer` must provide a ``send_raw`` coroutine, as `AsyncSMTPMailer`
+    does.
+
+    `rate_limit`, `retry`, `claim`, `shard`, `lease_timeout` and `order`
+    are as for `QueueProcessor`; the rate limit is waited for without blocking the
+    event loop.  `concurrency` takes the place of `workers`, and messages
+    are sent in the order of the queue: the ``'domain'`` schedule, which
+    needs SMTP sessions, is not available.
+    """
+    def __init__(self, mailer, queue_path, Maildir=Maildir,
+                 ignore_transient=False, concurrency=10, claim='link',
+                 rate_limit=None, retry=None, shard=None, lease_timeout=300,
+                 order='mtime'):
+        super(AsyncQueueProcessor, self).__init__(
+            mailer, queue_path, Maildir=Maildir,
+            ignore_transient=ignore_transient, rate_limit=rate_limit,
+            retry=retry, claim=claim, shard=shard,
+            lease_timeout=lease_timeout, order=order)
+        self.concurrency = concurrency
+
+    async def send_messages(self):
+        loop = asyncio.get_running_loop()
+        if self.claim == 'rename':
+            await loop.run_in_executor(None, self._recover)
+        if self.shard is not None:
+            await loop.run_in_executor(None, self._select_shards)
+        filenames = await loop.run_in_executor(None, self._due)
+        semaphore = asyncio.Semaphore(self.concurrency)
+        tasks = []
+        for filename in filenames:
+            await semaphore.acquire()
+            if self._stopped.is_set():
+                semaphore.release()
+                break
+            task = loop.create_task(self._send_message(filename))
+            task.add_done_callback(lambda task: semaphore.release())
+            tasks.append(task)
+        if tasks:
+            await asyncio.wait(tasks)
+
+    def _due(self):
+        return list(self._pending())
+
+    def _read(self, filename):
+        # Claim and read the message in one trip to the executor.
+        if self.shard is not None:
+            # sending may take longer than the lease
+            self._keep_lease()
+        claim = self._claim(filename)
+        if claim is None:
+            return None, None
+        try:
+            return claim, self._read_claimed(filename, claim)
+        except:
+            self._release(filename, claim)
+            raise
+
+    def _put_back(self, filename, claim, fromaddr, toaddrs):
+        # Leave a message which failed to send for a later pass.
+        if self.retry is not None:
+            self._retry_later(filename, claim, fromaddr, toaddrs)
+        else:
+            self._release(filename, claim)
+
+    async def _send(self, fromaddr, toaddrs, message):
+        rate_limit = self.rate_limit
+        if rate_limit is None:
+            return await self.mailer.send_raw(fromaddr, toaddrs, message)
+        wait = rate_limit.reserve(toaddrs)
+        if wait > 0:
+            await asyncio.sleep(wait)
+        try:
+            refused = await self.mailer.send_raw(fromaddr, toaddrs, message)
+        except Exception as e:
+            rate_limit.failed(e, toaddrs)
+            raise
+        rate_limit.succeeded(toaddrs)
+        return refused
+
+    async def _send_message(self, filename):
+        loop = asyncio.get_running_loop()
+        fromaddr = ''
+        toaddrs = ()
+        claim = None
+        try:
+            claim, read = await loop.run_in_executor(
+                None, self._read, filename)
+            if claim is None:
+                return
+            fromaddr, toaddrs, message = read
+            refused = None
+            try:
+                refused = await self._send(fromaddr, toaddrs, message)
+            except DeferredRecipients as e:
+                # sent to some recipients; keep it queued for the others
+                await loop.run_in_executor(
+                    None, self._defer, filename, claim, fromaddr, toaddrs, e)
+                return
+            except SMTPResponseException as e:
+                if 500 <= e.smtp_code <= 599:
+                    # permanent error, ditch the message
+                    await loop.run_in_executor(
+                        None, self._reject, filename, fromaddr, toaddrs, e,
+                        claim)
+                elif self.ignore_transient:
+                    await loop.run_in_executor(
+                        None, self._put_back, filename, claim, fromaddr,
+                        toaddrs)
+                    return
+                else:
+                    raise
+            self._log_refused(fromaddr, refused)
+            await loop.run_in_executor(
+                None, self._finish, filename, claim, fromaddr, toaddrs)
+        except Exception:
+            self._log_failure(filename, fromaddr, toaddrs)
+            if claim is not None:
+                try:
+                    await loop.run_in_executor(
+                        None, self._put_back, filename, claim, fromaddr,
+                        toaddrs)
+                except Exception:
+                    self._log_failure(filename, fromaddr, toaddrs)
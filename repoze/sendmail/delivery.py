@@ -22,10 +22,13 @@ from email.header import Header
 from email.parser import Parser
 from email.utils import formatdate
 from email.utils import make_msgid
+import re
+from weakref import WeakKeyDictionary
 
 from zope.interface import implementer
 from repoze.sendmail.interfaces import IMailDelivery
 from repoze.sendmail.maildir import Maildir
+from repoze.sendmail.maildir import commit_messages
 from repoze.sendmail import encoding
 import transaction
 from transaction.interfaces import ISavepointDataManager
@@ -187,6 +190,61 @@ class MailDataSavepoint:
         pass
 
 
+@implementer(ISavepointDataManager)
+class BatchMailDataManager(MailDataManager):
+    """A `MailDataManager` for many messages sent in one transaction.
+
+    Items, one per message, are collected with `add`.  During the
+    tpc_finish phase the whole list is passed to ``callable`` at once; if
+    the transaction is aborted it is passed to ``onAbort`` instead.
+    """
+    def __init__(self, callable, onAbort=None, transaction_manager=None):
+        self.items = []
+        self.onAbortItems = onAbort
+        if onAbort is not None:
+            onAbort = self._abortItems
+        super(BatchMailDataManager, self).__init__(
+            callable, args=(self.items,), onAbort=onAbort,
+            transaction_manager=transaction_manager)
+
+    def add(self, item):
+        self.items.append(item)
+
+    def abort(self, trans):
+        super(BatchMailDataManager, self).abort(trans)
+        # The items are gone with the transaction, or with the savepoint
+        # which the manager joined after.
+        del self.items[:]
+
+    def _abortItems(self):
+        self.onAbortItems(self.items)
+
+    def savepoint(self):
+        """Create a `BatchMailDataSavepoint` object
+
+        Rolling it back drops (and aborts) the items added since.
+        """
+        if self.transaction is None:
+            raise ValueError("Not in a transaction")
+        return BatchMailDataSavepoint(self)
+
+
+@implementer(IDataManagerSavepoint)
+class BatchMailDataSavepoint(object):
+    """Remembers how many items a `BatchMailDataManager` held.
+    """
+    def __init__(self, mail_data_manager):
+        self.mail_data_manager = mail_data_manager
+        self.length = len(mail_data_manager.items)
+
+    def rollback(self):
+        items = self.mail_data_manager.items
+        dropped = items[self.length:]
+        del items[self.length:]
+        if dropped and self.mail_data_manager.onAbortItems is not None:
+            self.mail_data_manager.onAbortItems(dropped)
+
+
 class AbstractMailDelivery(object):
     """Base class for mail delivery.
 
@@ -197,35 +255,119 @@ class AbstractMailDelivery(object):
     another class that implements `IDataManager` or `ISavepointDataManager`
 
     The managed message is immediately joined into the current transaction.
+
+    If ``batch`` is true, all of the messages sent in one transaction share
+    a single `BatchMailDataManager` instead -- the result of
+    ``self.createBatchDataManager()`` -- to which each message is added by
+    ``self.addToBatch(manager,fromaddr,toaddrs,message)``.  The whole batch
+    is then delivered at once when the transaction commits.
+
+    If ``header_cache`` is a `repoze.sendmail.encoding.HeaderCache`, the
+    headers of messages are encoded through it, which saves encoding the
+    same headers over and over when sending many similar messages.
+
+    ``send_raw`` sends messages which are already encoded, such as those
+    rendered by a `repoze.sendmail.template.MessageTemplate`, the same way.
     """
+    batch = False
+    header_cache = None
+    _batches = None
+
     def send(self, fromaddr, toaddrs, message):
         if not isinstance(message, Message):
             raise ValueError('Message must be email.message.Message')
-        encoding.cleanup_message(message)
+        encoding.cleanup_message(message, header_cache=self.header_cache)
         messageid = message['Message-Id']
         if messageid is None:
             messageid = message['Message-Id'] = make_msgid('repoze.sendmail')
         if message['Date'] is None:
             message['Date'] = formatdate()
-        managedMessage = self.createDataManager(fromaddr, toaddrs, message)
-        managedMessage.join_transaction()
+        if self.batch:
+            manager = self._getBatchDataManager()
+            self.addToBatch(manager, fromaddr, toaddrs, message)
+        else:
+            managedMessage = self.createDataManager(fromaddr, toaddrs,
+                                                    message)
+            managedMessage.join_transaction()
         return messageid
 
+    def send_raw(self, fromaddr, toaddrs, message):
+        if not isinstance(message, bytes):
+            raise ValueError('Message must be bytes')
+        if self.batch:
+            manager = self._getBatchDataManager()
+            self.addToBatch(manager, fromaddr, toaddrs, message)
+        else:
+            managedMessage = self.createDataManager(fromaddr, toaddrs,
+                                                    message)
+            managedMessage.join_transaction()
+        return _message_id(message)
+
+    def _getBatchDataManager(self):
+        trans = self.transaction_manager.get()
+        if self._batches is None:
+            self._batches = WeakKeyDictionary()
+        manager = self._batches.get(trans)
+        if manager is None or manager not in trans._resources:
+            # Rolling back a savepoint taken before the manager joined
+            # aborts it and drops it from the transaction.
+            manager = self._batches[trans] = self.createBatchDataManager()
+            manager.join_transaction(trans)
+        return manager
+
 
 @implementer(IMailDelivery)
 class DirectMailDelivery(AbstractMailDelivery):
 
-    def __init__(self, mailer, transaction_manager=None):
+    def __init__(self, mailer, transaction_manager=None, batch=False,
+                 rate_limit=None, header_cache=None):
         self.mailer = mailer
         if transaction_manager is None:
             transaction_manager = transaction.manager
         self.transaction_manager = transaction_manager
+        self.batch = batch
+        self.header_cache = header_cache
+        # See `repoze.sendmail.ratelimit.RateLimiter`.
+        self.rate_limit = rate_limit
 
     def createDataManager(self, fromaddr, toaddrs, message):
-        return MailDataManager(self.mailer.send,
+        return MailDataManager(self._send,
                                args=(fromaddr, toaddrs, message),
                                transaction_manager=self.transaction_manager)
 
+    def _send(self, fromaddr, toaddrs, message, sender=None):
+        if sender is None:
+            sender = self.mailer
+        if isinstance(message, bytes):
+            send = sender.send_raw
+        else:
+            send = sender.send
+        if self.rate_limit is None:
+            return send(fromaddr, toaddrs, message)
+        return self.rate_limit.send(send, fromaddr, toaddrs, message)
+
+    def createBatchDataManager(self):
+        return BatchMailDataManager(
+            self.sendBatch, transaction_manager=self.transaction_manager)
+
+    def addToBatch(self, manager, fromaddr, toaddrs, message):
+        manager.add((fromaddr, toaddrs, message))
+
+    def sendBatch(self, messages):
+        """Send `messages`, a sequence of ``(fromaddr, toaddrs, message)``.
+
+        Mailers which provide a ``session`` (such as `SMTPMailer`) send the
+        whole batch over one connection.
+        """
+        session = getattr(self.mailer, 'session', None)
+        if session is None:
+            for fromaddr, toaddrs, message in messages:
+                self._send(fromaddr, toaddrs, message)
+            return
+        with session() as session:
+            for fromaddr, toaddrs, message in messages:
+                self._send(fromaddr, toaddrs, message, session)
+
 
 @implementer(IMailDelivery)
 class QueuedMailDelivery(AbstractMailDelivery):
@@ -233,21 +375,68 @@ class QueuedMailDelivery(AbstractMailDelivery):
     queuePath = property(lambda self: self._queuePath)
     processor_thread = None
 
-    def __init__(self, queuePath, transaction_manager=None):
+    def __init__(self, queuePath, transaction_manager=None,
+                 durability='none', group_commit=0, batch=False,
+                 header_cache=None):
         self._queuePath = queuePath
         if transaction_manager is None:
             transaction_manager = transaction.manager
         self.transaction_manager = transaction_manager
+        # See `repoze.sendmail.maildir.Maildir`.
+        self.durability = durability
+        self.group_commit = group_commit
+        self.batch = batch
+        self.header_cache = header_cache
 
     def createDataManager(self, fromaddr, toaddrs, message):
-        message = copy_message(message)
-        message['X-Actually-From'] = Header(fromaddr, 'utf-8')
-        message['X-Actually-To'] = Header(','.join(toaddrs), 'utf-8')
-        maildir = Maildir(self.queuePath, True)
-        tx_message = maildir.add(message)
+        tx_message = self._queue(fromaddr, toaddrs, message)
         return MailDataManager(tx_message.commit, onAbort=tx_message.abort,
                                transaction_manager=self.transaction_manager)
 
+    def createBatchDataManager(self):
+        # Queued files are all renamed into place before the queue
+        # directory is synced, once.
+        return BatchMailDataManager(
+            commit_messages, onAbort=_abort_messages,
+            transaction_manager=self.transaction_manager)
+
+    def addToBatch(self, manager, fromaddr, toaddrs, message):
+        manager.add(self._queue(fromaddr, toaddrs, message))
+
+    def _queue(self, fromaddr, toaddrs, message):
+        # The envelope goes into the queue file ahead of the message, so the
+        # message itself is neither copied nor modified.
+        envelope = [('X-Actually-From', fromaddr),
+                    ('X-Actually-To', ','.join(toaddrs))]
+        envelope = [(name, Header(value, 'utf-8', header_name=name).encode())
+                    for name, value in envelope]
+        # ``send`` has just cleaned up the message and it is written now,
+        # so the queue processor need not clean it up again.
+        envelope.append(('X-Actually-Cleaned', 'yes'))
+        maildir = Maildir(self.queuePath, True, durability=self.durability,
+                          group_commit=self.group_commit)
+        return maildir.add(message, envelope)
+
+
+_MESSAGE_ID = re.compile(br'^message-id:[ \t]*(.*?)\r?$',
+                         re.IGNORECASE | re.MULTILINE)
+
+
+def _message_id(message):
+    # The Message-Id of an encoded message, from its headers only.
+    end = re.search(br'\r?\n\r?\n', message)
+    if end is not None:
+        message = message[:end.start()]
+    match = _MESSAGE_ID.search(message)
+    if match is None:
+        return None
+    return match.group(1).decode('ascii', 'replace')
+
+
+def _abort_messages(tx_messages):
+    for tx_message in tx_messages:
+        tx_message.abort()
+
 
 def copy_message(message):
     parser = Parser()
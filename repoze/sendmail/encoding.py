@@ -1,8 +1,14 @@
+import re
+import threading
+from collections import OrderedDict
 from email import utils
 from email import header
+from email.generator import Generator
 
 from repoze.sendmail._compat import PY_2
+from repoze.sendmail._compat import string_types
 from repoze.sendmail._compat import text_type
+from repoze.sendmail._compat import u
 
 # From http://tools.ietf.org/html/rfc5322#section-3.6
 ADDR_HEADERS = ('resent-from',
@@ -20,9 +26,34 @@ ADDR_HEADERS = ('resent-from',
 PARAM_HEADERS = ('content-type',
                  'content-disposition')
 
+# How much of an encoded message `write_message` buffers before writing it.
+CHUNK_SIZE = 64 * 1024
+
+# Attribute set on messages which `mark_cleaned` marked as clean.
+CLEANED = '_repoze_sendmail_cleaned'
+
+
+def is_cleaned(message):
+    """
+    Whether `message` was marked as clean with `mark_cleaned`.
+    """
+    return getattr(message, CLEANED, False)
+
+
+def mark_cleaned(message):
+    """
+    Mark `message` as clean, so that `encode_message` does not clean it up
+    again, e.g. when it was read back from a queue file written after
+    `cleanup_message`.  Only mark messages which are not changed before
+    they are encoded; the mark stays on the message whatever happens to it.
+    """
+    setattr(message, CLEANED, True)
+    return message
+
 
 def cleanup_message(message,
-                   addr_headers=ADDR_HEADERS, param_headers=PARAM_HEADERS):
+                   addr_headers=ADDR_HEADERS, param_headers=PARAM_HEADERS,
+                   header_cache=None):
     """
     Cleanup a `Message` handling header and payload charsets.
 
@@ -35,39 +66,46 @@ def cleanup_message(message,
     while leaving the rest of the header to be handled without
     encoding.  Finally, all other header are left in `ascii` if
     possible or encoded to `iso-8859-1` or `utf-8` as a whole.
+    Short headers which are all `ascii` already (apart from
+    parameterized ones) are left as they are.
+
+    If `header_cache` (a `HeaderCache`) is given, encoded headers are
+    looked up there before being encoded again.
 
     The message is modified in place and is also returned in such a
-    state that it can be safely encoded to ascii.
+    state that it can be safely encoded to ascii.  It is not marked as
+    clean (see `mark_cleaned`), as it may still be changed afterwards.
     """
-    for key, value in message.items():
-        if key.lower() in addr_headers:
-            addrs = []
-            for name, addr in utils.getaddresses([value]):
-                best, encoded = best_charset(name)
+    # The header list is rebuilt in one pass, rather than replacing each
+    # header in turn, which is slow with many headers and which would
+    # replace the first of several headers with the same name every time.
+    store = _header_store(message)
+    headers = []
+    params = []
+    for stored, (key, value) in zip(message._headers, message.items()):
+        lower = key.lower()
+        if lower in param_headers:
+            params.append(key)
+        elif not _is_plain(key, value):
+            address = lower in addr_headers
+            if header_cache is None or not isinstance(value, string_types):
+                value = _encode_header(key, value, address)
+            else:
+                value = header_cache.get(key, value, address)
+            stored = store(key, value)
+        headers.append(stored)
+    message._headers = headers
+
+    for key in params:
+        for param_key, param_value in message.get_params(header=key):
+            if param_value:
+                best, encoded = best_charset(param_value)
                 if PY_2:
-                    name = encoded
-                name = header.Header(
-                    name, charset=best, header_name=key).encode()
-                addrs.append(utils.formataddr((name, addr)))
-            value = ', '.join(addrs)
-            message.replace_header(key, value)
-        if key.lower() in param_headers:
-            for param_key, param_value in message.get_params(header=key):
-                if param_value:
-                    best, encoded = best_charset(param_value)
-                    if PY_2:
-                        param_value = encoded
-                    if best == 'ascii':
-                        best = None
-                    message.set_param(param_key, param_value,
-                                      header=key, charset=best)
-        else:
-            best, encoded = best_charset(value)
-            if PY_2:
-                value = encoded
-            value = header.Header(
-                value, charset=best, header_name=key).encode()
-            message.replace_header(key, value)
+                    param_value = encoded
+                if best == 'ascii':
+                    best = None
+                message.set_param(param_key, param_value,
+                                  header=key, charset=best)
 
     payload = message.get_payload()
     if payload and isinstance(payload, text_type):
@@ -77,13 +115,58 @@ def cleanup_message(message,
             message.set_payload(payload, charset=charset)
     elif isinstance(payload, list):
         for part in payload:
-            cleanup_message(part)
+            cleanup_message(part, header_cache=header_cache)
 
     return message
 
 
+def _encode_header(key, value, address=False):
+    if address:
+        value = _encode_addresses(key, value)
+    if not _is_plain(key, value):
+        best, encoded = best_charset(value)
+        if PY_2:
+            value = encoded
+        value = header.Header(
+            value, charset=best, header_name=key).encode()
+    return value
+
+
+def _encode_addresses(key, value):
+    addrs = []
+    for name, addr in utils.getaddresses([value]):
+        best, encoded = best_charset(name)
+        if PY_2:
+            name = encoded
+        name = header.Header(
+            name, charset=best, header_name=key).encode()
+        addrs.append(utils.formataddr((name, addr)))
+    return ', '.join(addrs)
+
+
+def _header_store(message):
+    policy = getattr(message, 'policy', None)
+    if policy is None:  # pragma NO COVER Python 2
+        return lambda name, value: (name, value)
+    return policy.header_store_parse
+
+
+_NOT_PLAIN = re.compile('[^\x00-\x7f]|[\r\n]')
+
+
+def _is_plain(key, value):
+    # Whether a header can be left as it is: an ascii string short enough
+    # not to need folding.  Header objects are never taken as plain.
+    if not isinstance(value, string_types):
+        return False
+    if len(key) + len(value) + 2 > header.MAXLINELEN:
+        return False
+    return _NOT_PLAIN.search(value) is None
+
+
 def encode_message(message,
-                   addr_headers=ADDR_HEADERS, param_headers=PARAM_HEADERS):
+                   addr_headers=ADDR_HEADERS, param_headers=PARAM_HEADERS,
+                   header_cache=None):
     """
     Encode a `Message` handling headers and payloads.
 
@@ -97,12 +180,221 @@ def encode_message(message,
     encoding.  Finally, all other header are left in `ascii` if
     possible or encoded to `iso-8859-1` or `utf-8` as a whole.
 
+    Messages marked as clean with `mark_cleaned`, such as those which the
+    queue processor reads back from queue files, are not cleaned up again.
+
+    The return is a byte string of the whole message.
+    """
+    if not is_cleaned(message):
+        cleanup_message(message, addr_headers, param_headers, header_cache)
+    return encode_cleaned_message(message)
+
+
+def encode_cleaned_message(message):
+    """
+    Encode a `Message` which is known to be clean, i.e. which can be
+    safely encoded to ascii, without cleaning it up first.
+
     The return is a byte string of the whole message.
     """
-    cleanup_message(message)
     return message.as_string().encode('ascii')
 
 
+def write_message(message, fp,
+                  addr_headers=ADDR_HEADERS, param_headers=PARAM_HEADERS,
+                  header_cache=None, chunk_size=CHUNK_SIZE):
+    """
+    Encode a `Message` like `encode_message`, writing it to the binary
+    file `fp` (such as a pipe, a socket file or a temporary file) in chunks
+    of about `chunk_size` bytes, instead of returning it.
+
+    This saves holding the whole encoded message in memory, more than once,
+    on top of the message itself.  Returns the number of bytes written.
+    """
+    if not is_cleaned(message):
+        cleanup_message(message, addr_headers, param_headers, header_cache)
+    return _write_cleaned_message(message, fp, chunk_size)
+
+
+def _write_cleaned_message(message, fp, chunk_size=CHUNK_SIZE):
+    # `write_message` without the cleanup.
+    writer = _ChunkWriter(fp, chunk_size)
+    # the same as `Message.as_string` does
+    if PY_2:  # pragma NO COVER
+        generator = Generator(writer)
+    else:  # pragma NO COVER
+        generator = _StreamingGenerator(writer, mangle_from_=False,
+                                        maxheaderlen=0)
+    generator.flatten(message)
+    writer.flush()
+    return writer.written
+
+
+# Characters which `email` uses for undecodable bytes in payloads.
+_SURROGATES = re.compile(u('[\udc80-\udcff]'))
+
+
+class _StreamingGenerator(Generator):
+    # A `Generator` which writes each part of a message as it goes, where
+    # the stdlib one writes each part into a buffer before writing it out
+    # (so that it can still fix up its headers) and splits text into a list
+    # of lines.  The output is the same.
+
+    def _write(self, msg):
+        payload = msg._payload
+        if isinstance(payload, text_type) and _SURROGATES.search(payload):
+            # written with a different Content-Transfer-Encoding
+            return Generator._write(self, msg)
+        if (msg.get_content_maintype() == 'multipart' and
+                not msg.get_boundary()):
+            # chosen up front, as the headers are written first
+            msg.set_boundary(_make_boundary(msg))
+        meth = getattr(msg, '_write_headers', None)
+        if meth is None:
+            self._write_headers(msg)
+        else:
+            meth(self)
+        self._dispatch(msg)
+
+    def _handle_text(self, msg):
+        # Looking for surrogates here saves `get_payload` copying the
+        # payload to do so.
+        payload = msg._payload
+        if (self._mangle_from_ or not isinstance(payload, text_type) or
+                _SURROGATES.search(payload)):
+            return Generator._handle_text(self, msg)
+        self._write_lines(payload)
+
+    _writeBody = _handle_text
+
+    def _write_lines(self, lines):
+        if self._NL != '\n' or '\r' in lines:
+            # line endings to convert
+            return Generator._write_lines(self, lines)
+        self.write(lines)
+
+    def _handle_multipart(self, msg):
+        subparts = msg.get_payload()
+        if not isinstance(subparts, list):
+            return Generator._handle_multipart(self, msg)
+        boundary = msg.get_boundary()
+        if msg.preamble is not None:
+            self._write_lines(msg.preamble)
+            self.write(self._NL)
+        self.write('--' + boundary + self._NL)
+        for i, part in enumerate(subparts):
+            if i:
+                self.write(self._NL + '--' + boundary + self._NL)
+            self.clone(self._fp).flatten(part, unixfrom=False,
+                                         linesep=self._NL)
+        self.write(self._NL + '--' + boundary + '--' + self._NL)
+        if msg.epilogue is not None:
+            self._write_lines(msg.epilogue)
+
+
+def _make_boundary(msg):
+    # A boundary which does not appear in the payloads of `msg`.
+    texts = [part._payload for part in msg.walk()
+             if isinstance(part._payload, string_types)]
+    while True:
+        boundary = Generator._make_boundary()
+        if not any(boundary in text for text in texts):
+            return boundary
+
+
+class _ChunkWriter(object):
+    # Encodes the text written to it to ascii and writes it to binary file
+    # `fp` in chunks of at most `chunk_size` bytes.
+
+    def __init__(self, fp, chunk_size):
+        self.fp = fp
+        self.chunk_size = chunk_size
+        self.written = 0
+        self._buffer = []
+        self._buffered = 0
+
+    def write(self, text):
+        if len(text) > self.chunk_size:
+            # encoded a chunk at a time
+            self.flush()
+            for start in range(0, len(text), self.chunk_size):
+                self._write(
+                    text[start:start + self.chunk_size].encode('ascii'))
+            return
+        data = text.encode('ascii')
+        if self._buffered + len(data) < self.chunk_size:
+            self._buffer.append(data)
+            self._buffered += len(data)
+            return
+        self.flush()
+        self._buffer.append(data)
+        self._buffered = len(data)
+
+    def flush(self):
+        if self._buffer:
+            data = b''.join(self._buffer)
+            self._buffer = []
+            self._buffered = 0
+            self._write(data)
+
+    def _write(self, data):
+        self.fp.write(data)
+        self.written += len(data)
+
+
+class HeaderCache(object):
+    """
+    A bounded cache of encoded header values, for `cleanup_message`.
+
+    Messages sent in bulk often share headers, such as `From` or
+    `Reply-To`, which are then encoded over and over again.  The cache
+    maps a header name and raw value to the encoded value, keeping the
+    `maxsize` most recently used ones.  `hits` and `misses` count the
+    lookups which were and were not answered from the cache.
+
+    A `HeaderCache` may be shared between threads.  Share it only between
+    calls with the same `addr_headers`.
+    """
+    def __init__(self, maxsize=1024):
+        if maxsize < 1:
+            raise ValueError('maxsize must be at least 1')
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._values = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._values)
+
+    def get(self, name, value, address=False):
+        """
+        Return the encoded value of header `name`, encoding `value` (as a
+        list of addresses if `address` is true) if it is not cached.
+        """
+        key = (name, value, address)
+        with self._lock:
+            encoded = self._values.pop(key, None)
+            if encoded is not None:
+                # most recently used last
+                self._values[key] = encoded
+                self.hits += 1
+                return encoded
+            self.misses += 1
+        encoded = _encode_header(name, value, address)
+        with self._lock:
+            self._values[key] = encoded
+            while len(self._values) > self.maxsize:
+                self._values.popitem(last=False)
+        return encoded
+
+    def clear(self):
+        """Forget all values and reset the statistics."""
+        with self._lock:
+            self._values.clear()
+            self.hits = self.misses = 0
+
+
 def best_charset(text):
     """
     Find the most human-readable and/or conventional encoding for unicode text.
@@ -67,6 +67,20 @@ class IMailDelivery(Interface):
         Messages are actually sent during transaction commit.
         """
 
+    def send_raw(fromaddr, toaddrs, message):
+        """Send an already encoded email message.
+
+        `fromaddr` and `toaddrs` are as for `send`.
+
+        `message` is the complete RFC 5322 message as a byte string, e.g.
+        rendered by a `repoze.sendmail.template.MessageTemplate`.  It is
+        sent as is: no header is added and nothing is re-encoded.
+
+        Returns the message ID, if the message has one.
+
+        Messages are actually sent during transaction commit.
+        """
+
 class IMailer(Interface):
     """Handles synchronous mail delivery.
     """
@@ -83,3 +97,15 @@ class IMailer(Interface):
 
         Messages are sent immediatelly.
         """
+
+    def send_raw(fromaddr, toaddrs, message):
+        """Send an already encoded email message.
+
+        `fromaddr` and `toaddrs` are as for `send`.
+
+        `message` is the complete RFC 5322 message, either as a byte string
+        or as a file object opened in binary mode.  It is sent as is: no
+        header is added and nothing is re-encoded.
+
+        Messages are sent immediatelly.
+        """
@@ -20,16 +20,73 @@ Read/write access to `Maildir` folders.
 import os
 import errno
 import socket
+import sys
+import threading
 import time
 import random
-from email.generator import Generator
+
+from repoze.sendmail._compat import BytesGenerator
+
+ORDERS = ('mtime', 'name', None)
+
+DURABILITY = ('none', 'file', 'full')
+
+# Queue files are written through a buffer this large, so that a typical
+# message reaches the file in a single write.
+WRITE_BUFFER_SIZE = 64 * 1024
 
 class Maildir(object):
-    """See `repoze.sendmail.interfaces.IMaildir`"""
+    """See `repoze.sendmail.interfaces.IMaildir`
+
+    `order` controls the order in which messages are iterated:
+
+    ``'mtime'``
+        oldest modification time first (the default).  Every message is
+        stat'ed and the whole listing is sorted before the first message is
+        returned.
+
+    ``'name'``
+        oldest first according to the timestamp which `add` puts at the
+        start of each filename, so no message needs to be stat'ed.  Files
+        not named by `add` are ordered by modification time.
+
+    ``None``
+        directory order; messages are returned as the directories are read,
+        without building a list of the whole queue first.
+
+    `filter`, if set, is called with the path of each message before it is
+    stat'ed; messages for which it returns false are skipped.
+
+    `durability` controls what is flushed to disk when messages are added:
+
+    ``'none'``
+        nothing; a crash may lose messages which were reported committed
+        (the default).
+
+    ``'file'``
+        message files are fsync'ed before they are committed.
 
-    def __init__(self, path, create=False):
+    ``'full'``
+        additionally, the ``new`` directory is fsync'ed after a message is
+        committed, so that the commit itself survives a crash.  Commits
+        made at the same time share one directory fsync; a `group_commit`
+        window (in seconds) makes each fsync wait that long to collect more
+        commits, trading latency for fewer fsyncs under load.
+    """
+
+    filter = None
+
+    def __init__(self, path, create=False, order='mtime', durability='none',
+                 group_commit=0):
         """See `repoze.sendmail.interfaces.IMaildirFactory`"""
+        if order not in ORDERS:
+            raise ValueError('Unknown order: %r' % (order,))
+        if durability not in DURABILITY:
+            raise ValueError('Unknown durability: %r' % (durability,))
         self.path = path
+        self.order = order
+        self.durability = durability
+        self.group_commit = group_commit
 
         subdir_cur = os.path.join(path, 'cur')
         subdir_new = os.path.join(path, 'new')
@@ -49,27 +106,60 @@ class Maildir(object):
 
     def __iter__(self):
         "See `repoze.sendmail.interfaces.IMaildir`"
+        if self.order is None:
+            return (path for path, entry in self._messages())
+        if self.order == 'name':
+            key = _name_order
+        else:
+            key = _mtime
+        # Sort by time so earlier messages are sent before later messages
+        # during queue processing.
+        msgs_sorted = []
+        for path, entry in self._messages():
+            try:
+                msgs_sorted.append((key(path, entry), path))
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+                # already sent and removed by someone else
+        msgs_sorted.sort(key=lambda x: x[0])
+        return iter([m[1] for m in msgs_sorted])
+
+    def _messages(self):
+        """Yield the path of and the directory entry for each message.
+
+        The directory entry is None where ``os.scandir`` is not available.
+        """
         join = os.path.join
-        subdir_cur = join(self.path, 'cur')
-        subdir_new = join(self.path, 'new')
-        # http://www.qmail.org/man/man5/maildir.html says:
-        #     "It is a good idea for readers to skip all filenames in new
-        #     and cur starting with a dot.  Other than this, readers
-        #     should not attempt to parse filenames."
-        new_messages = [join(subdir_new, x) for x in os.listdir(subdir_new)
-                        if not x.startswith('.')]
-        cur_messages = [join(subdir_cur, x) for x in os.listdir(subdir_cur)
-                        if not x.startswith('.')]
-
-        # Sort by modification time so earlier messages are sent before
-        # later messages during queue processing.
-        msgs_sorted = [(m, os.path.getmtime(m)) for m
-                      in new_messages + cur_messages]
-        msgs_sorted.sort(key=lambda x: x[1])
-        return iter([m[0] for m in msgs_sorted])
-
-    def add(self, message):
-        "See `repoze.sendmail.interfaces.IMaildir`"
+        scandir = getattr(os, 'scandir', None)
+        accept = self.filter
+        if accept is None:
+            accept = lambda path: True
+        for subdir in ('new', 'cur'):
+            subdir = join(self.path, subdir)
+            # http://www.qmail.org/man/man5/maildir.html says:
+            #     "It is a good idea for readers to skip all filenames in new
+            #     and cur starting with a dot.  Other than this, readers
+            #     should not attempt to parse filenames."
+            if scandir is None:
+                for name in os.listdir(subdir):
+                    if not name.startswith('.'):
+                        path = join(subdir, name)
+                        if accept(path):
+                            yield path, None
+            else:
+                for entry in scandir(subdir):
+                    if not entry.name.startswith('.') and accept(entry.path):
+                        yield entry.path, entry
+
+    def add(self, message, headers=()):
+        """See `repoze.sendmail.interfaces.IMaildir`
+
+        `headers` is a sequence of ``(name, value)`` pairs, with values
+        already encoded, which are written ahead of the headers of `message`.
+        `message` itself is flattened straight into the file, unless it is
+        already encoded as bytes.
+        """
         join = os.path.join
         subdir_tmp = join(self.path, 'tmp')
         subdir_new = join(self.path, 'new')
@@ -101,23 +191,149 @@ class Maildir(object):
             else:
                 break
 
-        with os.fdopen(fd, 'w') as f:
-            writer = Generator(f)
-            writer.flatten(message)
+        with os.fdopen(fd, 'wb', WRITE_BUFFER_SIZE) as f:
+            for name, value in headers:
+                f.write(('%s: %s\n' % (name, value)).encode('ascii'))
+            if isinstance(message, bytes):
+                f.write(message)
+            else:
+                writer = BytesGenerator(f)
+                writer.flatten(message)
+            if self.durability != 'none':
+                f.flush()
+                os.fsync(f.fileno())
+
+        if self.durability == 'full':
+            sync = _directory_sync(subdir_new, self.group_commit)
+        else:
+            sync = None
+        return MaildirTransactionalMessage(filename, join(subdir_new, unique),
+                                           sync)
+
 
-        return MaildirTransactionalMessage(filename, join(subdir_new, unique))
+def _mtime(path, entry):
+    if entry is None:
+        return os.path.getmtime(path)
+    # On some platforms the directory listing already carries this.
+    return entry.stat().st_mtime
+
+def _name_order(path, entry):
+    # `Maildir.add` names files "<timestamp>.<pid>.<host>.<random>".  This
+    # deliberately ignores the qmail advice against parsing the names, but
+    # only for files that we named ourselves.
+    name = os.path.basename(path)
+    timestamp = name.split('.', 1)[0]
+    if timestamp.isdigit():
+        return int(timestamp)
+    return _mtime(path, entry)
+
+
+def _fsync_dir(path):
+    if sys.platform == 'win32': #pragma NO COVER
+        # Directories cannot be opened, and need not be synced, there.
+        return
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class _DirectorySync(object):
+    """Callable which fsyncs a directory on behalf of many committers.
+
+    A caller returns once an fsync which started after it was called has
+    completed.  Callers arriving while an fsync is underway wait for it to
+    finish and are then covered, together, by the next one.
+    """
+
+    def __init__(self, path, window=0):
+        self.path = path
+        self.window = window
+        self._cond = threading.Condition()
+        self._requested = 0
+        self._synced = 0
+        self._syncing = False
+
+    def __call__(self):
+        self._cond.acquire()
+        try:
+            self._requested += 1
+            ticket = self._requested
+            while self._synced < ticket:
+                if self._syncing:
+                    self._cond.wait()
+                else:
+                    self._sync()
+        finally:
+            self._cond.release()
+
+    def _sync(self):
+        # Called, and returns, with the lock held; releases it meanwhile.
+        self._syncing = True
+        covered = None
+        self._cond.release()
+        try:
+            if self.window:
+                time.sleep(self.window)
+            self._cond.acquire()
+            pending = self._requested
+            self._cond.release()
+            _fsync_dir(self.path)
+            covered = pending
+        finally:
+            self._cond.acquire()
+            self._syncing = False
+            if covered is not None:
+                self._synced = max(self._synced, covered)
+            self._cond.notify_all()
+
+
+_directory_syncs = {}
+_directory_syncs_lock = threading.Lock()
+
+def _directory_sync(path, window):
+    # Share one `_DirectorySync` per directory, since the deliveries create
+    # a new `Maildir` for every message.
+    with _directory_syncs_lock:
+        sync = _directory_syncs.get((path, window))
+        if sync is None:
+            sync = _directory_syncs[(path, window)] = _DirectorySync(path,
+                                                                     window)
+        return sync
+
+
+def commit_messages(messages):
+    """Commit several `MaildirTransactionalMessage` objects at once.
+
+    All of the messages are moved into their folders before any directory
+    is synced, so that each directory is synced only once.
+    """
+    syncs = []
+    for message in messages:
+        message.commit(sync=False)
+        if message._sync is not None and message._sync not in syncs:
+            syncs.append(message._sync)
+    for sync in syncs:
+        sync()
 
 
 class MaildirTransactionalMessage(object):
     """See `repoze.sendmail.interfaces.ITransactionalMessage`"""
 
-    def __init__(self, pending_path, committed_path):
+    def __init__(self, pending_path, committed_path, sync=None):
         self._pending_path = pending_path
         self._committed_path = committed_path
+        self._sync = sync
         self._committed = False
         self._aborted = False
 
-    def commit(self):
+    def commit(self, sync=True):
+        """Move the message into the folder.
+
+        With a false `sync` the directory is not synced, even if the folder's
+        durability asks for it; see `commit_messages`.
+        """
         if self._aborted:
             raise RuntimeError('Cannot commit--already aborted.')
         if self._committed:
@@ -125,6 +341,8 @@ class MaildirTransactionalMessage(object):
 
         os.rename(self._pending_path, self._committed_path)
         self._committed = True
+        if sync and self._sync is not None:
+            self._sync()
 
     def abort(self):
         if self._aborted:
@@ -12,8 +12,22 @@
 #
 ##############################################################################
 from email.message import Message
+import errno
+import logging
+import re
+import shutil
 import subprocess
+import sys
+import threading
+import time
 from smtplib import SMTP
+from tempfile import SpooledTemporaryFile
+from smtplib import SMTPDataError
+from smtplib import SMTPException
+from smtplib import SMTPRecipientsRefused
+from smtplib import SMTPSenderRefused
+from smtplib import SMTPServerDisconnected
+from smtplib import quoteaddr
 
 try:
     import ssl
@@ -27,20 +41,578 @@ else:  # pragma NO COVER
     from smtplib import SMTP_SSL
 
 from zope.interface import implementer
+from repoze.sendmail.encoding import CHUNK_SIZE
+from repoze.sendmail.encoding import _write_cleaned_message
+from repoze.sendmail.encoding import cleanup_message
 from repoze.sendmail.encoding import encode_message
+from repoze.sendmail.encoding import is_cleaned
+from repoze.sendmail.encoding import write_message
 from repoze.sendmail.interfaces import IMailer
+from repoze.sendmail.ratelimit import is_throttling
+from repoze.sendmail._compat import Full
+from repoze.sendmail._compat import Queue
 from repoze.sendmail._compat import SSLError
+from repoze.sendmail._compat import text_type
+
+
+class _PooledConnection(object):
+    """Book-keeping wrapper for a connection held by `SMTPConnectionPool`.
+    """
+    def __init__(self, connection, key):
+        self.connection = connection
+        self.key = key
+        self.created = self.last_used = time.time()
+        self.messages = 0
+
+
+class SMTPConnectionPool(object):
+    """A bounded pool of connected and authenticated SMTP connections.
+
+    At most `size` connections are open at once, whether idle or in use;
+    callers asking for more block until one is released.  Idle connections
+    are closed once they have been unused for `idle_timeout` seconds, have
+    been open for `max_age` seconds or have carried `max_messages`
+    messages.  A value of `None` disables the corresponding limit.
+    """
+    def __init__(self, size=4, idle_timeout=60, max_messages=100,
+                 max_age=600):
+        if size < 1:
+            raise ValueError('Pool size must be at least 1')
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self.max_messages = max_messages
+        self.max_age = max_age
+        self._idle = []
+        self._leased = 0
+        self._cond = threading.Condition()
+
+    def _expired(self, entry, now):
+        if self.max_messages is not None and (
+            entry.messages >= self.max_messages):
+            return True
+        if self.max_age is not None and now - entry.created >= self.max_age:
+            return True
+        if self.idle_timeout is not None and (
+            now - entry.last_used >= self.idle_timeout):
+            return True
+        return False
+
+    def _evict(self, now):
+        # Must be called with the lock held; returns the evicted entries
+        # so that they can be closed once the lock is released.
+        evicted = [e for e in self._idle if self._expired(e, now)]
+        if evicted:
+            self._idle = [e for e in self._idle if e not in evicted]
+        return evicted
+
+    def acquire(self, key, connect):
+        """Lease a connection for `key`.
+
+        An idle connection opened for the same `key` is reused if there is
+        one; otherwise `connect()` is called to open a new one.  Returns a
+        pool entry whose `connection` attribute is the SMTP connection.
+        """
+        evicted = []
+        entry = None
+        self._cond.acquire()
+        try:
+            while True:
+                evicted.extend(self._evict(time.time()))
+                for candidate in reversed(self._idle):
+                    if candidate.key == key:
+                        entry = candidate
+                        self._idle.remove(entry)
+                        break
+                if entry is not None:
+                    break
+                if self._leased + len(self._idle) < self.size:
+                    break
+                if self._idle:
+                    # Make room by dropping the least recently used
+                    # connection to some other destination.
+                    evicted.append(self._idle.pop(0))
+                    continue
+                self._cond.wait()
+            self._leased += 1
+        finally:
+            self._cond.release()
+
+        for stale in evicted:
+            _close_connection(stale.connection)
+
+        if entry is None:
+            try:
+                entry = _PooledConnection(connect(), key)
+            except:
+                self._return_lease()
+                raise
+        return entry
+
+    def release(self, entry):
+        """Return a leased connection to the pool for reuse."""
+        entry.last_used = time.time()
+        self._cond.acquire()
+        try:
+            self._leased -= 1
+            if self._expired(entry, entry.last_used):
+                expired = entry
+            else:
+                expired = None
+                self._idle.append(entry)
+            self._cond.notify()
+        finally:
+            self._cond.release()
+        if expired is not None:
+            _close_connection(expired.connection)
+
+    def discard(self, entry):
+        """Drop a leased connection which is broken or in an unknown state.
+        """
+        self._return_lease()
+        _close_connection(entry.connection, quit=False)
+
+    @property
+    def leased(self):
+        """The number of connections leased out."""
+        return self._leased
+
+    def sweep(self):
+        """Close the idle connections which have expired.
+
+        This is otherwise only done when a connection is asked for, which
+        may be never for a pool which is not used any more.
+        """
+        self._cond.acquire()
+        try:
+            evicted = self._evict(time.time())
+        finally:
+            self._cond.release()
+        for stale in evicted:
+            _close_connection(stale.connection)
+
+    def close(self):
+        """Close all idle connections."""
+        self._cond.acquire()
+        try:
+            idle, self._idle = self._idle, []
+        finally:
+            self._cond.release()
+        for entry in idle:
+            _close_connection(entry.connection)
+
+    def _return_lease(self):
+        self._cond.acquire()
+        try:
+            self._leased -= 1
+            self._cond.notify()
+        finally:
+            self._cond.release()
+
+
+def _read_raw(message):
+    # `IMailer.send_raw` accepts bytes or a binary file object.
+    read = getattr(message, 'read', None)
+    if read is not None:
+        message = read()
+    if not isinstance(message, bytes):
+        raise ValueError('Message must be bytes or a binary file object')
+    return message
+
+
+# Messages larger than this are sent from a file, a chunk at a time.
+SPOOL_SIZE = 1024 * 1024
+
+
+class _MessageFile(object):
+    # A message in a seekable binary file, from offset `start` to its end,
+    # which is too large to be read into memory at once.
+
+    def __init__(self, fp, start, size, chunk_size=CHUNK_SIZE):
+        self.fp = fp
+        self.start = start
+        self.size = size
+        self.chunk_size = chunk_size
+
+    def __len__(self):
+        return self.size
+
+    def chunks(self):
+        self.fp.seek(self.start)
+        while True:
+            chunk = self.fp.read(self.chunk_size)
+            if not chunk:
+                break
+            yield chunk
+
+
+def _read_large(message, spool_size):
+    # Like `_read_raw`, but leaves messages in seekable files larger than
+    # `spool_size` bytes in their file, as a `_MessageFile`.
+    seek = getattr(message, 'seek', None)
+    if seek is None or getattr(message, 'read', None) is None:
+        return _read_raw(message)
+    try:
+        start = message.tell()
+        seek(0, 2)
+        size = message.tell() - start
+        seek(start)
+    except (EnvironmentError, ValueError):
+        # not seekable after all
+        return _read_raw(message)
+    if size <= spool_size:
+        return _read_raw(message)
+    return _MessageFile(message, start, size)
+
+
+def _spool(message, spool_size):
+    # Encode `message` into a file, which stays in memory unless the
+    # message is larger than `spool_size` bytes.
+    spool = SpooledTemporaryFile(spool_size)
+    try:
+        write_message(message, spool)
+        spool.seek(0)
+    except:
+        spool.close()
+        raise
+    return spool
+
+
+_LEADING_PERIOD = re.compile(br'(?m)^\.')
+_PERIOD_AFTER_NEWLINE = re.compile(br'\n\.')
+
+def _quote_data(message):
+    # What `smtplib.SMTP.data` sends for a bytes `message`.
+    data = _LEADING_PERIOD.sub(b'..', message)
+    if not data.endswith(b'\r\n'):
+        data += b'\r\n'
+    return data + b'.\r\n'
+
+
+def _send_data(connection, message):
+    # Send `message`, bytes or a `_MessageFile`, quoted as DATA.
+    if isinstance(message, bytes):
+        connection.send(_quote_data(message))
+        return
+    last = b'\n'
+    tail = b''
+    for chunk in message.chunks():
+        # Periods are quoted at the start of lines, which may have begun
+        # in the previous chunk.
+        data = _PERIOD_AFTER_NEWLINE.sub(b'\n..', last + chunk)[1:]
+        connection.send(data)
+        last = chunk[-1:]
+        tail = (tail + data)[-2:]
+    if tail != b'\r\n':
+        connection.send(b'\r\n')
+    connection.send(b'.\r\n')
+
+
+def _sendmail_streamed(connection, fromaddr, toaddrs, message):
+    """Like ``connection.sendmail``, but sending `message`, a
+    `_MessageFile`, from its file a chunk at a time.
+
+    Refusals are reported with the same exceptions, and the same return
+    value, as `smtplib.SMTP.sendmail`.
+    """
+    connection.ehlo_or_helo_if_needed()
+    options = []
+    if connection.does_esmtp and connection.has_extn('size'):
+        options.append('size=%d' % len(message))
+    if isinstance(toaddrs, (str, text_type)):
+        toaddrs = [toaddrs]
+    code, resp = connection.mail(fromaddr, options)
+    if code != 250:
+        _abort_transaction(connection, code)
+        raise SMTPSenderRefused(code, resp, fromaddr)
+    senderrs = {}
+    for addr in toaddrs:
+        code, resp = connection.rcpt(addr)
+        if code not in (250, 251):
+            senderrs[addr] = (code, resp)
+        if code == 421:
+            connection.close()
+            raise SMTPRecipientsRefused(senderrs)
+    if len(senderrs) == len(toaddrs):
+        # the server refused all our recipients
+        connection.rset()
+        raise SMTPRecipientsRefused(senderrs)
+    connection.putcmd('data')
+    code, resp = connection.getreply()
+    if code != 354:
+        _abort_transaction(connection, code)
+        raise SMTPDataError(code, resp)
+    _send_data(connection, message)
+    code, resp = connection.getreply()
+    if code != 250:
+        _abort_transaction(connection, code)
+        raise SMTPDataError(code, resp)
+    return senderrs
+
+
+def _closing(error):
+    # Whether the server closed the connection when it sent `error`.
+    if isinstance(error, SMTPRecipientsRefused):
+        return any(code == 421 for code, resp in error.recipients.values())
+    return getattr(error, 'smtp_code', None) == 421
+
+
+def _abort_transaction(connection, code):
+    if code == 421:
+        connection.close()
+    else:
+        connection.rset()
+
+
+def _sendmail_pipelined(connection, fromaddr, toaddrs, message):
+    """Like ``connection.sendmail``, but using ESMTP PIPELINING (RFC 2920).
+
+    MAIL, all of the RCPT commands and DATA are sent in one go and the
+    replies are read afterwards, instead of waiting for each reply in
+    turn.  Refusals are reported with the same exceptions, and the same
+    return value, as `smtplib.SMTP.sendmail`.
+    """
+    options = ''
+    if connection.has_extn('size'):
+        options = ' size=%d' % len(message)
+    if isinstance(toaddrs, (str, text_type)):
+        toaddrs = [toaddrs]
+    commands = ['mail FROM:%s%s' % (quoteaddr(fromaddr), options)]
+    commands.extend(['rcpt TO:%s' % quoteaddr(addr) for addr in toaddrs])
+    commands.append('data')
+    connection.send(''.join([command + '\r\n' for command in commands]))
+
+    # All of the replies must be read, even after a refusal, to keep the
+    # session in step.
+    mail_code, mail_resp = connection.getreply()
+    if mail_code == 421:
+        # The server is closing the connection: there are no more replies.
+        connection.close()
+        raise SMTPSenderRefused(mail_code, mail_resp, fromaddr)
+    senderrs = {}
+    closing = False
+    for addr in toaddrs:
+        code, resp = connection.getreply()
+        if code not in (250, 251):
+            senderrs[addr] = (code, resp)
+        if code == 421:
+            closing = True
+            break
+    if not closing:
+        code, resp = connection.getreply()
+        if code == 354 and (mail_code != 250 or
+                            len(senderrs) == len(toaddrs)):
+            # The server accepted DATA without a valid transaction;
+            # end it without sending the message.
+            connection.send(b'.\r\n')
+            connection.getreply()
+    if mail_code != 250:
+        _abort_transaction(connection, 421 if closing else mail_code)
+        raise SMTPSenderRefused(mail_code, mail_resp, fromaddr)
+    if closing:
+        connection.close()
+        raise SMTPRecipientsRefused(senderrs)
+    if len(senderrs) == len(toaddrs):
+        # the server refused all our recipients
+        connection.rset()
+        raise SMTPRecipientsRefused(senderrs)
+    if code != 354:
+        # End the transaction, or the next MAIL on the session is refused.
+        _abort_transaction(connection, code)
+        raise SMTPDataError(code, resp)
+
+    _send_data(connection, message)
+    code, resp = connection.getreply()
+    if code != 250:
+        _abort_transaction(connection, code)
+        raise SMTPDataError(code, resp)
+    return senderrs
+
+
+def _close_connection(connection, quit=True):
+    try:
+        if quit:
+            connection.quit()
+        else:
+            connection.close()
+    except (SMTPException, SSLError, EnvironmentError):
+        # something weird happened while quiting
+        connection.close()
+
+
+RELAY_STRATEGIES = ('round-robin', 'least-in-flight', 'latency')
+
+
+class Relay(object):
+    """An SMTP relay host, as used by `RelaySet`.
+    """
+    def __init__(self, hostname, port=25, weight=1):
+        if weight < 1:
+            raise ValueError('Relay weight must be at least 1')
+        self.hostname = hostname
+        self.port = port
+        self.weight = weight
+        self.in_flight = 0
+        self.latency = None
+        self.ejected_until = 0
+        self._current = 0
+
+    def __repr__(self):
+        return '<Relay %s:%s*%s>' % (self.hostname, self.port, self.weight)
+
+
+def parse_relays(value):
+    """Parse relays given as ``host[:port][*weight]``, separated by commas or
+    whitespace, into a list of `Relay` objects.
+    """
+    relays = []
+    for spec in value.replace(',', ' ').split():
+        weight = 1
+        port = 25
+        if '*' in spec:
+            spec, weight = spec.rsplit('*', 1)
+            weight = int(weight)
+        if ':' in spec:
+            spec, port = spec.rsplit(':', 1)
+            port = int(port)
+        relays.append(Relay(spec, port, weight))
+    return relays
+
+
+class RelaySet(object):
+    """Chooses among several relays, and keeps failing ones out of use.
+
+    `relays` is a sequence of `Relay` objects, ``(hostname, port[, weight])``
+    tuples or ``host[:port][*weight]`` strings, or a single string listing
+    them as understood by `parse_relays`.  `strategy` is one of
+
+    ``'round-robin'``
+        each relay in turn, in proportion to its weight.
+
+    ``'least-in-flight'``
+        the relay with the fewest messages being sent through it, relative
+        to its weight.
+
+    ``'latency'``
+        the relay which has recently been the fastest to accept a message,
+        allowing for the messages being sent through it.  Relays not yet
+        used are tried first.
+
+    A relay which is `eject` -ed is not chosen for `ejection_time` seconds,
+    unless all relays are ejected.
+    """
+    # Weight of the latest measurement in the moving average of latencies.
+    smoothing = 0.3
+
+    def __init__(self, relays, strategy='round-robin', ejection_time=30):
+        if strategy not in RELAY_STRATEGIES:
+            raise ValueError('Unknown relay strategy: %r' % (strategy,))
+        if isinstance(relays, (str, text_type)):
+            relays = parse_relays(relays)
+        self.relays = []
+        for relay in relays:
+            if isinstance(relay, (str, text_type)):
+                self.relays.extend(parse_relays(relay))
+            elif isinstance(relay, Relay):
+                self.relays.append(relay)
+            else:
+                self.relays.append(Relay(*relay))
+        if not self.relays:
+            raise ValueError('No relays given')
+        self.strategy = strategy
+        self.ejection_time = ejection_time
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.relays)
+
+    def choose(self, exclude=()):
+        """Return the relay to use next, other than those in `exclude`."""
+        with self._lock:
+            now = time.time()
+            candidates = [r for r in self.relays if r not in exclude]
+            if not candidates:
+                candidates = list(self.relays)
+            usable = [r for r in candidates if r.ejected_until <= now]
+            if not usable:
+                # Everything is ejected: try the one back soonest.
+                usable = [min(candidates, key=lambda r: r.ejected_until)]
+            if self.strategy == 'least-in-flight':
+                return min(usable,
+                           key=lambda r: float(r.in_flight) / r.weight)
+            if self.strategy == 'latency':
+                return min(usable, key=_expected_latency)
+            # Smooth weighted round-robin, as in nginx.
+            total = 0
+            best = None
+            for relay in usable:
+                relay._current += relay.weight
+                total += relay.weight
+                if best is None or relay._current > best._current:
+                    best = relay
+            best._current -= total
+            return best
+
+    def started(self, relay):
+        with self._lock:
+            relay.in_flight += 1
+
+    def finished(self, relay, elapsed=None):
+        """Record the end of a send through `relay`, which took `elapsed`
+        seconds if it succeeded.
+        """
+        with self._lock:
+            relay.in_flight -= 1
+            if elapsed is not None:
+                if relay.latency is None:
+                    relay.latency = elapsed
+                else:
+                    relay.latency += self.smoothing * (elapsed -
+                                                       relay.latency)
+
+    def eject(self, relay):
+        """Take `relay` out of use for a while."""
+        with self._lock:
+            relay.ejected_until = time.time() + self.ejection_time
+
+
+def _expected_latency(relay):
+    if relay.latency is None:
+        return (0, relay.in_flight)
+    return (1, relay.latency * (relay.in_flight + 1) / relay.weight)
 
 
 @implementer(IMailer)
 class SMTPMailer(object):
+    """Sends messages through an SMTP server.
+
+    Messages go to `hostname` and `port`, unless `relays` are given (see
+    `RelaySet`, to which `relays`, `relay_strategy` and
+    `relay_ejection_time` are passed).  Relays which cannot be connected to,
+    or which answer with a transient (4xx) error, are ejected for a while
+    and the message is tried on the next one.
+
+    `rate_limit` is an optional `repoze.sendmail.ratelimit.RateLimiter`,
+    which messages wait for before they are sent; its per-relay limits
+    apply to each relay, or to `hostname` and `port`.
+
+    Messages larger than `spool_size` bytes, whether encoded by `send` or
+    passed to `send_raw` in a seekable file, are not held in memory but
+    sent from a (temporary) file, a chunk at a time.
+    """
 
     smtp = SMTP  # allow replacement for testing.
     smtp_ssl = SMTP_SSL # allow replacement for testing.
+    spool_size = SPOOL_SIZE
+    # All messages go to the same place, see `destination`.
+    fixed_destination = True
 
     def __init__(self, hostname='localhost', port=25,
                  username=None, password=None,
-                 no_tls=False, force_tls=False, ssl=False, debug_smtp=False):
+                 no_tls=False, force_tls=False, ssl=False, debug_smtp=False,
+                 pool_size=0, pool_idle_timeout=60, pool_max_messages=100,
+                 pool_max_age=600, pipelining=True, relays=None,
+                 relay_strategy='round-robin', relay_ejection_time=30,
+                 rate_limit=None):
         self.hostname = hostname
         self.port = port
         self.username = username
@@ -49,10 +621,28 @@ class SMTPMailer(object):
         self.no_tls = no_tls
         self.ssl = ssl
         self.debug_smtp = debug_smtp
+        self.pipelining = pipelining
+        self.rate_limit = rate_limit
+        if relays:
+            self.relays = RelaySet(relays, relay_strategy,
+                                   relay_ejection_time)
+        else:
+            self.relays = None
+        if pool_size:
+            self.pool = SMTPConnectionPool(pool_size,
+                                           idle_timeout=pool_idle_timeout,
+                                           max_messages=pool_max_messages,
+                                           max_age=pool_max_age)
+        else:
+            self.pool = None
 
-    def smtp_factory(self):
-        hostname = self.hostname
-        port = str(self.port)
+    def smtp_factory(self, relay=None):
+        if relay is None:
+            hostname = self.hostname
+            port = str(self.port)
+        else:
+            hostname = relay.hostname
+            port = str(relay.port)
         timeout = 10
         if self.ssl:
             if self.smtp_ssl is None:
@@ -63,13 +653,22 @@ class SMTPMailer(object):
         connection.set_debuglevel(self.debug_smtp)
         return connection
 
-    def send(self, fromaddr, toaddrs, message):
-        if not isinstance(message, Message):
-            raise ValueError(
-               'Message must be instance of email.message.Message')
-        message = encode_message(message)
+    def _connect(self, relay=None):
+        """Open a connection and get it ready for sending: greet the
+        server, start TLS and log in as configured.
+        """
+        if relay is None:
+            connection = self.smtp_factory()
+        else:
+            connection = self.smtp_factory(relay)
+        try:
+            self._setup(connection)
+        except:
+            _close_connection(connection, quit=False)
+            raise
+        return connection
 
-        connection = self.smtp_factory()
+    def _setup(self, connection):
 
         # send EHLO
         code, response = connection.ehlo()
@@ -97,12 +696,358 @@ class SMTPMailer(object):
                     'Mailhost does not support ESMTP but a username '
                     'is configured')
 
-        connection.sendmail(fromaddr, toaddrs, message)
+    def _acquire(self, relay=None):
+        """Lease a live connection from the pool.
+
+        Idle connections are probed with RSET, which also clears any
+        leftover transaction state; those the server has dropped in the
+        meantime are replaced by fresh ones.
+        """
+        if relay is None:
+            key = (self.hostname, self.port)
+            connect = self._connect
+        else:
+            key = (relay.hostname, relay.port)
+            connect = lambda: self._connect(relay)
+        while True:
+            entry = self.pool.acquire(key, connect)
+            if not entry.messages:
+                return entry
+            try:
+                entry.connection.rset()
+            except (SMTPServerDisconnected, SSLError, EnvironmentError):
+                self.pool.discard(entry)
+            else:
+                return entry
+
+    def send(self, fromaddr, toaddrs, message):
+        with self.session() as session:
+            session.send(fromaddr, toaddrs, message)
+
+    def _lease(self, relay=None):
+        if self.pool is None:
+            if relay is None:
+                return _PooledConnection(self._connect(), None)
+            return _PooledConnection(self._connect(relay), None)
+        return self._acquire(relay)
+
+    def _release(self, entry):
+        if self.pool is None:
+            _close_connection(entry.connection)
+        else:
+            self.pool.release(entry)
+
+    def _discard(self, entry):
+        if self.pool is None:
+            _close_connection(entry.connection, quit=False)
+        else:
+            self.pool.discard(entry)
+
+    def _sendmail(self, connection, fromaddr, toaddrs, message):
+        if self.pipelining and connection.has_extn('pipelining'):
+            return _sendmail_pipelined(connection, fromaddr, toaddrs, message)
+        if isinstance(message, _MessageFile):
+            return _sendmail_streamed(connection, fromaddr, toaddrs, message)
+        return connection.sendmail(fromaddr, toaddrs, message)
+
+    def send_raw(self, fromaddr, toaddrs, message):
+        with self.session() as session:
+            return session.send_raw(fromaddr, toaddrs, message)
+
+    def session(self):
+        """Return an `SMTPSession` sending messages over one connection.
+        """
+        return SMTPSession(self)
+
+    def destination(self, toaddrs):
+        """Return where messages to `toaddrs` are sent, for grouping them.
+
+        All messages go to the same host or set of relays.
+        """
+        return None
+
+    def close(self):
+        """Close any pooled connections."""
+        if self.pool is not None:
+            self.pool.close()
+
+
+class SMTPSession(object):
+    """Sends several messages back-to-back over a single SMTP connection.
+
+    Use it as a context manager; the connection is opened (or leased from
+    the mailer's pool) by the first message and closed (or returned to the
+    pool) on exit.  A connection which the server drops is replaced by the
+    next message.
+    """
+    def __init__(self, mailer):
+        self.mailer = mailer
+        self._entry = None
+        self._relay = None
+        self._connected = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+
+    def send(self, fromaddr, toaddrs, message):
+        if not isinstance(message, Message):
+            raise ValueError(
+               'Message must be instance of email.message.Message')
+        spool = _spool(message, self.mailer.spool_size)
         try:
-            connection.quit()
-        except SSLError:
-            # something weird happened while quiting
-            connection.close()
+            self.send_raw(fromaddr, toaddrs, spool)
+        finally:
+            spool.close()
+
+    def send_raw(self, fromaddr, toaddrs, message):
+        message = _read_large(message, self.mailer.spool_size)
+        tried = []
+        while True:
+            connecting = self._entry is None
+            self._connected = not connecting
+            if connecting and self.mailer.relays is not None:
+                self._relay = self.mailer.relays.choose(tried)
+            try:
+                # Connecting is limited too: a busy server may refuse the
+                # connection with a 421 greeting.
+                return self._limited(self._send, fromaddr, toaddrs, message)
+            except (SMTPException, SSLError, EnvironmentError) as e:
+                # Messages refused for good are not the relay's fault, and
+                # those which may have been sent are not sent again.
+                if not self._connected:
+                    if not self._failed(tried):
+                        raise
+                    continue
+                if not is_throttling(e) or not self._failed(tried):
+                    raise
+                self.close()
+
+    def _failed(self, tried):
+        # Eject the relay in use; returns whether to fail over to another.
+        relays = self.mailer.relays
+        if relays is None:
+            return False
+        relays.eject(self._relay)
+        tried.append(self._relay)
+        return len(tried) < len(relays)
+
+    def _limited(self, send, fromaddr, toaddrs, message):
+        # Call `send` within the mailer's rate limits, if any.
+        limiter = self.mailer.rate_limit
+        if limiter is None:
+            return send(fromaddr, toaddrs, message)
+        if self._relay is None:
+            server = (self.mailer.hostname, self.mailer.port)
+        else:
+            server = (self._relay.hostname, self._relay.port)
+        limiter.acquire(toaddrs, server)
+        try:
+            refused = send(fromaddr, toaddrs, message)
+        except Exception as e:
+            limiter.failed(e, toaddrs, server)
+            raise
+        limiter.succeeded(toaddrs, server)
+        return refused
+
+    def _send(self, fromaddr, toaddrs, message):
+        if self._entry is None:
+            self._entry = self.mailer._lease(self._relay)
+            self._connected = True
+        return self._sendmail(fromaddr, toaddrs, message)
+
+    def _sendmail(self, fromaddr, toaddrs, message):
+        entry = self._entry
+        relays = self.mailer.relays
+        if relays is not None:
+            relay = self._relay
+            relays.started(relay)
+        started = time.time()
+        elapsed = None
+        try:
+            refused = self.mailer._sendmail(entry.connection, fromaddr,
+                                            toaddrs, message)
+            elapsed = time.time() - started
+        except SMTPServerDisconnected:
+            self._entry = None
+            self.mailer._discard(entry)
+            raise
+        except SMTPException as e:
+            if _closing(e):
+                # The server closed the connection along with its refusal.
+                self._entry = None
+                self.mailer._discard(entry)
+                raise
+            # The server refused the message but the session is still
+            # usable; smtplib has already reset it.
+            entry.messages += 1
+            raise
+        except:
+            self._entry = None
+            self.mailer._discard(entry)
+            raise
+        finally:
+            if relays is not None:
+                relays.finished(relay, elapsed)
+        entry.messages += 1
+        return refused
+
+    def close(self):
+        entry, self._entry = self._entry, None
+        if entry is not None:
+            self.mailer._release(entry)
+
+
+@implementer(IMailer)
+class BackgroundMailer(object):
+    """Hands messages to another mailer from background threads.
+
+    `send` and `send_raw` return as soon as the message is queued in memory,
+    so that e.g. a `DirectMailDelivery` does not hold up the end of a
+    transaction for the SMTP session.  Messages are encoded before they are
+    queued, so later changes to a `Message` do not affect what is sent.
+
+    At most `queue_size` messages wait to be sent.  When the queue is full,
+    callers wait for room; if there is still none after `timeout` seconds
+    (`None` waits as long as it takes) the caller sends the message itself.
+
+    Failures are passed to `on_error(fromaddr, toaddrs, message, exc_info)`,
+    with `message` as bytes; by default they are logged.  Messages still
+    queued when the process exits are lost: call `flush` or `close` on
+    shutdown.
+    """
+    log = logging.getLogger('repoze.sendmail.BackgroundMailer')
+
+    def __init__(self, mailer, workers=1, queue_size=100, timeout=None,
+                 on_error=None):
+        if workers < 1:
+            raise ValueError('Need at least one worker')
+        self.mailer = mailer
+        self.workers = workers
+        self.timeout = timeout
+        if on_error is not None:
+            self.on_error = on_error
+        self._queue = Queue(queue_size)
+        self._threads = []
+        self._unfinished = 0
+        self._cond = threading.Condition()
+        self._closed = False
+
+    def send(self, fromaddr, toaddrs, message):
+        if not isinstance(message, Message):
+            raise ValueError(
+               'Message must be instance of email.message.Message')
+        self.send_raw(fromaddr, toaddrs, encode_message(message))
+
+    def send_raw(self, fromaddr, toaddrs, message):
+        message = _read_raw(message)
+        self._cond.acquire()
+        try:
+            if self._closed:
+                raise RuntimeError('BackgroundMailer is closed')
+            self._start()
+            self._unfinished += 1
+        finally:
+            self._cond.release()
+        item = (fromaddr, toaddrs, message)
+        try:
+            self._queue.put(item, True, self.timeout)
+        except Full:
+            # Let the caller take the load rather than dropping the message.
+            try:
+                self._deliver(item)
+            finally:
+                self._task_done()
+
+    def _start(self):
+        # Called with the lock held.  Threads are only started once there is
+        # something to send.
+        while len(self._threads) < self.workers:
+            thread = threading.Thread(
+                target=self._worker,
+                name='BackgroundMailer-%d' % len(self._threads))
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def _worker(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            try:
+                self._deliver(item)
+            finally:
+                self._task_done()
+
+    def _deliver(self, item):
+        fromaddr, toaddrs, message = item
+        try:
+            self.mailer.send_raw(fromaddr, toaddrs, message)
+        except Exception:
+            try:
+                self.on_error(fromaddr, toaddrs, message, sys.exc_info())
+            except Exception:
+                self.log.exception('Error while handling a failed message.')
+
+    def _task_done(self):
+        self._cond.acquire()
+        try:
+            self._unfinished -= 1
+            if not self._unfinished:
+                self._cond.notify_all()
+        finally:
+            self._cond.release()
+
+    def on_error(self, fromaddr, toaddrs, message, exc_info):
+        self.log.error('Error while sending mail from %s to %s.',
+                       fromaddr, ', '.join(toaddrs), exc_info=exc_info)
+
+    def flush(self, timeout=None):
+        """Wait until all queued messages have been sent.
+
+        Returns False if messages are still pending after `timeout` seconds.
+        """
+        if timeout is not None:
+            deadline = time.time() + timeout
+        self._cond.acquire()
+        try:
+            while self._unfinished:
+                if timeout is None:
+                    self._cond.wait()
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return False
+                    self._cond.wait(remaining)
+            return True
+        finally:
+            self._cond.release()
+
+    def close(self, timeout=None):
+        """Send the queued messages, stop the threads and close the mailer.
+
+        Returns False if messages were still pending after `timeout` seconds;
+        they are then left to the (daemon) threads.
+        """
+        self._cond.acquire()
+        try:
+            self._closed = True
+            threads, self._threads = self._threads, []
+        finally:
+            self._cond.release()
+        if not self.flush(timeout):
+            return False
+        for thread in threads:
+            self._queue.put(None)
+        for thread in threads:
+            thread.join()
+        close = getattr(self.mailer, 'close', None)
+        if close is not None:
+            close()
+        return True
 
 
 @implementer(IMailer)
@@ -168,7 +1113,24 @@ class SendmailMailer(object):
         if not isinstance(message, Message):
             raise ValueError(
                'Message must be instance of email.message.Message')
-        message = encode_message(message)
+        # Cleaned up first, so that a message which cannot be encoded
+        # fails before sendmail is run, then encoded straight into the pipe.
+        if not is_cleaned(message):
+            cleanup_message(message)
+        self._sendmail(fromaddr, toaddrs,
+                       lambda stdin: _write_cleaned_message(message, stdin))
+
+    def send_raw(self, fromaddr=None, toaddrs=None, message=None):
+        if getattr(message, 'read', None) is not None:
+            self._sendmail(fromaddr, toaddrs,
+                           lambda stdin: shutil.copyfileobj(message, stdin,
+                                                            CHUNK_SIZE))
+            return
+        message = _read_raw(message)
+        self._sendmail(fromaddr, toaddrs, lambda stdin: stdin.write(message))
+
+    def _sendmail(self, fromaddr, toaddrs, write):
+        # Run sendmail, passing its stdin to `write`.
         if toaddrs is None:
             toaddrs = []
 
@@ -177,7 +1139,18 @@ class SendmailMailer(object):
                            recipients=toaddrs)
                 for arg in self.sendmail_template] + list(toaddrs)
         p = self._popen(args)
-        stdoutdata, stderrdata = p.communicate(message)
+        try:
+            try:
+                write(p.stdin)
+                p.stdin.close()
+            except EnvironmentError as e:
+                # sendmail exited early; its exit status tells why
+                if e.errno not in (errno.EPIPE, errno.EINVAL):
+                    raise
+        except:
+            _kill(p)
+            raise
+        p.wait()
         if p.returncode:
             raise subprocess.CalledProcessError(
                 "Could not excecute sendmail properly", args)
@@ -190,3 +1163,14 @@ class SendmailMailer(object):
         """
         kw['stdin'] = subprocess.PIPE
         return subprocess.Popen(*args, **kw) 
+
+
+def _kill(p):
+    # Kill sendmail before it reads the end of its input, so that it does
+    # not send what it got of the message.
+    p.kill()
+    p.wait()
+    try:
+        p.stdin.close()
+    except EnvironmentError:
+        pass
@@ -0,0 +1,385 @@
+##############################################################################
+#
+# Copyright (c) 2003 Zope Corporation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""
+Delivery straight to the mail exchangers (MX) of the recipients' domains.
+"""
+import random
+import threading
+import time
+from collections import OrderedDict
+from email.message import Message
+from smtplib import SMTPException
+from smtplib import SMTPRecipientsRefused
+from smtplib import SMTPResponseException
+
+try:
+    import dns.resolver
+except ImportError:  # pragma NO COVER
+    HAVE_DNS = False
+else:  # pragma NO COVER
+    HAVE_DNS = True
+
+from zope.interface import implementer
+from repoze.sendmail.encoding import encode_message
+from repoze.sendmail.interfaces import IMailer
+from repoze.sendmail.mailer import SMTPMailer
+from repoze.sendmail.mailer import _read_raw
+from repoze.sendmail._compat import SSLError
+
+
+class MXLookupError(Exception):
+    """The mail exchangers of a domain could not be found.
+
+    `permanent` is true if the domain does not exist, and false for errors
+    which may go away, such as a DNS server not answering.
+    """
+    def __init__(self, domain, permanent, reason=''):
+        Exception.__init__(self, domain, permanent, reason)
+        self.domain = domain
+        self.permanent = permanent
+        self.reason = reason
+
+
+class DeferredRecipients(SMTPRecipientsRefused):
+    """The message was delivered to some recipients, but could not be
+    delivered to others for now.
+
+    `recipients` maps the recipients to try again later to the
+    ``(code, response)`` of their transient failure; `refused` maps those
+    refused permanently in the same way.
+    """
+    def __init__(self, recipients, refused=None):
+        SMTPRecipientsRefused.__init__(self, recipients)
+        if refused is None:
+            refused = {}
+        self.refused = refused
+
+
+def dns_resolver(domain):
+    """Look up the MX records of `domain` with dnspython.
+
+    Returns ``(ttl, records)`` where `records` is a list of
+    ``(preference, hostname)`` pairs, empty if the domain has no MX
+    records; the hostname of a null MX (RFC 7505) is ``'.'``.  Raises
+    `MXLookupError` if the lookup fails.
+
+    This is the interface expected of the `resolver` of `MXCache`.
+    """
+    if not HAVE_DNS:
+        raise RuntimeError('dnspython is needed to look up MX records')
+    resolve = getattr(dns.resolver, 'resolve', None)
+    if resolve is None:  # pragma NO COVER dnspython < 2.0
+        resolve = dns.resolver.query
+    try:
+        answer = resolve(domain, 'MX')
+    except dns.resolver.NXDOMAIN:
+        raise MXLookupError(domain, True, 'No such domain')
+    except dns.resolver.NoAnswer:
+        return None, []
+    except dns.exception.DNSException as e:
+        raise MXLookupError(domain, False, str(e))
+    records = [(rr.preference, rr.exchange.to_text(omit_final_dot=True))
+               for rr in answer]
+    return answer.rrset.ttl, records
+
+
+class MXCache(object):
+    """Caches the mail exchangers of domains for as long as DNS allows.
+
+    `resolver` is a callable with the interface of `dns_resolver`, which is
+    the default; pass another one to look up domains some other way, e.g.
+    in tests.  Answers are kept for their TTL, capped at `max_ttl` seconds.
+    Domains which do not exist, or which the resolver gives no TTL for, are
+    remembered for `negative_ttl` seconds; lookups which failed for some
+    other reason for `error_ttl` seconds.
+    """
+    def __init__(self, resolver=dns_resolver, negative_ttl=300,
+                 error_ttl=30, max_ttl=86400):
+        self.resolver = resolver
+        self.negative_ttl = negative_ttl
+        self.error_ttl = error_ttl
+        self.max_ttl = max_ttl
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def lookup(self, domain):
+        """Return the hosts to deliver to for `domain`, in order of
+        preference.
+
+        Hosts of equal preference are shuffled, to spread the load between
+        them.  A domain without MX records is its own mail exchanger.
+        Raises `MXLookupError` if the domain cannot be delivered to, for
+        good if it does not exist or has a null MX record.
+        """
+        domain = domain.lower()
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(domain)
+        if entry is None or entry[0] <= now:
+            entry = self._resolve(domain, now)
+            with self._lock:
+                self._entries[domain] = entry
+        expires, records, error = entry
+        if error is not None:
+            raise error
+        records = [(preference, random.random(), host)
+                   for preference, host in records]
+        records.sort()
+        return [host for preference, rand, host in records]
+
+    def _resolve(self, domain, now):
+        try:
+            ttl, records = self.resolver(domain)
+        except MXLookupError as e:
+            if e.permanent:
+                return now + self.negative_ttl, None, e
+            return now + self.error_ttl, None, e
+        if any(host in ('', '.') for preference, host in records):
+            # RFC 7505: a null MX says that the domain accepts no mail.
+            return now + self.negative_ttl, None, MXLookupError(
+                domain, True, 'Domain accepts no mail (null MX)')
+        if not records:
+            # RFC 5321, section 5.1: the domain is its own mail exchanger.
+            records = [(0, domain)]
+        if ttl is None:
+            ttl = self.negative_ttl
+        return now + min(ttl, self.max_ttl), records, None
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+def _permanent(error):
+    if isinstance(error, MXLookupError):
+        return error.permanent
+    if isinstance(error, SMTPRecipientsRefused):
+        codes = [code for code, resp in error.recipients.values()]
+        return bool(codes) and all(500 <= code <= 599 for code in codes)
+    code = getattr(error, 'smtp_code', None)
+    return code is not None and 500 <= code <= 599
+
+
+@implementer(IMailer)
+class MXMailer(object):
+    """Delivers messages straight to the mail exchangers of the recipients.
+
+    Recipients are grouped by domain and each group is sent to the
+    preferred MX host of its domain, falling back to the other MX hosts if
+    a host cannot be reached or answers with a transient error.  MX
+    records are looked up through `cache` (by default an `MXCache` using
+    `resolver`).
+
+    Connections are kept open and reused per MX host: each host gets an
+    `SMTPMailer` with a pool of `pool_size` connections; other keyword
+    arguments (``no_tls``, ``force_tls``, ``pool_idle_timeout`` etc.) are
+    passed on to these mailers.  The mailers of at most `max_hosts` hosts
+    are kept; beyond that those of the least recently used hosts are
+    closed and dropped.  Every `sweep_interval` seconds the idle
+    connections of all hosts which have expired are closed.  `port` is the
+    port to connect to, which together with a stub resolver allows local
+    SMTP servers to stand in for remote hosts.
+
+    As with `smtplib.SMTP.sendmail`, recipients which are refused
+    permanently while others are accepted are not raised but returned as a
+    dictionary from recipient to ``(code, response)``.  If no recipient is
+    accepted the error of a domain which failed is raised, preferring a
+    transient one, so that the message is tried again later.  If the
+    message was delivered to some recipients but failed for others only
+    for now (a 4xx reply, or no connection), `DeferredRecipients` is
+    raised, so that it is tried again for those recipients alone.
+    """
+    smtp = SMTPMailer.smtp  # allow replacement for testing.
+    sweep_interval = 10
+
+    def __init__(self, resolver=dns_resolver, port=25, pool_size=2,
+                 cache=None, max_hosts=100, **options):
+        if cache is None:
+            cache = MXCache(resolver)
+        self.cache = cache
+        self.port = port
+        self.pool_size = pool_size
+        self.max_hosts = max_hosts
+        self.options = options
+        self._mailers = OrderedDict()
+        self._swept = time.time()
+        self._lock = threading.Lock()
+
+    def _mailer(self, host):
+        now = time.time()
+        with self._lock:
+            mailer = self._mailers.pop(host, None)
+            if mailer is None:
+                mailer = SMTPMailer(host, self.port,
+                                    pool_size=self.pool_size,
+                                    **self.options)
+                mailer.smtp = self.smtp
+            # Most recently used last.
+            self._mailers[host] = mailer
+            excess = len(self._mailers) - self.max_hosts
+            dropped = []
+            if excess > 0:
+                # Hosts with connections in use are kept until released.
+                dropped = [other for other, m in self._mailers.items()
+                           if other != host and not _leased(m)][:excess]
+                dropped = [self._mailers.pop(other) for other in dropped]
+            pools = []
+            if now - self._swept >= self.sweep_interval:
+                self._swept = now
+                pools = [m.pool for m in self._mailers.values()
+                         if m.pool is not None]
+        for other in dropped:
+            other.close()
+        for pool in pools:
+            pool.sweep()
+        return mailer
+
+    def send(self, fromaddr, toaddrs, message):
+        if not isinstance(message, Message):
+            raise ValueError(
+               'Message must be instance of email.message.Message')
+        return self.send_raw(fromaddr, toaddrs, encode_message(message))
+
+    def send_raw(self, fromaddr, toaddrs, message):
+        with self.session() as session:
+            return session.send_raw(fromaddr, toaddrs, message)
+
+    def session(self):
+        """Return an `MXSession`, which keeps one connection per MX host
+        open for the messages sent through it.
+        """
+        return MXSession(self)
+
+    def destination(self, toaddrs):
+        """Return the domains of `toaddrs`, where messages to them go."""
+        return tuple(sorted(set(domain for domain, recipients
+                                in _by_domain(toaddrs))))
+
+    def close(self):
+        """Close the connections to all hosts."""
+        with self._lock:
+            mailers, self._mailers = self._mailers, OrderedDict()
+        for mailer in mailers.values():
+            mailer.close()
+
+
+class MXSession(object):
+    """Sends several messages back-to-back over one connection per MX host.
+
+    Use it as a context manager, like `repoze.sendmail.mailer.SMTPSession`;
+    the connections are closed on exit.  If the mailer pools connections,
+    each one is instead returned to its pool as soon as the recipients of
+    its domain are sent to: holding it while waiting for a connection to
+    another host could deadlock with a session doing the reverse.
+    """
+    def __init__(self, mailer):
+        self.mailer = mailer
+        self._sessions = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+
+    def send(self, fromaddr, toaddrs, message):
+        if not isinstance(message, Message):
+            raise ValueError(
+               'Message must be instance of email.message.Message')
+        return self.send_raw(fromaddr, toaddrs, encode_message(message))
+
+    def send_raw(self, fromaddr, toaddrs, message):
+        message = _read_raw(message)
+        refused = {}
+        deferred = {}
+        errors = []
+        delivered = False
+        for domain, recipients in _by_domain(toaddrs):
+            try:
+                replies = self._deliver(domain, fromaddr, recipients,
+                                        message)
+            except (SMTPException, SSLError, EnvironmentError,
+                    MXLookupError) as e:
+                errors.append(e)
+                replies = dict((recipient, _reply(e))
+                               for recipient in recipients)
+            else:
+                delivered = True
+            for recipient, (code, resp) in replies.items():
+                if 500 <= code <= 599:
+                    refused[recipient] = code, resp
+                else:
+                    deferred[recipient] = code, resp
+        if not delivered and errors:
+            transient = [e for e in errors if not _permanent(e)]
+            raise (transient or errors)[0]
+        if deferred:
+            raise DeferredRecipients(deferred, refused)
+        return refused
+
+    def _session(self, host):
+        session = self._sessions.get(host)
+        if session is None:
+            session = self.mailer._mailer(host).session()
+            self._sessions[host] = session
+        return session
+
+    def _deliver(self, domain, fromaddr, recipients, message):
+        hosts = self.mailer.cache.lookup(domain)
+        for i, host in enumerate(hosts):
+            try:
+                return self._send(host, fromaddr, recipients, message)
+            except (SMTPException, SSLError, EnvironmentError) as e:
+                if _permanent(e) or i == len(hosts) - 1:
+                    raise
+                # try the next mail exchanger
+
+    def _send(self, host, fromaddr, recipients, message):
+        if self.mailer.pool_size:
+            with self.mailer._mailer(host).session() as session:
+                return session.send_raw(fromaddr, recipients, message) or {}
+        return self._session(host).send_raw(fromaddr, recipients,
+                                            message) or {}
+
+    def close(self):
+        sessions, self._sessions = self._sessions, {}
+        for session in sessions.values():
+            session.close()
+
+
+def _leased(mailer):
+    return mailer.pool is not None and mailer.pool.leased
+
+
+def _by_domain(toaddrs):
+    # Group recipients by domain, keeping their order.
+    groups = []
+    index = {}
+    for addr in toaddrs:
+        domain = addr.rsplit('@', 1)[-1].strip().rstrip('>').lower()
+        if domain not in index:
+            index[domain] = []
+            groups.append((domain, index[domain]))
+        index[domain].append(addr)
+    return groups
+
+
+def _reply(error):
+    if isinstance(error, SMTPResponseException):
+        return error.smtp_code, error.smtp_error
+    if isinstance(error, SMTPRecipientsRefused) and error.recipients:
+        return list(error.recipients.values())[0]
+    if isinstance(error, MXLookupError):
+        return (550 if error.permanent else 451), error.reason
+    return 451, str(error)
@@ -2,17 +2,31 @@ from __future__ import with_statement
 import errno
 import logging
 import os
+import random
+import select
+import shutil
+import signal
 import smtplib
+import socket
 import stat
 import sys
+import threading
 import time
+import zlib
 
-from email.parser import Parser
 from email import header
 
+from repoze.sendmail.encoding import mark_cleaned
+from repoze.sendmail.maildir import ORDERS
 from repoze.sendmail.maildir import Maildir
+from repoze.sendmail.mailer import RELAY_STRATEGIES
 from repoze.sendmail.mailer import SMTPMailer
+from repoze.sendmail.mailer import parse_relays
+from repoze.sendmail.mx import DeferredRecipients
+from repoze.sendmail.ratelimit import RateLimiter
+from repoze.sendmail._compat import BytesParser
 from repoze.sendmail._compat import ConfigParser
+from repoze.sendmail._compat import Queue
 
 if sys.platform == 'win32': #pragma NO COVERAGE
     import win32file
@@ -20,6 +34,28 @@ if sys.platform == 'win32': #pragma NO COVERAGE
 else:
     _os_link = os.link
 
+try:
+    import fcntl
+except ImportError: #pragma NO COVER
+    HAVE_FLOCK = False
+else:
+    HAVE_FLOCK = hasattr(fcntl, 'flock')
+
+try:
+    import ctypes
+    import ctypes.util
+    _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    _inotify_init1 = _libc.inotify_init1
+    _inotify_add_watch = _libc.inotify_add_watch
+except (ImportError, OSError, AttributeError, TypeError): #pragma NO COVER
+    HAVE_INOTIFY = False
+else: #pragma NO COVER
+    HAVE_INOTIFY = True
+
+# From <sys/inotify.h>
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+
 def _log_error(msg): #pragma NO COVER
     sys.stderr.write(msg)
 
@@ -82,6 +118,22 @@ def _log_error(msg): #pragma NO COVER
 # messages sent.
 MAX_SEND_TIME = 60*60*3
 
+# Headers which carry the envelope in queue files, stripped before sending.
+ENVELOPE_HEADERS = (b'x-actually-from', b'x-actually-to',
+                    b'x-actually-cleaned')
+
+def _unfold(lines):
+    value = b''.join(lines).decode('utf-8')
+    return ' '.join(line.strip() for line in value.splitlines())
+
+def _decode_envelope(value, name):
+    decoded = header.decode_header(value)
+    assert len(decoded) == 1, '%s header has multiple parts.' % name
+    encoded, charset = decoded[0]
+    if charset is not None:
+        value = encoded.decode(charset)
+    return value
+
 def boolean(s):
     s = str(s).lower()
     return s.startswith("t") or s.startswith("y") or s.startswith("1")
@@ -91,172 +143,811 @@ def string_or_none(s):
         return None
     return s
 
+def float_or_none(s):
+    s = string_or_none(s)
+    if s is None:
+        return None
+    return float(s)
+
+def order_or_none(s):
+    # ``none`` stands for directory order.
+    if s.lower() == 'none':
+        return None
+    return s
+
+SCHEDULES = ('mtime', 'domain')
+
+CLAIMS = ('link', 'rename', 'flock')
+
+# Separates the retry information from the unique part of the name of a
+# queued message, as in the "info" part of Maildir names.
+if sys.platform == 'win32': #pragma NO COVERAGE
+    RETRY_SEP = ';'
+else:
+    RETRY_SEP = ':'
+
+def retry_info(filename):
+    """Return ``(attempts, due, since)`` for a queued message.
+
+    These are the number of failed attempts to send it, the time at which
+    to try again and the time it was queued (or first failed); all zero
+    for a message not tried yet.  Only the name of the file is looked at.
+    """
+    name = os.path.basename(filename)
+    unique, sep, info = name.rpartition(RETRY_SEP)
+    if sep and info.startswith('R'):
+        try:
+            attempts, due, since = info[1:].split('.')
+            return int(attempts), int(due), int(since)
+        except ValueError:
+            pass
+    return 0, 0, 0
+
+def parse_shard(value):
+    """Parse a shard given as ``"i/N"`` (the i-th of N, counting from 1)
+    into ``(i, N)``.
+    """
+    try:
+        index, count = [int(part) for part in value.split('/')]
+    except ValueError:
+        raise ValueError('Invalid shard: %r' % (value,))
+    if not 1 <= index <= count:
+        raise ValueError('Invalid shard: %r' % (value,))
+    return index, count
+
+def shard_of(filename, count):
+    """Return which of `count` shards (counting from 1) a queued message
+    belongs to, going by the unique part of its name.
+    """
+    unique = os.path.basename(filename).split(RETRY_SEP, 1)[0]
+    return (zlib.crc32(unique.encode('utf-8')) & 0xffffffff) % count + 1
+
+class RetryPolicy(object):
+    """Decides when messages which failed to send are tried again.
+
+    After the n-th failed attempt a message waits ``initial * factor **
+    (n - 1)`` seconds, at most `maximum`, give or take a random `jitter`
+    fraction of that, so that messages which failed together are not all
+    retried at once.  Messages which have been queued for longer than
+    `max_age` seconds, or failed `max_attempts` times, are moved to the
+    `dead_letter` directory (by default ``dead`` in the queue) instead.
+    """
+    def __init__(self, initial=60, factor=2, maximum=3600, jitter=0.1,
+                 max_age=5*24*3600, max_attempts=None, dead_letter=None):
+        self.initial = initial
+        self.factor = factor
+        self.maximum = maximum
+        self.jitter = jitter
+        self.max_age = max_age
+        self.max_attempts = max_attempts
+        self.dead_letter = dead_letter
+
+    def delay(self, attempts):
+        """Seconds to wait after the `attempts`-th failure."""
+        delay = min(self.initial * self.factor ** (attempts - 1),
+                    self.maximum)
+        return delay * (1 + random.uniform(-self.jitter, self.jitter))
+
+    def expired(self, attempts, since, now):
+        """Whether to give up on a message after `attempts` failures."""
+        if self.max_attempts is not None and attempts >= self.max_attempts:
+            return True
+        return self.max_age is not None and now - since > self.max_age
+
+
 class QueueProcessor(object):
+    """Sends the messages in a queue.
+
+    With the default `schedule`, ``'mtime'``, messages are sent one by one
+    in the order of the queue.  With ``'domain'``, the messages are first
+    grouped by destination and each group is sent back-to-back over one SMTP
+    session, if the mailer provides ``session``.  The destination is what
+    the mailer's ``destination(toaddrs)`` returns if it has such a method,
+    otherwise the recipients' domains.  Mailers which send everything to
+    the same place say so with a true ``fixed_destination``; their messages
+    are grouped without reading them.  Groups take turns, at most
+    `session_limit` messages at a time, so that a busy destination does not
+    hold up the others.
+
+    `rate_limit` is an optional `repoze.sendmail.ratelimit.RateLimiter`
+    which messages wait for before they are handed to the mailer.
+
+    Without a `retry` policy, messages which fail to send for any reason
+    but a permanent (5xx) refusal are tried again on every pass.  With a
+    `RetryPolicy` they are renamed to record the attempt and skipped, by
+    name alone, until they are due again, and are eventually given up on.
+
+    `claim` is how a message is claimed, so that no two processes or
+    workers send it:
+
+    ``'link'``
+        a ``.sending-`` hard link is made next to the message (the
+        default).  This takes six or more file system operations per
+        message.
+
+    ``'rename'``
+        the message is renamed into a ``.sending-`` directory of the
+        worker's own in ``cur``, which takes two.  Messages left there by a
+        worker which died are put back after `MAX_SEND_TIME`.
+
+    ``'flock'``
+        the message file is locked with ``flock``, which the system
+        releases if the process dies.  Only for local file systems.
+
+    With ``'rename'`` and ``'flock'``, messages which failed to send are
+    released at once; a ``'link'`` claim is kept for `MAX_SEND_TIME`.
+
+    Processors on several hosts can share a queue by each taking a `shard`,
+    ``(i, N)``: only messages whose names hash to the i-th of N shards are
+    looked at.  Each processor renews a lease on its shard on every pass;
+    the shards of processors whose lease is more than `lease_timeout`
+    seconds old are taken over until they come back.
+
+    `order` is the order in which the queue is listed, as for
+    `repoze.sendmail.maildir.Maildir`.
+    """
     log = logging.getLogger("QueueProcessor")
 
-    def __init__(self, mailer, queue_path, Maildir=Maildir, ignore_transient=False):
+    def __init__(self, mailer, queue_path, Maildir=Maildir, ignore_transient=False,
+                 workers=1, schedule='mtime', session_limit=100,
+                 rate_limit=None, retry=None, claim='link', shard=None,
+                 lease_timeout=300, order='mtime'):
+        if schedule not in SCHEDULES:
+            raise ValueError('Unknown schedule: %r' % (schedule,))
+        if claim not in CLAIMS:
+            raise ValueError('Unknown claim: %r' % (claim,))
+        if claim == 'flock' and not HAVE_FLOCK: #pragma NO COVER
+            raise ValueError('flock is not available')
         self.mailer = mailer
-        self.maildir = Maildir(queue_path, create=True)
+        self.maildir = Maildir(queue_path, create=True, order=order)
         self.ignore_transient = ignore_transient
+        self.workers = workers
+        self.schedule = schedule
+        self.session_limit = session_limit
+        self.rate_limit = rate_limit
+        self.retry = retry
+        self.claim = claim
+        self.shard = shard
+        self.lease_timeout = lease_timeout
+        self._stopped = threading.Event()
+        if shard is not None:
+            self._started = time.time()
+            self._shards = set([shard[0]])
+            self.maildir.filter = self._in_shards
 
     def send_messages(self):
-        for filename in self.maildir:
-            self._send_message(filename)
+        if self.claim == 'rename':
+            self._recover()
+        if self.shard is not None:
+            self._select_shards()
+        if self.schedule == 'domain':
+            items = self._batches()
+        else:
+            items = self._pending()
+        if self.workers > 1:
+            self._send_messages_concurrently(items)
+            return
+        for item in items:
+            if self._stopped.is_set():
+                break
+            self._send_item(item)
+
+    def stop(self):
+        """Ask a running ``send_messages`` to return.
+
+        Messages which are already being sent are finished; no new ones
+        are started.  May be called from any thread.
+        """
+        self._stopped.set()
+
+    def _send_messages_concurrently(self, items):
+        # The maildir is walked in this thread and the filenames (or
+        # batches of them) are handed to the workers through a small bounded
+        # queue, so that a large backlog is not held in memory.  The claim
+        # protocol in ``_send_message`` keeps two workers from sending the
+        # same file.
+        pending = Queue(self.workers * 2)
+        threads = []
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._worker, args=(pending,),
+                                      name='QueueProcessor-%d' % i)
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        try:
+            for item in items:
+                if self._stopped.is_set():
+                    break
+                pending.put(item)
+        finally:
+            for thread in threads:
+                pending.put(None)
+            for thread in threads:
+                thread.join()
+
+    def _worker(self, pending):
+        while True:
+            item = pending.get()
+            if item is None:
+                return
+            if not self._stopped.is_set():
+                self._send_item(item)
+
+    def _lease(self, index):
+        return os.path.join(self.maildir.path, 'shards',
+                            '%d-of-%d' % (index, self.shard[1]))
+
+    def _renew_lease(self, now):
+        lease = self._lease(self.shard[0])
+        try:
+            os.utime(lease, None)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            try:
+                os.mkdir(os.path.dirname(lease))
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+            open(lease, 'a').close()
+        self._renewed = now
+
+    def _select_shards(self):
+        """Renew the lease on our shard and choose the shards to send.
+
+        Shards whose lease has run out are taken over; a shard which never
+        had a lease counts as run out once we have been running for
+        `lease_timeout` seconds.
+        """
+        now = time.time()
+        self._renew_lease(now)
+        index, count = self.shard
+        shards = set([index])
+        for other in range(1, count + 1):
+            if other == index:
+                continue
+            try:
+                renewed = os.stat(self._lease(other)).st_mtime
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+                renewed = self._started
+            if now - renewed > self.lease_timeout:
+                shards.add(other)
+        taken = sorted(shards - self._shards)
+        if taken:
+            self.log.info("Taking over shards %s of %d.",
+                          ", ".join(str(i) for i in taken), count)
+        self._shards = shards
+
+    def _in_shards(self, filename):
+        # The filter of the maildir when sharding; keeps the lease fresh
+        # while a large queue is listed.
+        self._keep_lease()
+        return shard_of(filename, self.shard[1]) in self._shards
+
+    def _keep_lease(self):
+        # Renew the lease if it is getting old, during long passes.
+        now = time.time()
+        if now - self._renewed > self.lease_timeout / 3.0:
+            self._renew_lease(now)
+
+    def _pending(self):
+        # The queued messages which are due to be sent.
+        if self.retry is None:
+            return iter(self.maildir)
+        now = time.time()
+        return (filename for filename in self.maildir
+                if retry_info(filename)[1] <= now)
+
+    def _send_item(self, item):
+        if isinstance(item, list):
+            self._send_batch(item)
+        else:
+            self._send_message(item)
+
+    def _batches(self):
+        """Group the queued messages by destination and return lists of
+        at most `session_limit` filenames, taking turns between the groups.
+        """
+        groups = {}
+        order = []
+        fixed = getattr(self.mailer, 'fixed_destination', False)
+        for filename in self._pending():
+            if self._stopped.is_set():
+                return []
+            if fixed:
+                key = None
+            else:
+                key = self._destination(filename)
+            if key not in groups:
+                groups[key] = []
+                order.append(key)
+            groups[key].append(filename)
+        limit = max(self.session_limit, 1)
+        batches = []
+        start = 0
+        while order:
+            remaining = []
+            for key in order:
+                batch = groups[key][start:start + limit]
+                if batch:
+                    batches.append(batch)
+                if len(groups[key]) > start + limit:
+                    remaining.append(key)
+            order = remaining
+            start += limit
+        return batches
+
+    def _destination(self, filename):
+        try:
+            with open(filename, 'rb') as f:
+                fromaddr, toaddrs, message = self._readMessage(f, body=False)
+        except EnvironmentError:
+            # Gone or unreadable; ``_send_message`` will deal with it.
+            return None
+        destination = getattr(self.mailer, 'destination', None)
+        if destination is not None:
+            return destination(toaddrs)
+        return tuple(sorted(set(
+            addr.rsplit('@', 1)[-1].lower() for addr in toaddrs)))
+
+    def _send_batch(self, filenames):
+        session = getattr(self.mailer, 'session', None)
+        if session is None:
+            for filename in filenames:
+                if self._stopped.is_set():
+                    break
+                self._send_message(filename)
+            return
+        try:
+            with session() as sender:
+                for filename in filenames:
+                    if self._stopped.is_set():
+                        break
+                    self._send_message(filename, sender)
+        except Exception:
+            # Closing the session failed; the messages are already sent.
+            self.log.error("Error while closing SMTP session.", exc_info=True)
 
     def _parseMessage(self, fp):
         """
-        Extract fromaddr and toaddrs from the X-Actually-{To,From} headers.
-        Returns message string which has those headers stripped.
+        Extract fromaddr and toaddrs from the X-Actually-{To,From} headers
+        of the message in binary file `fp`.
+        Returns message string which has those headers stripped.  The
+        message is marked as clean if the queue file says so
+        (X-Actually-Cleaned), so that mailers do not clean it up again.
         """
-        parser = Parser()
+        parser = BytesParser()
         message = parser.parse(fp)
 
         fromaddr = message['X-Actually-From']
         if fromaddr is not None:
-            decoded_fromaddr = header.decode_header(fromaddr)
-            assert len(decoded_fromaddr) == 1, 'From header has multiple parts.'
-            encoded_fromaddr, charset = decoded_fromaddr[0]
-            if charset is not None:
-                fromaddr = encoded_fromaddr.decode(charset)
+            fromaddr = _decode_envelope(fromaddr, 'From')
         else:
             fromaddr = ''
         del message['X-Actually-From']
 
         toaddrs = message['X-Actually-To']
         if toaddrs is not None:
-            decoded_toaddrs = header.decode_header(toaddrs)
-            assert len(decoded_toaddrs) == 1, 'To header has multiple parts.'
-            encoded_toaddrs, charset = decoded_toaddrs[0]
-            if charset is not None:
-                toaddrs = encoded_toaddrs.decode(charset)
+            toaddrs = _decode_envelope(toaddrs, 'To')
             toaddrs = tuple(a.strip() for a in toaddrs.split(','))
         else:
             toaddrs = ()
         del message['X-Actually-To']
 
+        if message['X-Actually-Cleaned'] is not None:
+            del message['X-Actually-Cleaned']
+            mark_cleaned(message)
+
         return fromaddr, toaddrs, message
 
-    def _send_message(self, filename):
-        fromaddr = ''
-        toaddrs = ()
-        head, tail = os.path.split(filename)
-        tmp_filename = os.path.join(head, '.sending-' + tail)
-        rejected_filename = os.path.join(head, '.rejected-' + tail)
-        try:
-            # perform a series of operations in an attempt to ensure
-            # that no two threads/processes send this message
-            # simultaneously as well as attempting to not generate
-            # spurious failure messages in the log; a diagram that
-            # represents these operations is included in a
-            # comment above this class
-            try:
-                # find the age of the tmp file (if it exists)
-                mtime = os.stat(tmp_filename)[stat.ST_MTIME]
-            except OSError as e:
-                if e.errno == errno.ENOENT: # file does not exist
-                    # the tmp file could not be stated because it
-                    # doesn't exist, that's fine, keep going
-                    age = None
-                else: #pragma NO COVER
-                    # the tmp file could not be stated for some reason
-                    # other than not existing; we'll report the error
-                    raise
+    def _readMessage(self, fp, body=True):
+        """
+        Like `_parseMessage`, but read only the header block of the message
+        in binary file `fp`.  Returns the bytes of the message, which has
+        those headers stripped and is otherwise unchanged.  If `body` is
+        false, only the header block is read and returned.
+        """
+        kept = []
+        envelope = {}
+        name = None
+        while True:
+            line = fp.readline()
+            if line.strip(b'\r\n') == b'':
+                # end of the headers (or of the file)
+                break
+            if line[:1] in (b' ', b'\t'):
+                # continuation of a folded header
+                if name in envelope:
+                    envelope[name].append(line)
+                else:
+                    kept.append(line)
+                continue
+            name = line.split(b':', 1)[0].strip().lower()
+            if name in ENVELOPE_HEADERS:
+                envelope[name] = [line.split(b':', 1)[1]]
             else:
-                age = time.time() - mtime
+                kept.append(line)
+        kept.append(line)
+        if body:
+            kept.append(fp.read())
 
-            # if the tmp file exists, check it's age
-            if age is not None:
-                try:
-                    if age > MAX_SEND_TIME:
-                        # the tmp file is "too old"; this suggests
-                        # that during an attemt to send it, the
-                        # process died; remove the tmp file so we
-                        # can try again
-                        os.remove(tmp_filename)
-                    else:
-                        # the tmp file is "new", so someone else may
-                        # be sending this message, try again later
-                        return
-                    # if we get here, the file existed, but was too
-                    # old, so it was unlinked
-                except OSError as e: #pragma NO COVER
-                    if e.errno == errno.ENOENT: # file does not exist
-                        # it looks like someone else removed the tmp
-                        # file, that's fine, we'll try to deliver the
-                        # message again later
-                        return
+        fromaddr = envelope.get(b'x-actually-from')
+        if fromaddr is not None:
+            fromaddr = _decode_envelope(_unfold(fromaddr), 'From')
+        else:
+            fromaddr = ''
 
-            # now we know that the tmp file doesn't exist, we need to
-            # "touch" the message before we create the tmp file so the
-            # mtime will reflect the fact that the file is being
-            # processed (there is a race here, but it's OK for two or
-            # more processes to touch the file "simultaneously")
-            try:
-                os.utime(filename, None)
-            except OSError as e: #pragma NO COVER
-                if e.errno == errno.ENOENT: # file does not exist
-                    # someone removed the message before we could
-                    # touch it, no need to complain, we'll just keep
-                    # going
-                    return
-                else:
-                    # Some other error, propogate it
-                    raise
+        toaddrs = envelope.get(b'x-actually-to')
+        if toaddrs is not None:
+            toaddrs = _decode_envelope(_unfold(toaddrs), 'To')
+            toaddrs = tuple(a.strip() for a in toaddrs.split(','))
+        else:
+            toaddrs = ()
 
-            # creating this hard link will fail if another process is
-            # also sending this message
-            try:
-                _os_link(filename, tmp_filename)
-            except OSError as e: #pragma NO COVER
-                if e.errno == errno.EEXIST: # file exists, *nix
-                    # it looks like someone else is sending this
-                    # message too; we'll try again later
-                    return
-                else:
-                    # Some other error, propogate it
-                    raise
+        return fromaddr, toaddrs, b''.join(kept)
 
-            # FIXME: Need to test in Windows.  If
-            # test_concurrent_delivery passes, this stanza can be
-            # deleted.  Otherwise we probably need to catch
-            # WindowsError and check for corresponding error code.
-            #except error as e:
-            #    if e[0] == 183 and e[1] == 'CreateHardLink':
-            #        # file exists, win32
-            #        return
-
-            # read message file and send contents
-            with open(filename) as f:
-                fromaddr, toaddrs, message = self._parseMessage(f)
+    def _send_message(self, filename, sender=None):
+        # `sender` is the mailer, or a session of it
+        if sender is None:
+            sender = self.mailer
+        if self.shard is not None:
+            # sending may take longer than the lease
+            self._keep_lease()
+        fromaddr = ''
+        toaddrs = ()
+        claim = None
+        refused = None
+        try:
+            claim = self._claim(filename)
+            if claim is None:
+                return
+
+            # read message file and send contents; mailers which accept
+            # encoded messages get the file's bytes without a reparse
+            send = getattr(sender, 'send_raw', None)
+            if send is not None:
+                fromaddr, toaddrs, message = self._read_claimed(
+                    filename, claim)
+            else:
+                send = sender.send
+                fromaddr, toaddrs, message = self._read_claimed(
+                    filename, claim, parse=True)
             try:
-                self.mailer.send(fromaddr, toaddrs, message)
+                if self.rate_limit is None:
+                    refused = send(fromaddr, toaddrs, message)
+                else:
+                    refused = self.rate_limit.send(send, fromaddr, toaddrs,
+                                                   message)
+            except DeferredRecipients as e:
+                # sent to some recipients; keep it queued for the others
+                self._defer(filename, claim, fromaddr, toaddrs, e)
+                return
             except smtplib.SMTPResponseException as e:
                 if 500 <= e.smtp_code <= 599:
                     # permanent error, ditch the message
-                    self.log.error(
-                        "Discarding email from %s to %s due to"
-                        " a permanent error: %s",
-                        fromaddr, ", ".join(toaddrs), e.args)
-                    _os_link(filename, rejected_filename)
+                    self._reject(filename, fromaddr, toaddrs, e, claim)
                 else:
                     # Log an error and retry later
                     if self.ignore_transient:
+                        if self.retry is not None:
+                            self._retry_later(filename, claim,
+                                              fromaddr, toaddrs)
+                        else:
+                            self._release(filename, claim)
                         return
                     else:
                         raise
 
+            self._log_refused(fromaddr, refused)
+            self._finish(filename, claim, fromaddr, toaddrs)
+
+        # Catch errors and log them here
+        except:
+            self._log_failure(filename, fromaddr, toaddrs)
+            if claim is not None:
+                try:
+                    if self.retry is not None:
+                        self._retry_later(filename, claim, fromaddr,
+                                          toaddrs)
+                    else:
+                        self._release(filename, claim)
+                except:
+                    self._log_failure(filename, fromaddr, toaddrs)
+
+    def _claimed(self, filename, claim):
+        # Where the claimed message in `filename` is now.
+        if self.claim == 'rename':
+            return claim
+        return filename
+
+    def _read_claimed(self, filename, claim, parse=False):
+        """Read the claimed message in `filename` with `_readMessage`, or
+        with `_parseMessage` if `parse` is true.
+        """
+        read = self._parseMessage if parse else self._readMessage
+        if self.claim == 'flock':
+            # read through the locked file
+            claim.seek(0)
+            return read(claim)
+        with open(self._claimed(filename, claim), 'rb') as f:
+            return read(f)
+
+    def _retry_later(self, filename, claim, fromaddr, toaddrs):
+        """Record a failed attempt to send a message in its name, or move
+        it to the dead letter directory if it is not to be tried again.
+        """
+        retry = self.retry
+        now = time.time()
+        attempts, due, since = retry_info(filename)
+        attempts += 1
+        head, tail = os.path.split(filename)
+        unique = tail.rpartition(RETRY_SEP)[0] if since else tail
+        if not since:
+            # `Maildir.add` starts names with the time of queueing.
+            timestamp = unique.split('.', 1)[0]
+            since = int(timestamp) if timestamp.isdigit() else int(now)
+        if retry.expired(attempts, since, now):
+            dead_letter = retry.dead_letter
+            if dead_letter is None:
+                dead_letter = os.path.join(self.maildir.path, 'dead')
+            if not os.path.isdir(dead_letter):
+                try:
+                    os.makedirs(dead_letter)
+                except OSError as e: #pragma NO COVER
+                    if e.errno != errno.EEXIST:
+                        raise
+            os.rename(self._claimed(filename, claim),
+                      os.path.join(dead_letter, unique))
+            self.log.error(
+                "Giving up on email from %s to %s after %d attempts.",
+                fromaddr, ", ".join(toaddrs), attempts)
+        else:
+            due = int(now + retry.delay(attempts))
+            if os.path.basename(head) == 'new':
+                # Messages with info in their names belong in "cur".
+                head = os.path.join(os.path.dirname(head), 'cur')
+            os.rename(self._claimed(filename, claim), os.path.join(
+                head, '%s%sR%d.%d.%d' % (unique, RETRY_SEP, attempts, due,
+                                         since)))
+            self.log.info(
+                "Mail from %s to %s will be retried in %d seconds.",
+                fromaddr, ", ".join(toaddrs), due - now)
+        if self.claim == 'link':
+            os.remove(claim)
+        elif self.claim == 'flock':
+            claim.close()
+
+    def _defer(self, filename, claim, fromaddr, toaddrs, error):
+        """Keep a message, which was sent to some of its recipients, queued
+        for those it could not be sent to yet.
+        """
+        self._log_refused(fromaddr, error.refused)
+        deferred = [addr for addr in toaddrs if addr in error.recipients]
+        for addr in deferred:
+            code, resp = error.recipients[addr]
+            self.log.info("Mail from %s to %s deferred: %s %s",
+                          fromaddr, addr, code, resp)
+        _set_recipients(self._claimed(filename, claim), deferred)
+        if self.retry is not None:
+            self._retry_later(filename, claim, fromaddr, deferred)
+        else:
+            self._release(filename, claim)
+
+    def _log_refused(self, fromaddr, refused):
+        # Recipients which the server refused while accepting the others.
+        for addr, (code, resp) in sorted((refused or {}).items()):
+            self.log.error("Mail from %s to %s refused: %s %s",
+                           fromaddr, addr, code, resp)
+
+    def _claim(self, filename):
+        """Claim the message in `filename` for sending.
+
+        Returns what marks the claim, which depends on the `claim` strategy,
+        or None if the message is being sent by someone else or is gone.
+        """
+        if self.claim == 'rename':
+            return self._claim_rename(filename)
+        if self.claim == 'flock':
+            return self._claim_flock(filename)
+        return self._claim_link(filename)
+
+    def _claim_link(self, filename):
+        # Returns the name of the ``.sending-`` link which marks the claim.
+        head, tail = os.path.split(filename)
+        tmp_filename = os.path.join(head, '.sending-' + tail)
+        # perform a series of operations in an attempt to ensure
+        # that no two threads/processes send this message
+        # simultaneously as well as attempting to not generate
+        # spurious failure messages in the log; a diagram that
+        # represents these operations is included in a
+        # comment above this class
+        try:
+            # find the age of the tmp file (if it exists)
+            mtime = os.stat(tmp_filename)[stat.ST_MTIME]
+        except OSError as e:
+            if e.errno == errno.ENOENT: # file does not exist
+                # the tmp file could not be stated because it
+                # doesn't exist, that's fine, keep going
+                age = None
+            else: #pragma NO COVER
+                # the tmp file could not be stated for some reason
+                # other than not existing; we'll report the error
+                raise
+        else:
+            age = time.time() - mtime
+
+        # if the tmp file exists, check it's age
+        if age is not None:
             try:
-                os.remove(filename)
+                if age > MAX_SEND_TIME:
+                    # the tmp file is "too old"; this suggests
+                    # that during an attemt to send it, the
+                    # process died; remove the tmp file so we
+                    # can try again
+                    os.remove(tmp_filename)
+                else:
+                    # the tmp file is "new", so someone else may
+                    # be sending this message, try again later
+                    return None
+                # if we get here, the file existed, but was too
+                # old, so it was unlinked
             except OSError as e: #pragma NO COVER
                 if e.errno == errno.ENOENT: # file does not exist
-                    # someone else unlinked the file; oh well
-                    pass
-                else:
-                    # something bad happend, log it
+                    # it looks like someone else removed the tmp
+                    # file, that's fine, we'll try to deliver the
+                    # message again later
+                    return None
+
+        # now we know that the tmp file doesn't exist, we need to
+        # "touch" the message before we create the tmp file so the
+        # mtime will reflect the fact that the file is being
+        # processed (there is a race here, but it's OK for two or
+        # more processes to touch the file "simultaneously")
+        try:
+            os.utime(filename, None)
+        except OSError as e: #pragma NO COVER
+            if e.errno == errno.ENOENT: # file does not exist
+                # someone removed the message before we could
+                # touch it, no need to complain, we'll just keep
+                # going
+                return None
+            else:
+                # Some other error, propogate it
+                raise
+
+        # creating this hard link will fail if another process is
+        # also sending this message
+        try:
+            _os_link(filename, tmp_filename)
+        except OSError as e: #pragma NO COVER
+            if e.errno == errno.EEXIST: # file exists, *nix
+                # it looks like someone else is sending this
+                # message too; we'll try again later
+                return None
+            else:
+                # Some other error, propogate it
+                raise
+
+        # FIXME: Need to test in Windows.  If
+        # test_concurrent_delivery passes, this stanza can be
+        # deleted.  Otherwise we probably need to catch
+        # WindowsError and check for corresponding error code.
+        #except error as e:
+        #    if e[0] == 183 and e[1] == 'CreateHardLink':
+        #        # file exists, win32
+        #        return
+
+        return tmp_filename
+
+    def _claim_dir(self):
+        # The directory which this worker renames the messages it claims
+        # into.  Readers skip names starting with a dot.
+        return os.path.join(self.maildir.path, 'cur', '.sending-%s.%d.%s' % (
+            socket.gethostname(), os.getpid(),
+            threading.current_thread().name))
+
+    def _claim_rename(self, filename):
+        # Returns the name the message was renamed to.
+        claim_dir = self._claim_dir()
+        claimed = os.path.join(claim_dir, os.path.basename(filename))
+        for attempt in range(2):
+            try:
+                os.rename(filename, claimed)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
                     raise
+                if os.path.isdir(claim_dir):
+                    # someone else claimed (or removed) the message
+                    return None
+                try:
+                    os.mkdir(claim_dir)
+                except OSError as e: #pragma NO COVER
+                    if e.errno != errno.EEXIST:
+                        raise
+            else:
+                return claimed
+        return None #pragma NO COVER
+
+    def _claim_flock(self, filename):
+        # Returns the message file, open and locked.
+        try:
+            f = open(filename, 'rb')
+        except (IOError, OSError) as e:
+            if e.errno == errno.ENOENT:
+                return None
+            raise
+        try:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except (IOError, OSError) as e:
+            f.close()
+            if e.errno in (errno.EAGAIN, errno.EACCES, errno.EWOULDBLOCK):
+                # someone else is sending this message
+                return None
+            raise
+        if os.fstat(f.fileno()).st_nlink == 0:
+            # sent and removed by whoever held the lock before us
+            f.close()
+            return None
+        return f
+
+    def _release(self, filename, claim):
+        """Give up the claim on a message which stays queued."""
+        if self.claim == 'rename':
+            os.rename(claim, filename)
+        elif self.claim == 'flock':
+            claim.close()
+        # A ``.sending-`` link is left in place, so that the message is only
+        # tried again after `MAX_SEND_TIME`.
 
+    def _recover(self):
+        """Put back messages which have been claimed, by renaming them,
+        for longer than `MAX_SEND_TIME`, and remove idle claim directories.
+        """
+        cur = os.path.join(self.maildir.path, 'cur')
+        now = time.time()
+        for name in os.listdir(cur):
+            claim_dir = os.path.join(cur, name)
+            if not name.startswith('.sending-'):
+                continue
+            if not os.path.isdir(claim_dir):
+                continue
+            for entry in os.listdir(claim_dir):
+                claimed = os.path.join(claim_dir, entry)
+                try:
+                    # renaming a file updates its ctime
+                    if now - os.stat(claimed).st_ctime > MAX_SEND_TIME:
+                        os.rename(claimed, os.path.join(cur, entry))
+                except OSError as e: #pragma NO COVER
+                    if e.errno != errno.ENOENT:
+                        raise
             try:
-                os.remove(tmp_filename)
+                if now - os.stat(claim_dir).st_mtime > MAX_SEND_TIME:
+                    os.rmdir(claim_dir)
+            except OSError:
+                # not empty after all, or removed by someone else
+                pass
+
+    def _reject(self, filename, fromaddr, toaddrs, error, claim=None):
+        """Set aside a message which the server refused permanently."""
+        head, tail = os.path.split(filename)
+        rejected_filename = os.path.join(head, '.rejected-' + tail)
+        self.log.error(
+            "Discarding email from %s to %s due to"
+            " a permanent error: %s",
+            fromaddr, ", ".join(toaddrs), error.args)
+        _os_link(self._claimed(filename, claim), rejected_filename)
+
+    def _finish(self, filename, claim, fromaddr, toaddrs):
+        """Remove a sent (or rejected) message and its claim."""
+        if self.claim == 'link':
+            removed = (filename, claim)
+        else:
+            removed = (self._claimed(filename, claim),)
+        for path in removed:
+            try:
+                os.remove(path)
             except OSError as e: #pragma NO COVER
                 if e.errno == errno.ENOENT: # file does not exist
                     # someone else unlinked the file; oh well
@@ -264,21 +955,157 @@ class QueueProcessor(object):
                 else:
                     # something bad happened, log it
                     raise
+        if self.claim == 'flock':
+            claim.close()
 
-            # TODO: maybe log the Message-Id of the message sent
-            self.log.info("Mail from %s to %s sent.",
-                          fromaddr, ", ".join(toaddrs))
+        # TODO: maybe log the Message-Id of the message sent
+        self.log.info("Mail from %s to %s sent.",
+                      fromaddr, ", ".join(toaddrs))
+
+    def _log_failure(self, filename, fromaddr, toaddrs):
+        # Must be called from an exception handler.
+        if fromaddr != '' or toaddrs != ():
+            self.log.error(
+                "Error while sending mail from %s to %s.",
+                fromaddr, ", ".join(toaddrs), exc_info=True)
+        else:
+            self.log.error(
+                "Error while sending mail : %s ",
+                filename, exc_info=True)
+
+def _set_recipients(path, toaddrs):
+    """Replace the recipients in the envelope of the queued message in
+    `path`, by writing the message anew and renaming it into place.
+    """
+    head, tail = os.path.split(path)
+    temp = os.path.join(head, '.deferred-' + tail)
+    with open(path, 'rb') as f:
+        with open(temp, 'wb') as out:
+            value = header.Header(','.join(toaddrs), 'utf-8',
+                                  header_name='X-Actually-To').encode()
+            out.write(('X-Actually-To: %s\n' % value).encode('ascii'))
+            name = None
+            while True:
+                line = f.readline()
+                if line.strip(b'\r\n') == b'':
+                    break
+                if line[:1] not in (b' ', b'\t'):
+                    name = line.split(b':', 1)[0].strip().lower()
+                if name != b'x-actually-to':
+                    out.write(line)
+            out.write(line)
+            shutil.copyfileobj(f, out)
+    os.rename(temp, path)
+
+
+class QueueWatcher(object):
+    """Wait for messages to arrive in a queue.
+
+    ``wait`` returns as soon as a file is created in or moved into the
+    queue's ``new`` directory, after ``interval`` seconds at the latest, or
+    when ``wake`` is called (which is safe to do from a signal handler).
+
+    Linux inotify is used when it is available.  Elsewhere the ``new``
+    directory is polled every ``poll_interval`` seconds and a change in its
+    modification time counts as an arrival.
+    """
+    poll_interval = 1
+
+    def __init__(self, queue_path, interval=60):
+        self.path = os.path.join(queue_path, 'new')
+        self.interval = interval
+        self._inotify = None
+        self._wakeup = None
+        if sys.platform != 'win32':
+            self._wakeup = os.pipe()
+            for fd in self._wakeup:
+                _set_nonblocking(fd)
+            if HAVE_INOTIFY:
+                self._inotify = self._init_inotify()
+        self._mtime = self._get_mtime()
+
+    def _init_inotify(self):
+        fd = _inotify_init1(os.O_NONBLOCK)
+        if fd < 0: #pragma NO COVER
+            return None
+        path = self.path
+        if not isinstance(path, bytes):
+            path = path.encode(sys.getfilesystemencoding())
+        wd = _inotify_add_watch(fd, path, IN_CREATE | IN_MOVED_TO)
+        if wd < 0: #pragma NO COVER
+            os.close(fd)
+            return None
+        return fd
+
+    def _get_mtime(self):
+        try:
+            return os.stat(self.path).st_mtime
+        except OSError: #pragma NO COVER
+            return None
+
+    def wait(self):
+        """Block until a message may have arrived or `interval` passed.
+
+        Returns True if a new message was seen, False otherwise.
+        """
+        deadline = time.time() + self.interval
+        while True:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                return False
+            if self._inotify is not None:
+                fds = [self._wakeup[0], self._inotify]
+                ready = select.select(fds, [], [], timeout)[0]
+                if self._wakeup[0] in ready:
+                    _drain(self._wakeup[0])
+                if self._inotify in ready:
+                    _drain(self._inotify)
+                    return True
+                if ready:
+                    return False
+                continue
+            timeout = min(timeout, self.poll_interval)
+            if self._wakeup is not None:
+                if select.select([self._wakeup[0]], [], [], timeout)[0]:
+                    _drain(self._wakeup[0])
+                    return False
+            else: #pragma NO COVER
+                time.sleep(timeout)
+            mtime = self._get_mtime()
+            if mtime != self._mtime:
+                self._mtime = mtime
+                return True
+
+    def wake(self):
+        """Make a current or the next call to ``wait`` return at once."""
+        if self._wakeup is not None:
+            try:
+                os.write(self._wakeup[1], b'\0')
+            except OSError as e: #pragma NO COVER
+                if e.errno != errno.EAGAIN:
+                    raise
+
+    def close(self):
+        fds = list(self._wakeup or ())
+        if self._inotify is not None:
+            fds.append(self._inotify)
+        for fd in fds:
+            os.close(fd)
+        self._wakeup = self._inotify = None
+
+
+def _set_nonblocking(fd):
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+def _drain(fd):
+    try:
+        while os.read(fd, 4096):
+            pass
+    except OSError as e:
+        if e.errno != errno.EAGAIN: #pragma NO COVER
+            raise
 
-        # Catch errors and log them here
-        except:
-            if fromaddr != '' or toaddrs != ():
-                self.log.error(
-                    "Error while sending mail from %s to %s.",
-                    fromaddr, ", ".join(toaddrs), exc_info=True)
-            else:
-                self.log.error(
-                    "Error while sending mail : %s ",
-                    filename, exc_info=True)
 
 class ConsoleApp(object):
     """Allows running of Queue Processor from the console.
@@ -296,6 +1123,58 @@ class ConsoleApp(object):
         --port              Which port on smtp server to deliver mail to.
                             Default is 25.
 
+        --relay <host[:port][*weight]>
+                            Deliver through this relay instead of --hostname
+                            and --port.  Give it several times to balance the
+                            load between relays; relays which fail are left
+                            out for a while.  Relays with a higher weight
+                            (default 1) get a larger share of the messages.
+
+        --relay-strategy <strategy>
+                            How to choose among relays: round-robin,
+                            least-in-flight or latency.  Default is
+                            round-robin.
+
+        --rate <n>          Send at most n messages per second.  Limits
+                            tighten when servers answer with transient (4xx)
+                            errors and recover as messages go through.
+
+        --relay-rate <n>    Send at most n messages per second to each relay.
+
+        --domain-rate <n>   Send at most n messages per second to each
+                            recipient domain.
+
+        --shard <i/N>       Send only the i-th of N shares of the messages,
+                            so that N processes (e.g. on several hosts)
+                            can share a queue.  Shares whose process has
+                            not been seen for --lease-timeout seconds are
+                            taken over.
+
+        --lease-timeout <secs>
+                            With --shard, how long another process may be
+                            silent before its share is taken over.  Default
+                            is 300.
+
+        --claim <strategy>  How to keep two workers or processes from
+                            sending the same message: link (the default),
+                            rename (fewer file system operations, e.g. for
+                            NFS) or flock (local file systems only).
+
+        --order <order>     The order in which to send the queue: mtime
+                            (oldest first, the default), name (oldest
+                            first by the time in the file names, which
+                            saves a stat per message) or none (directory
+                            order, starting at once on large queues).
+
+        --backoff <secs>    Wait this long before trying a message which
+                            failed again, doubling the wait (up to an hour)
+                            after each further failure.  Without it failed
+                            messages are tried again on every pass.
+
+        --max-age <secs>    With --backoff, give up on messages queued for
+                            longer than this and move them to the "dead"
+                            directory of the queue.  Default is 5 days.
+
         --username          Username to use to log in to smtp server.  Default
                             is none.
 
@@ -317,8 +1196,33 @@ class ConsoleApp(object):
                             used for all options.
 
         --debug-smtp        Enable SMTP debug output (STDERR)
+
+        --workers <n>       Number of messages to send in parallel, each
+                            worker using its own SMTP connection.  Default
+                            is 1.
+
+        --daemon            Keep running, sending messages as soon as they
+                            are queued, instead of making a single pass over
+                            the queue.  SIGTERM or SIGINT make the daemon
+                            exit and SIGHUP makes it reload its
+                            configuration, in both cases after finishing the
+                            messages being sent.
+
+        --interval <secs>   In daemon mode, the longest time to wait between
+                            passes over the queue, so that failed messages
+                            are retried.  Default is 60.
+
+        --schedule <order>  mtime to send messages in the order they were
+                            queued, or domain to group them by recipient
+                            domain (or relay) and send each group over one
+                            SMTP session.  Default is mtime.
+
+        --session-limit <n> With --schedule domain, the most messages sent
+                            over one session before other groups get their
+                            turn.  Default is 100.
     """
     _error = False
+    _qp = None
     hostname = "localhost"
     port = 25
     username = None
@@ -328,12 +1232,63 @@ class ConsoleApp(object):
     ssl = False
     queue_path = None
     debug_smtp = False
+    workers = 1
+    daemon = False
+    interval = 60
+    relays = None
+    relay_strategy = "round-robin"
+    schedule = "mtime"
+    session_limit = 100
+    rate = None
+    relay_rate = None
+    domain_rate = None
+    backoff = None
+    max_age = 5*24*3600
+    claim = "link"
+    shard = None
+    lease_timeout = 300
+    order = "mtime"
+    log = logging.getLogger("QueueProcessor")
+
+    _settings = (
+        "hostname",
+        "port",
+        "relays",
+        "relay_strategy",
+        "username",
+        "password",
+        "force_tls",
+        "no_tls",
+        "queue_path",
+        "debug_smtp",
+        "ssl",
+        "workers",
+        "daemon",
+        "interval",
+        "schedule",
+        "session_limit",
+        "rate",
+        "relay_rate",
+        "domain_rate",
+        "backoff",
+        "max_age",
+        "claim",
+        "shard",
+        "lease_timeout",
+        "order",
+    )
 
     def __init__(self, argv=sys.argv):
         self.script_name = argv[0]
+        self._argv = list(argv[1:])
         self._load_config()
-        self._process_args(argv[1:])
-        self.mailer = SMTPMailer(
+        self._process_args(list(self._argv))
+        self.mailer = self._make_mailer()
+
+    def _make_mailer(self):
+        # With several workers the connections are pooled, so that each
+        # worker keeps using one connection for all the messages it sends.
+        return SMTPMailer(
             hostname=self.hostname,
             port=self.port,
             username=self.username,
@@ -342,18 +1297,130 @@ class ConsoleApp(object):
             force_tls=self.force_tls,
             ssl=self.ssl,
             debug_smtp=self.debug_smtp,
+            pool_size=self.workers if self.workers > 1 else 0,
+            relays=self.relays,
+            relay_strategy=self.relay_strategy,
+            rate_limit=self._make_rate_limit(),
             )
-        
+
+    def _make_shard(self):
+        if self.shard is None:
+            return None
+        return parse_shard(self.shard)
+
+    def _make_retry(self):
+        if self.backoff is None:
+            return None
+        return RetryPolicy(initial=self.backoff, max_age=self.max_age)
+
+    def _make_rate_limit(self):
+        if (self.rate, self.relay_rate, self.domain_rate) == (None,) * 3:
+            return None
+        return RateLimiter(rate=self.rate, relay_rate=self.relay_rate,
+                           domain_rate=self.domain_rate)
+
     def main(self):
         if self._error:
             return
 
-        qp = QueueProcessor(self.mailer, self.queue_path)
-        qp.send_messages()
+        try:
+            if self.daemon:
+                self._run_daemon()
+            else:
+                self._send_messages()
+        finally:
+            self._close_mailer()
+
+    def _send_messages(self):
+        # The daemon keeps its processor, and with it the state of its
+        # shards, from pass to pass until the configuration is reloaded.
+        if self._qp is None:
+            self._qp = QueueProcessor(self.mailer, self.queue_path,
+                                      workers=self.workers,
+                                      schedule=self.schedule,
+                                      session_limit=self.session_limit,
+                                      retry=self._make_retry(),
+                                      claim=self.claim,
+                                      shard=self._make_shard(),
+                                      lease_timeout=self.lease_timeout,
+                                      order=self.order)
+        self._qp.send_messages()
+
+    def _close_mailer(self):
+        close = getattr(self.mailer, 'close', None)
+        if close is not None:
+            close()
+
+    def _run_daemon(self):
+        self._stopping = self._reloading = False
+        self._qp = self._watcher = None
+        saved = self._install_signal_handlers()
+        try:
+            while not self._stopping:
+                if self._reloading:
+                    self._reload()
+                    if self._error:
+                        break
+                self._send_messages()
+                if self._watcher is None:
+                    self._watcher = QueueWatcher(self.queue_path,
+                                                 self.interval)
+                if not (self._stopping or self._reloading):
+                    self._watcher.wait()
+        finally:
+            for signum, handler in saved:
+                signal.signal(signum, handler)
+            if self._watcher is not None:
+                self._watcher.close()
+
+    def _install_signal_handlers(self):
+        saved = []
+        for name in ('SIGTERM', 'SIGINT', 'SIGHUP'):
+            signum = getattr(signal, name, None)
+            if signum is None: #pragma NO COVER
+                continue
+            try:
+                handler = signal.signal(signum, self._handle_signal)
+            except ValueError:
+                # Not in the main thread, where handlers must be set.
+                break
+            saved.append((signum, handler))
+        return saved
+
+    def _handle_signal(self, signum, frame):
+        if signum == getattr(signal, 'SIGHUP', None):
+            self._reloading = True
+        else:
+            self._stopping = True
+        # Let the messages being sent finish, then leave the send loop.
+        if self._qp is not None:
+            self._qp.stop()
+        if self._watcher is not None:
+            self._watcher.wake()
+
+    def _reload(self):
+        self.log.info("Reloading configuration.")
+        self._reloading = False
+        queue_path = self.queue_path
+        # Start over from the defaults, so that settings removed from the
+        # config file do not linger.
+        for name in self._settings:
+            self.__dict__.pop(name, None)
+        self._load_config()
+        self._process_args(list(self._argv))
+        self._close_mailer()
+        self.mailer = self._make_mailer()
+        self._qp = None
+        if self._watcher is not None and (
+            self.queue_path != queue_path or
+            self.interval != self._watcher.interval):
+            self._watcher.close()
+            self._watcher = None
 
     def _process_args(self, args):
         got_queue_path = False
         log_usage = False
+        relays = []
         while args:
             arg = args.pop(0)
             if arg == "--hostname":
@@ -368,6 +1435,63 @@ class ConsoleApp(object):
                 except:
                     log_usage = True
 
+            elif arg == "--relay":
+                try:
+                    spec = args.pop(0)
+                    parse_relays(spec)
+                except (IndexError, ValueError):
+                    log_usage = True
+                else:
+                    relays.append(spec)
+
+            elif arg == "--relay-strategy":
+                if not args or args[0] not in RELAY_STRATEGIES:
+                    log_usage = True
+                else:
+                    self.relay_strategy = args.pop(0)
+
+            elif arg == "--shard":
+                try:
+                    self.shard = args.pop(0)
+                    parse_shard(self.shard)
+                except (IndexError, ValueError):
+                    log_usage = True
+
+            elif arg == "--lease-timeout":
+                try:
+                    self.lease_timeout = float(args.pop(0))
+                except:
+                    log_usage = True
+                else:
+                    if self.lease_timeout <= 0:
+                        log_usage = True
+
+            elif arg == "--claim":
+                if not args or args[0] not in CLAIMS:
+                    log_usage = True
+                else:
+                    self.claim = args.pop(0)
+
+            elif arg in ("--backoff", "--max-age"):
+                try:
+                    secs = float(args.pop(0))
+                except:
+                    log_usage = True
+                else:
+                    if secs <= 0:
+                        log_usage = True
+                    setattr(self, arg[2:].replace('-', '_'), secs)
+
+            elif arg in ("--rate", "--relay-rate", "--domain-rate"):
+                try:
+                    rate = float(args.pop(0))
+                except:
+                    log_usage = True
+                else:
+                    if rate <= 0:
+                        log_usage = True
+                    setattr(self, arg[2:].replace('-', '_'), rate)
+
             elif arg == "--username":
                 if not args:
                     log_usage = True
@@ -398,6 +1522,48 @@ class ConsoleApp(object):
             elif arg == "--debug-smtp":
                 self.debug_smtp = True
 
+            elif arg == "--daemon":
+                self.daemon = True
+
+            elif arg == "--interval":
+                try:
+                    self.interval = float(args.pop(0))
+                except:
+                    log_usage = True
+                else:
+                    if not self.interval > 0:
+                        log_usage = True
+
+            elif arg == "--order":
+                if not args:
+                    log_usage = True
+                else:
+                    self.order = order_or_none(args.pop(0))
+
+            elif arg == "--workers":
+                try:
+                    self.workers = int(args.pop(0))
+                except:
+                    log_usage = True
+                else:
+                    if self.workers < 1:
+                        log_usage = True
+
+            elif arg == "--schedule":
+                if not args or args[0] not in SCHEDULES:
+                    log_usage = True
+                else:
+                    self.schedule = args.pop(0)
+
+            elif arg == "--session-limit":
+                try:
+                    self.session_limit = int(args.pop(0))
+                except:
+                    log_usage = True
+                else:
+                    if self.session_limit < 1:
+                        log_usage = True
+
             elif arg.startswith("-") or got_queue_path:
                 log_usage = True
 
@@ -408,6 +1574,17 @@ class ConsoleApp(object):
         if not self.queue_path:
             log_usage = True
 
+        if self.interval is None or not self.interval > 0:
+            # a bad ``interval`` in the config file
+            log_usage = True
+
+        if self.order not in ORDERS:
+            log_usage = True
+
+        if relays:
+            # Relays given on the command line replace those configured.
+            self.relays = ' '.join(relays)
+
         if log_usage:
             self._error_usage()
 
@@ -431,23 +1608,15 @@ class ConsoleApp(object):
                 return
 
         section = "app:qp"
-        names = [
-            "hostname",
-            "port",
-            "username",
-            "password",
-            "force_tls",
-            "no_tls",
-            "queue_path",
-            "debug_smtp",
-            "ssl",
-        ]
+        names = self._settings
         defaults = dict([(name, str(getattr(self, name))) for name in names])
         config = ConfigParser(defaults)
         config.read(path)
 
         self.hostname = config.get(section, "hostname")
         self.port = int(config.get(section, "port"))
+        self.relays = string_or_none(config.get(section, "relays"))
+        self.relay_strategy = config.get(section, "relay_strategy")
         self.username = string_or_none(config.get(section, "username"))
         self.password = string_or_none(config.get(section, "password"))
         self.force_tls = boolean(config.get(section, "force_tls"))
@@ -455,6 +1624,23 @@ class ConsoleApp(object):
         self.ssl = boolean(config.get(section, "ssl"))
         self.queue_path = string_or_none(config.get(section, "queue_path"))
         self.debug_smtp = boolean(config.get(section, "debug_smtp"))
+        self.workers = int(config.get(section, "workers"))
+        self.daemon = boolean(config.get(section, "daemon"))
+        try:
+            self.interval = float(config.get(section, "interval"))
+        except ValueError:
+            self.interval = None
+        self.schedule = config.get(section, "schedule")
+        self.session_limit = int(config.get(section, "session_limit"))
+        self.rate = float_or_none(config.get(section, "rate"))
+        self.relay_rate = float_or_none(config.get(section, "relay_rate"))
+        self.domain_rate = float_or_none(config.get(section, "domain_rate"))
+        self.backoff = float_or_none(config.get(section, "backoff"))
+        self.max_age = float(config.get(section, "max_age"))
+        self.claim = config.get(section, "claim")
+        self.shard = string_or_none(config.get(section, "shard"))
+        self.lease_timeout = float(config.get(section, "lease_timeout"))
+        self.order = order_or_none(config.get(section, "order"))
 
 
     def _error_usage(self):
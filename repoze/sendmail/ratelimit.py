@@ -0,0 +1,199 @@
+##############################################################################
+#
+# Copyright (c) 2003 Zope Corporation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""
+Limits on the rate at which messages are sent.
+"""
+import threading
+import time
+
+from smtplib import SMTPRecipientsRefused
+
+
+def is_throttling(error):
+    """Whether `error` is a transient (4xx) SMTP error, which is how servers
+    ask clients to slow down.
+    """
+    if isinstance(error, SMTPRecipientsRefused):
+        codes = [code for code, resp in error.recipients.values()]
+        return bool(codes) and all(400 <= code < 500 for code in codes)
+    code = getattr(error, 'smtp_code', None)
+    return code is not None and 400 <= code < 500
+
+
+class TokenBucket(object):
+    """Allows `rate` messages per second on average, in bursts of up to
+    `burst` messages (by default one second's worth).
+
+    The bucket is adaptive: `throttle` cuts the rate by `decrease` (down to
+    `min_rate`, by default a hundredth of `rate`) and `recover` raises it
+    again by `increase` times `rate`, up to `rate`.
+    """
+    def __init__(self, rate, burst=None, min_rate=None, decrease=0.5,
+                 increase=0.1):
+        if rate <= 0:
+            raise ValueError('rate must be positive')
+        self.max_rate = float(rate)
+        self.rate = self.max_rate
+        if burst is None:
+            burst = max(self.max_rate, 1)
+        self.burst = burst
+        if min_rate is None:
+            min_rate = self.max_rate / 100
+        self.min_rate = min_rate
+        self.decrease = decrease
+        self.increase = increase
+        self._tokens = float(burst)
+        self._updated = time.time()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        elapsed = max(now - self._updated, 0)
+        self._tokens = min(self.burst, self._tokens + elapsed * self.rate)
+        self._updated = now
+
+    def reserve(self):
+        """Take a token and return how many seconds to wait before it may
+        be used; 0 if it may be used at once.
+        """
+        with self._lock:
+            self._refill(time.time())
+            self._tokens -= 1
+            if self._tokens >= 0:
+                return 0
+            return -self._tokens / self.rate
+
+    def throttle(self):
+        with self._lock:
+            self._refill(time.time())
+            self.rate = max(self.rate * self.decrease, self.min_rate)
+            # no more bursts until the server had a break
+            self._tokens = min(self._tokens, 0)
+
+    def recover(self):
+        with self._lock:
+            if self.rate < self.max_rate:
+                self._refill(time.time())
+                self.rate = min(self.rate + self.max_rate * self.increase,
+                                self.max_rate)
+
+    @property
+    def idle(self):
+        # Whether the bucket is back to its initial state.
+        with self._lock:
+            self._refill(time.time())
+            return self._tokens >= self.burst and self.rate == self.max_rate
+
+
+class RateLimiter(object):
+    """Keeps the sending of messages within rate limits.
+
+    `rate` limits all messages, `relay_rate` those sent through each relay
+    (or SMTP server) and `domain_rate` those sent to each recipient domain,
+    in messages per second; ``None`` means no limit.  The ``*_burst``
+    arguments are passed on to the `TokenBucket` for each limit.
+
+    If `adaptive` is true, a transient (4xx) error from the server halves
+    the limits which applied to the message, and each message sent
+    afterwards raises them a little, until they are back to their
+    configured rates.
+
+    A `RateLimiter` may be shared between threads and between mailers.
+    """
+    max_buckets = 10000
+    sleep = staticmethod(time.sleep)  # allow replacement for testing.
+
+    def __init__(self, rate=None, relay_rate=None, domain_rate=None,
+                 burst=None, relay_burst=None, domain_burst=None,
+                 adaptive=True):
+        self.relay_rate = relay_rate
+        self.relay_burst = relay_burst
+        self.domain_rate = domain_rate
+        self.domain_burst = domain_burst
+        self.adaptive = adaptive
+        if rate is None:
+            self.bucket = None
+        else:
+            self.bucket = TokenBucket(rate, burst)
+        self._relays = {}
+        self._domains = {}
+        self._lock = threading.Lock()
+
+    def _get(self, buckets, key, rate, burst):
+        with self._lock:
+            bucket = buckets.get(key)
+            if bucket is None:
+                if len(buckets) >= self.max_buckets:
+                    for old in [k for k, b in buckets.items() if b.idle]:
+                        del buckets[old]
+                bucket = buckets[key] = TokenBucket(rate, burst)
+            return bucket
+
+    def buckets(self, toaddrs=(), relay=None):
+        """Return the buckets which limit a message to `toaddrs` sent
+        through `relay` (any hashable naming the server, or ``None``).
+        """
+        buckets = []
+        if self.bucket is not None:
+            buckets.append(self.bucket)
+        if self.relay_rate is not None and relay is not None:
+            buckets.append(self._get(self._relays, relay,
+                                     self.relay_rate, self.relay_burst))
+        if self.domain_rate is not None:
+            domains = set(addr.rsplit('@', 1)[-1].lower()
+                          for addr in toaddrs)
+            for domain in sorted(domains):
+                buckets.append(self._get(self._domains, domain,
+                                         self.domain_rate, self.domain_burst))
+        return buckets
+
+    def reserve(self, toaddrs=(), relay=None):
+        """Reserve the sending of a message to `toaddrs` through `relay`
+        and return how many seconds to wait before sending it, without
+        waiting; for callers which must not block, such as coroutines.
+        """
+        wait = 0
+        for bucket in self.buckets(toaddrs, relay):
+            wait = max(wait, bucket.reserve())
+        return wait
+
+    def acquire(self, toaddrs=(), relay=None):
+        """Wait until a message to `toaddrs` may be sent through `relay`.
+
+        Returns the time waited, in seconds.
+        """
+        wait = self.reserve(toaddrs, relay)
+        if wait > 0:
+            self.sleep(wait)
+        return wait
+
+    def succeeded(self, toaddrs=(), relay=None):
+        if self.adaptive:
+            for bucket in self.buckets(toaddrs, relay):
+                bucket.recover()
+
+    def failed(self, error, toaddrs=(), relay=None):
+        if self.adaptive and is_throttling(error):
+            for bucket in self.buckets(toaddrs, relay):
+                bucket.throttle()
+
+    def send(self, send, fromaddr, toaddrs, message, relay=None):
+        """Call ``send(fromaddr, toaddrs, message)`` within the limits."""
+        self.acquire(toaddrs, relay)
+        try:
+            result = send(fromaddr, toaddrs, message)
+        except Exception as e:
+            self.failed(e, toaddrs, relay)
+            raise
+        self.succeeded(toaddrs, relay)
+        return result
@@ -0,0 +1,231 @@
+##############################################################################
+#
+# Copyright (c) 2003 Zope Corporation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""
+Templates for sending many variants of one message, e.g. to mailing lists.
+"""
+import copy
+import re
+import uuid
+from email.charset import Charset
+from email.message import Message
+from email.utils import formatdate
+from email.utils import make_msgid
+from io import BytesIO
+
+from repoze.sendmail.encoding import ADDR_HEADERS
+from repoze.sendmail.encoding import PARAM_HEADERS
+from repoze.sendmail.encoding import _encode_header
+from repoze.sendmail.encoding import _header_store
+from repoze.sendmail.encoding import best_charset
+from repoze.sendmail.encoding import cleanup_message
+from repoze.sendmail.encoding import mark_cleaned
+from repoze.sendmail.encoding import write_message
+from repoze.sendmail._compat import string_types
+from repoze.sendmail._compat import text_type
+
+PLACEHOLDER = re.compile(r'\$\{([_A-Za-z][_A-Za-z0-9]*)\}')
+
+_NEWLINES = re.compile(r'\r\n|\r')
+
+
+def substitute(text, values):
+    """
+    Replace the ``${name}`` placeholders in `text` with ``values[name]``.
+
+    Raises `KeyError` for names missing from `values`.
+    """
+    return PLACEHOLDER.sub(lambda match: text_type(values[match.group(1)]),
+                           text)
+
+
+class MessageTemplate(object):
+    """
+    A `Message` which is encoded once and then rendered, quickly, into many
+    variants.
+
+    Header values and text parts of `message` may contain ``${name}``
+    placeholders, which `render` replaces.  Everything else, i.e. the other
+    headers, the other parts (such as attachments) and the MIME structure,
+    is encoded once, when the template is made; rendering only encodes the
+    headers and text parts with placeholders and splices them in between.
+    A text part keeps its charset unless the rendered text does not fit
+    into it.
+
+    Unless `message` has them, each rendering gets a new `Message-Id` and
+    the current `Date`.  `addr_headers` and `header_cache` are as for
+    `repoze.sendmail.encoding.cleanup_message`.
+
+    `message` itself is left as it is.  The rendered messages are bytes,
+    which may be passed to the ``send_raw`` method of deliveries and
+    mailers.
+    """
+    def __init__(self, message, addr_headers=ADDR_HEADERS,
+                 header_cache=None):
+        if not isinstance(message, Message):
+            raise ValueError(
+               'Message must be instance of email.message.Message')
+        self.addr_headers = addr_headers
+        self.header_cache = header_cache
+        message = copy.deepcopy(message)
+        # Short enough for headers to stay on one line, whatever their name.
+        self._prefix = 'repoze-%s-' % uuid.uuid4().hex[:16]
+        self._markers = {}
+        self._renderers = []
+        for part in message.walk():
+            if _is_text(part):
+                text = _text(part)
+                if PLACEHOLDER.search(text):
+                    self._add_part(part, text)
+            self._add_headers(part)
+        if message['Message-Id'] is None:
+            marker = self._marker(lambda values: make_msgid('repoze.sendmail'))
+            message['Message-Id'] = marker
+        if message['Date'] is None:
+            message['Date'] = self._marker(lambda values: formatdate())
+        cleanup_message(message, addr_headers, header_cache=header_cache)
+        out = BytesIO()
+        write_message(message, out)
+        self._segments = self._split(out.getvalue())
+
+    def _marker(self, render):
+        # A placeholder in the encoded template for what `render(values)`
+        # returns.
+        marker = '%s%d' % (self._prefix, len(self._markers))
+        self._markers[marker.encode('ascii')] = len(self._renderers)
+        self._renderers.append(render)
+        return marker
+
+    def _add_part(self, part, text):
+        # The Content-Type, the Content-Transfer-Encoding and the payload
+        # of a text part are all rendered together.
+        content_type = part.get('Content-Type', 'text/plain')
+        charset = part.get_content_charset()
+        rendered = {}
+
+        def render(values):
+            if rendered.get('values') is not values:
+                rendered['values'] = values
+                rendered['part'] = _render_part(
+                    content_type, charset, substitute(text, values))
+            return rendered['part']
+        markers = [self._marker(lambda values, i=i: render(values)[i])
+                   for i in range(3)]
+        headers = []
+        for name, value in part._headers:
+            if name.lower() == 'content-type':
+                value = markers[0]
+            elif name.lower() == 'content-transfer-encoding':
+                continue
+            headers.append((name, value))
+        if part.get('MIME-Version') is None:
+            # as `cleanup_message` adds to text parts
+            headers.append(('MIME-Version', '1.0'))
+        if part.get('Content-Type') is None:
+            headers.append(('Content-Type', markers[0]))
+        headers.append(('Content-Transfer-Encoding', markers[1]))
+        part._headers = headers
+        part.set_payload(markers[2])
+        # A charset keeps `cleanup_message` from choosing one, which would
+        # add it to the Content-Type marker.
+        part._charset = Charset('us-ascii')
+
+    def _add_headers(self, part):
+        store = _header_store(part)
+        headers = []
+        for name, value in part._headers:
+            if (isinstance(value, string_types) and
+                    not value.startswith(self._prefix) and
+                    PLACEHOLDER.search(value)):
+                value = store(name, self._marker(
+                    lambda values, name=name, value=value:
+                    self._render_header(name, substitute(value, values))))
+            else:
+                value = (name, value)
+            headers.append(value)
+        part._headers = headers
+
+    def _render_header(self, name, value):
+        if '\r' in value or '\n' in value:
+            raise ValueError('%s header must be on one line' % name)
+        lower = name.lower()
+        if lower in PARAM_HEADERS:
+            message = Message()
+            message[name] = value
+            cleanup_message(message, self.addr_headers)
+            return message[name]
+        address = lower in self.addr_headers
+        if self.header_cache is None:
+            return _encode_header(name, value, address)
+        return self.header_cache.get(name, value, address)
+
+    def _split(self, data):
+        segments = re.split(
+            b'(' + re.escape(self._prefix.encode('ascii')) + b'[0-9]+)', data)
+        found = segments[1::2]
+        if sorted(found) != sorted(self._markers):  # pragma NO COVER
+            raise ValueError('Message could not be made into a template')
+        for i in range(1, len(segments), 2):
+            segments[i] = self._markers[segments[i]]
+        return segments
+
+    def render(self, values):
+        """
+        Return the message as bytes, with the placeholders replaced by the
+        values for their names in the mapping `values`.
+        """
+        chunks = list(self._segments)
+        renderers = self._renderers
+        for i in range(1, len(chunks), 2):
+            rendered = renderers[chunks[i]](values)
+            if not isinstance(rendered, bytes):
+                rendered = rendered.encode('ascii')
+            chunks[i] = rendered
+        return b''.join(chunks)
+
+
+def _is_text(part):
+    return (not part.is_multipart() and
+            part.get_content_maintype() == 'text' and
+            isinstance(part.get_payload(), string_types))
+
+
+def _text(part):
+    # The decoded text of a text part.
+    payload = part.get_payload(decode=True)
+    if not isinstance(payload, bytes):  # pragma NO COVER
+        return payload
+    charset = part.get_content_charset() or 'ascii'
+    try:
+        return payload.decode(charset)
+    except (LookupError, UnicodeError):
+        return part.get_payload()
+
+
+def _render_part(content_type, charset, text):
+    # Return the Content-Type, the Content-Transfer-Encoding and the
+    # encoded payload of a text part.
+    if charset is not None:
+        try:
+            text.encode(charset)
+        except (LookupError, UnicodeError):
+            charset = None
+    if charset is None or charset == 'us-ascii':
+        charset, encoded = best_charset(text)
+    part = Message()
+    part['Content-Type'] = content_type
+    part.set_payload(text, charset)
+    mark_cleaned(part)
+    payload = _NEWLINES.sub('\n', part.get_payload())
+    return (part['Content-Type'], part['Content-Transfer-Encoding'],
+            payload.encode('ascii'))
@@ -0,0 +1,499 @@
+import os
+import shutil
+import smtplib
+import sys
+import unittest
+from tempfile import mkdtemp
+
+from repoze.sendmail.tests.test_queue import LoggerStub
+
+NEEDS_ASYNCIO = unittest.skipIf(sys.version_info < (3, 7),
+                                'requires Python 3.7 or later')
+
+GREETING = b'220 localhost ESMTP\r\n'
+EHLO = b'250-localhost\r\n250-SIZE 1000000\r\n250 AUTH LOGIN PLAIN\r\n'
+EHLO_TLS = b'250-localhost\r\n250 STARTTLS\r\n'
+OK = b'250 OK\r\n'
+
+
+class _AsyncTestCase(unittest.TestCase):
+
+    def setUp(self):
+        import asyncio
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        import asyncio
+        self.loop.close()
+        asyncio.set_event_loop(None)
+
+    def _run(self, coroutine):
+        return self.loop.run_until_complete(coroutine)
+
+    def _done(self, result=None, error=None):
+        future = self.loop.create_future()
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+        return future
+
+
+@NEEDS_ASYNCIO
+class TestData(unittest.TestCase):
+
+    def test_data(self):
+        from repoze.sendmail.aio import _data
+        self.assertEqual(_data(b'a\n.b\r\nc\rd'),
+                         b'a\r\n..b\r\nc\r\nd\r\n.\r\n')
+        self.assertEqual(_data(b'a\r\n'), b'a\r\n.\r\n')
+
+
+@NEEDS_ASYNCIO
+class TestAsyncSMTPMailer(_AsyncTestCase):
+
+    def _getTargetClass(self):
+        from repoze.sendmail.aio import AsyncSMTPMailer
+        return AsyncSMTPMailer
+
+    def _makeOne(self, replies, **kw):
+        import asyncio
+        mailer = self._getTargetClass()(**kw)
+        mailer.local_hostname = 'client.example.com'
+        reader = asyncio.StreamReader()
+        reader.feed_data(b''.join(replies))
+        reader.feed_eof()
+        writer = _WriterStub(self)
+        mailer._open_connection = lambda: self._done((reader, writer))
+        return mailer, writer
+
+    def _send(self, mailer, toaddrs=('you@example.com',), message=b'Hi\n'):
+        return self._run(mailer.send_raw('me@example.com', toaddrs, message))
+
+    def test_send_raw(self):
+        mailer, writer = self._makeOne(
+            [GREETING, EHLO, OK, OK, OK, b'354 Go\r\n', OK, b'221 Bye\r\n'])
+        self._send(mailer, ('you@example.com', 'him@example.com'),
+                   b'Subject: hi\n\n.dot\n')
+        self.assertEqual(writer.lines(), [
+            b'EHLO client.example.com',
+            b'MAIL FROM:<me@example.com>',
+            b'RCPT TO:<you@example.com>',
+            b'RCPT TO:<him@example.com>',
+            b'DATA',
+            b'Subject: hi', b'', b'..dot', b'.',
+            b'QUIT'])
+        self.assertTrue(writer.closed)
+        self.assertEqual(writer.tls, None)
+
+    def test_send(self):
+        from email.message import Message
+        mailer, writer = self._makeOne(
+            [GREETING, EHLO, OK, OK, b'354 Go\r\n', OK, b'221 Bye\r\n'])
+        message = Message()
+        message['Subject'] = 'hi'
+        self._run(mailer.send('me@example.com', ('you@example.com',),
+                              message))
+        self.assertTrue(b'Subject: hi' in writer.lines())
+
+    def test_send_w_non_message(self):
+        mailer, writer = self._makeOne([])
+        self.assertRaises(ValueError, self._run,
+                          mailer.send('me@example.com', ('you@example.com',),
+                                      b''))
+
+    def test_starttls(self):
+        context = object()
+        mailer, writer = self._makeOne(
+            [GREETING, EHLO_TLS, b'220 Go ahead\r\n', EHLO, OK, OK,
+             b'354 Go\r\n', OK, b'221 Bye\r\n'], ssl_context=context,
+            hostname='smtp.example.com')
+        self._send(mailer)
+        self.assertEqual(writer.tls, (context, 'smtp.example.com'))
+        self.assertEqual(writer.lines()[:3], [
+            b'EHLO client.example.com',
+            b'STARTTLS',
+            b'EHLO client.example.com'])
+
+    def test_no_tls(self):
+        mailer, writer = self._makeOne(
+            [GREETING, EHLO_TLS, OK, OK, b'354 Go\r\n', OK, b'221 Bye\r\n'],
+            no_tls=True)
+        self._send(mailer)
+        self.assertEqual(writer.tls, None)
+
+    def test_force_tls_unavailable(self):
+        mailer, writer = self._makeOne([GREETING, EHLO], force_tls=True)
+        self.assertRaises(RuntimeError, self._send, mailer)
+        self.assertTrue(writer.closed)
+
+    def test_helo_fallback(self):
+        mailer, writer = self._makeOne(
+            [GREETING, b'502 What?\r\n', OK, OK, OK, b'354 Go\r\n', OK,
+             b'221 Bye\r\n'])
+        self._send(mailer)
+        self.assertEqual(writer.lines()[:2], [b'EHLO client.example.com',
+                                              b'HELO client.example.com'])
+
+    def test_helo_fails(self):
+        mailer, writer = self._makeOne(
+            [GREETING, b'502 What?\r\n', b'502 What?\r\n'])
+        self.assertRaises(RuntimeError, self._send, mailer)
+
+    def test_helo_w_username(self):
+        mailer, writer = self._makeOne(
+            [GREETING, b'502 What?\r\n', OK], username='user',
+            password='secret')
+        self.assertRaises(RuntimeError, self._send, mailer)
+
+    def test_login_plain(self):
+        mailer, writer = self._makeOne(
+            [GREETING, EHLO, b'235 OK\r\n', OK, OK, b'354 Go\r\n', OK,
+             b'221 Bye\r\n'], username='user', password='secret')
+        self._send(mailer)
+        self.assertEqual(writer.lines()[1],
+                         b'AUTH PLAIN AHVzZXIAc2VjcmV0')
+
+    def test_login_login(self):
+        ehlo = b'250-localhost\r\n250 AUTH LOGIN\r\n'
+        mailer, writer = self._makeOne(
+            [GREETING, ehlo, b'334 VXNlcm5hbWU6\r\n',
+             b'334 UGFzc3dvcmQ6\r\n', b'235 OK\r\n', OK, OK, b'354 Go\r\n',
+             OK, b'221 Bye\r\n'], username='user', password='secret')
+        self._send(mailer)
+        self.assertEqual(writer.lines()[1:4],
+                         [b'AUTH LOGIN', b'dXNlcg==', b'c2VjcmV0'])
+
+    def test_login_refused(self):
+        mailer, writer = self._makeOne(
+            [GREETING, EHLO, b'535 No\r\n'], username='user',
+            password='secret')
+        self.assertRaises(smtplib.SMTPAuthenticationError, self._send, mailer)
+
+    def test_login_no_method(self):
+        ehlo = b'250-localhost\r\n250 AUTH CRAM-MD5\r\n'
+        mailer, writer = self._makeOne(
+            [GREETING, ehlo], username='user', password='secret')
+        self.assertRaises(smtplib.SMTPException, self._send, mailer)
+
+    def test_bad_greeting(self):
+        mailer, writer = self._makeOne([b'554 Go away\r\n'])
+        self.assertRaises(smtplib.SMTPResponseException, self._send, mailer)
+
+    def test_sender_refused(self):
+        mailer, writer = self._makeOne(
+            [GREETING, EHLO, b'553 No\r\n', OK])
+        self.assertRaises(smtplib.SMTPSenderRefused, self._send, mailer)
+        self.assertEqual(writer.lines()[-1], b'RSET')
+        self.assertTrue(writer.closed)
+
+    def test_recipients_refused(self):
+        mailer, writer = self._makeOne(
+            [GREETING, EHLO, OK, b'550 Unknown\r\n', OK])
+        try:
+            self._send(mailer)
+        except smtplib.SMTPRecipientsRefused as e:
+            self.assertEqual(e.recipients,
+                             {'you@example.com': (550, b'Unknown')})
+        else: #pragma NO COVER
+            self.fail('SMTPRecipientsRefused not raised')
+        self.assertEqual(writer.lines()[-1], b'RSET')
+
+    def test_some_recipients_refused(self):
+        mailer, writer = self._makeOne(
+            [GREETING, EHLO, OK, b'550 Unknown\r\n', OK, b'354 Go\r\n', OK,
+             b'221 Bye\r\n'])
+        refused = self._send(mailer, ('nobody@example.com', 'you@example.com'))
+        self.assertEqual(refused, {'nobody@example.com': (550, b'Unknown')})
+        self.assertEqual(writer.lines()[-1], b'QUIT')
+
+    def test_recipient_421(self):
+        mailer, writer = self._makeOne(
+            [GREETING, EHLO, OK, b'421 Too busy\r\n'])
+        self.assertRaises(smtplib.SMTPRecipientsRefused, self._send, mailer,
+                          ('you@example.com', 'him@example.com'))
+        self.assertEqual(writer.lines()[-1], b'RCPT TO:<you@example.com>')
+
+    def test_data_refused(self):
+        mailer, writer = self._makeOne(
+            [GREETING, EHLO, OK, OK, b'354 Go\r\n', b'554 Spam\r\n', OK])
+        try:
+            self._send(mailer)
+        except smtplib.SMTPDataError as e:
+            self.assertEqual(e.smtp_code, 554)
+        else: #pragma NO COVER
+            self.fail('SMTPDataError not raised')
+
+    def test_disconnected(self):
+        mailer, writer = self._makeOne([GREETING, EHLO, OK])
+        self.assertRaises(smtplib.SMTPServerDisconnected, self._send, mailer)
+        self.assertTrue(writer.closed)
+
+    def test_quit_fails(self):
+        mailer, writer = self._makeOne(
+            [GREETING, EHLO, OK, OK, b'354 Go\r\n', OK])
+        self._send(mailer)
+        self.assertTrue(writer.closed)
+
+    def test_concurrency(self):
+        import asyncio
+        mailer = self._getTargetClass()(concurrency=2)
+        running = []
+        peak = []
+        def _connect():
+            running.append(None)
+            peak.append(len(running))
+            return asyncio.sleep(0.01, _ConnectionStub(running))
+        mailer._connect = _connect
+        self._run(asyncio.gather(*[
+            mailer.send_raw('me@example.com', ('you@example.com',), b'')
+            for i in range(5)]))
+        self.assertEqual(max(peak), 2)
+        self.assertEqual(running, [])
+
+
+@NEEDS_ASYNCIO
+class TestAsyncQueueProcessor(_AsyncTestCase):
+
+    def setUp(self):
+        super(TestAsyncQueueProcessor, self).setUp()
+        self.dir = mkdtemp()
+        self.queue_path = os.path.join(self.dir, 'Maildir')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+        super(TestAsyncQueueProcessor, self).tearDown()
+
+    def _makeOne(self, mailer, **kw):
+        from repoze.sendmail.aio import AsyncQueueProcessor
+        qp = AsyncQueueProcessor(mailer, self.queue_path, **kw)
+        qp.log = LoggerStub()
+        return qp
+
+    def _queue(self, count):
+        from email.message import Message
+        from repoze.sendmail.maildir import Maildir
+        maildir = Maildir(self.queue_path, True)
+        for i in range(count):
+            message = Message()
+            message.set_payload('Body %d' % i)
+            maildir.add(message, [
+                ('X-Actually-From', 'foo@example.com'),
+                ('X-Actually-To', 'bar%d@example.com' % i)]).commit()
+
+    def _queued(self):
+        return sorted(os.listdir(os.path.join(self.queue_path, 'new')))
+
+    def test_send_messages(self):
+        mailer = _AsyncMailerStub(self)
+        qp = self._makeOne(mailer, concurrency=2)
+        self._queue(5)
+        self._run(qp.send_messages())
+        self.assertEqual(sorted(t for f, t, m in mailer.sent),
+                         [('bar%d@example.com' % i,) for i in range(5)])
+        self.assertTrue(b'X-Actually' not in mailer.sent[0][2])
+        self.assertEqual(mailer.peak, 2)
+        self.assertEqual(self._queued(), [])
+        self.assertEqual(len(qp.log.infos), 5)
+        self.assertEqual(qp.log.errors, [])
+
+    def test_send_messages_empty(self):
+        qp = self._makeOne(_AsyncMailerStub(self))
+        self._run(qp.send_messages())
+
+    def test_stop(self):
+        mailer = _AsyncMailerStub(self)
+        qp = self._makeOne(mailer, concurrency=1)
+        self._queue(3)
+        qp.stop()
+        self._run(qp.send_messages())
+        self.assertEqual(mailer.sent, [])
+        self.assertEqual(len(self._queued()), 3)
+
+    def test_claimed_elsewhere(self):
+        self._queue(1)
+        filename = os.path.join(self.queue_path, 'new', self._queued()[0])
+        os.link(filename, os.path.join(self.queue_path, 'new',
+                                       '.sending-' + self._queued()[0]))
+        mailer = _AsyncMailerStub(self)
+        qp = self._makeOne(mailer)
+        self._run(qp.send_messages())
+        self.assertEqual(mailer.sent, [])
+
+    def test_permanent_error(self):
+        mailer = _AsyncMailerStub(self, smtplib.SMTPResponseException(
+            550, 'Serious Error'))
+        qp = self._makeOne(mailer)
+        self._queue(1)
+        name = self._queued()[0]
+        self._run(qp.send_messages())
+        self.assertEqual(self._queued(), ['.rejected-' + name])
+        self.assertEqual(len(qp.log.errors), 1)
+
+    def test_transient_error(self):
+        mailer = _AsyncMailerStub(self, smtplib.SMTPResponseException(
+            451, 'Try later'))
+        qp = self._makeOne(mailer)
+        self._queue(1)
+        name = self._queued()[0]
+        self._run(qp.send_messages())
+        self.assertTrue(name in self._queued())
+        self.assertEqual(len(qp.log.errors), 1)
+        self.assertEqual(qp.log.errors[0][1][1], 'bar0@example.com')
+
+    def test_transient_error_ignored(self):
+        mailer = _AsyncMailerStub(self, smtplib.SMTPResponseException(
+            451, 'Try later'))
+        qp = self._makeOne(mailer, ignore_transient=True)
+        self._queue(1)
+        name = self._queued()[0]
+        self._run(qp.send_messages())
+        self.assertTrue(name in self._queued())
+        self.assertEqual(qp.log.errors, [])
+
+    def test_transient_error_w_retry(self):
+        from repoze.sendmail.queue import RetryPolicy
+        from repoze.sendmail.queue import retry_info
+        mailer = _AsyncMailerStub(self, smtplib.SMTPResponseException(
+            451, 'Try later'))
+        qp = self._makeOne(mailer, retry=RetryPolicy(jitter=0))
+        self._queue(1)
+        self._run(qp.send_messages())
+        self.assertEqual(self._queued(), [])
+        cur = os.path.join(self.queue_path, 'cur')
+        names = os.listdir(cur)
+        self.assertEqual(len(names), 1)
+        self.assertEqual(retry_info(names[0])[0], 1)
+        # not due yet
+        mailer.error = None
+        self._run(qp.send_messages())
+        self.assertEqual(mailer.sent, [])
+        self.assertEqual(os.listdir(cur), names)
+
+    def test_deferred_recipients(self):
+        from repoze.sendmail.mx import DeferredRecipients
+        mailer = _AsyncMailerStub(self, DeferredRecipients(
+            {'bar0@example.com': (451, 'Try later')}))
+        qp = self._makeOne(mailer)
+        self._queue(1)
+        name = self._queued()[0]
+        self._run(qp.send_messages())
+        self.assertTrue(name in self._queued())
+        self.assertEqual(qp.log.errors, [])
+
+    def test_rate_limit(self):
+        from repoze.sendmail.ratelimit import RateLimiter
+        limiter = RateLimiter(rate=100, burst=1)
+        def sleep(seconds): #pragma NO COVER
+            self.fail('blocked the event loop')
+        limiter.sleep = sleep
+        waits = []
+        reserve = limiter.reserve
+        def _reserve(*args):
+            waits.append(reserve(*args))
+            return waits[-1]
+        limiter.reserve = _reserve
+        mailer = _AsyncMailerStub(self)
+        qp = self._makeOne(mailer, concurrency=3, rate_limit=limiter)
+        self._queue(3)
+        self._run(qp.send_messages())
+        self.assertEqual(len(mailer.sent), 3)
+        self.assertEqual(self._queued(), [])
+        self.assertEqual(len(waits), 3)
+        self.assertTrue(max(waits) > 0)
+
+    def test_rate_limit_throttled(self):
+        from repoze.sendmail.ratelimit import RateLimiter
+        limiter = RateLimiter(rate=100, burst=1)
+        mailer = _AsyncMailerStub(self, smtplib.SMTPResponseException(
+            451, 'Slow down'))
+        qp = self._makeOne(mailer, rate_limit=limiter)
+        self._queue(1)
+        self._run(qp.send_messages())
+        self.assertEqual(limiter.bucket.rate, 50)
+
+    def test_shard(self):
+        from repoze.sendmail.queue import shard_of
+        self._queue(6)
+        names = self._queued()
+        mailer = _AsyncMailerStub(self)
+        qp = self._makeOne(mailer, shard=(1, 2), lease_timeout=3600)
+        self._run(qp.send_messages())
+        self.assertEqual(self._queued(),
+                         [name for name in names if shard_of(name, 2) == 2])
+        self.assertEqual(len(mailer.sent), 6 - len(self._queued()))
+        self.assertTrue(os.path.exists(
+            os.path.join(self.queue_path, 'shards', '1-of-2')))
+
+    def test_claim_rename(self):
+        mailer = _AsyncMailerStub(self)
+        qp = self._makeOne(mailer, claim='rename')
+        self._queue(2)
+        self._run(qp.send_messages())
+        self.assertEqual(len(mailer.sent), 2)
+        self.assertEqual(self._queued(), [])
+
+
+class _WriterStub(object):
+    closed = False
+    tls = None
+
+    def __init__(self, test):
+        self.test = test
+        self.written = []
+
+    def write(self, data):
+        self.written.append(data)
+
+    def drain(self):
+        return self.test._done()
+
+    def start_tls(self, context, server_hostname=None):
+        self.tls = (context, server_hostname)
+        return self.test._done()
+
+    def close(self):
+        self.closed = True
+
+    def lines(self):
+        return b''.join(self.written).split(b'\r\n')[:-1]
+
+
+class _ConnectionStub(object):
+
+    def __init__(self, running):
+        self.running = running
+
+    def sendmail(self, fromaddr, toaddrs, message):
+        import asyncio
+        return asyncio.sleep(0.01)
+
+    def quit(self):
+        import asyncio
+        self.running.pop()
+        return asyncio.sleep(0)
+
+
+class _AsyncMailerStub(object):
+    peak = 0
+
+    def __init__(self, test, error=None):
+        self.test = test
+        self.error = error
+        self.sent = []
+        self.running = 0
+
+    def send_raw(self, fromaddr, toaddrs, message):
+        self.running += 1
+        self.peak = max(self.peak, self.running)
+        future = self.test.loop.create_future()
+        def _done():
+            self.running -= 1
+            if self.error is not None:
+                future.set_exception(self.error)
+            else:
+                self.sent.append((fromaddr, toaddrs, message))
+                future.set_result(None)
+        self.test.loop.call_later(0.01, _done)
+        return future
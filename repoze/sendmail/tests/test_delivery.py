@@ -302,6 +302,83 @@ class TestMailDataManager(unittest.TestCase):
         self.assertEqual(mdm.tpc_phase, 0)
 
 
+class TestBatchMailDataManager(unittest.TestCase):
+
+    def _getTargetClass(self):
+        from repoze.sendmail.delivery import BatchMailDataManager
+        return BatchMailDataManager
+
+    def _makeOne(self, callable=object, onAbort=None):
+        return self._getTargetClass()(callable, onAbort)
+
+    def test_class_conforms_to_ISavepointDataManager(self):
+        from transaction.interfaces import ISavepointDataManager
+        from zope.interface.verify import verifyClass
+        verifyClass(ISavepointDataManager, self._getTargetClass())
+
+    def test_tpc_finish_ok(self):
+        _called = []
+        def _callable(items):
+            _called.append(list(items))
+        mdm = self._makeOne(_callable)
+        mdm.add(1)
+        mdm.add(2)
+        txn = DummyTransaction()
+        mdm.join_transaction(txn)
+        mdm.tpc_phase = 2
+        mdm.tpc_finish(txn)
+        self.assertEqual(_called, [[1, 2]])
+
+    def test_abort_w_onAbort(self):
+        _aborted = []
+        mdm = self._makeOne(onAbort=_aborted.extend)
+        mdm.add(1)
+        mdm.add(2)
+        txn = DummyTransaction()
+        mdm.join_transaction(txn)
+        mdm.abort(txn)
+        self.assertEqual(_aborted, [1, 2])
+
+    def test_savepoint_wo_transaction(self):
+        mdm = self._makeOne()
+        self.assertRaises(ValueError, mdm.savepoint)
+
+    def test_savepoint_rollback(self):
+        from transaction.interfaces import IDataManagerSavepoint
+        from zope.interface.verify import verifyObject
+        _aborted = []
+        mdm = self._makeOne(onAbort=_aborted.extend)
+        mdm.add(1)
+        txn = DummyTransaction()
+        mdm.join_transaction(txn)
+        sp = mdm.savepoint()
+        verifyObject(IDataManagerSavepoint, sp)
+        mdm.add(2)
+        mdm.add(3)
+        sp.rollback()
+        self.assertEqual(mdm.items, [1])
+        self.assertEqual(_aborted, [2, 3])
+        sp.rollback()
+        self.assertEqual(_aborted, [2, 3])
+
+    def test_savepoint_rollback_wo_onAbort(self):
+        mdm = self._makeOne()
+        txn = DummyTransaction()
+        mdm.join_transaction(txn)
+        sp = mdm.savepoint()
+        mdm.add(1)
+        sp.rollback()
+        self.assertEqual(mdm.items, [])
+
+    def test_abort_drops_items(self):
+        mdm = self._makeOne()
+        mdm.add(1)
+        txn = DummyTransaction()
+        mdm.join_transaction(txn)
+        mdm.abort(txn)
+        self.assertEqual(mdm.items, [])
+
+
 class TestAbstractMailDelivery(unittest.TestCase):
 
     def _getTargetClass(self):
@@ -386,6 +463,25 @@ class TestDirectMailDelivery(unittest.TestCase):
         mailer = _makeMailerStub()
         delivery = self._makeOne(mailer)
         self.assertEqual(delivery.mailer, mailer)
+        self.assertEqual(delivery.header_cache, None)
+
+    def test_ctor_w_header_cache(self):
+        from repoze.sendmail.encoding import HeaderCache
+        cache = HeaderCache()
+        delivery = self._getTargetClass()(None, header_cache=cache)
+        self.assertTrue(delivery.header_cache is cache)
+
+    def test_send_w_rate_limit(self):
+        import transaction
+        from email.message import Message
+        mailer = _makeMailerStub()
+        limiter = _RateLimiterStub()
+        delivery = self._getTargetClass()(mailer, rate_limit=limiter)
+        delivery.send('me@example.com', ('you@example.com',), Message())
+        self.assertEqual(limiter.sent, [])
+        transaction.commit()
+        self.assertEqual(limiter.sent, [('you@example.com',)])
+        self.assertEqual(len(mailer.sent_messages), 1)
 
     def test_send(self):
         from repoze.sendmail.delivery import DirectMailDelivery
@@ -430,6 +526,64 @@ class TestDirectMailDelivery(unittest.TestCase):
         transaction.abort()
         self.assertEqual(mailer.sent_messages, [])
 
+    def test_send_raw(self):
+        import transaction
+        from repoze.sendmail.tests.test_queue import _makeRawMailerStub
+        mailer = _makeRawMailerStub()
+        delivery = self._makeOne(mailer)
+        toaddrs = ('guido@example.com',)
+        message = (b'Subject: example\r\n'
+                   b'message-id:  <20030519.1234@example.org>\r\n'
+                   b'\r\n'
+                   b'Message-Id: <not@the.header>\r\n')
+        msgid = delivery.send_raw('jim@example.com', toaddrs, message)
+        self.assertEqual(msgid, '<20030519.1234@example.org>')
+        self.assertEqual(mailer.sent_raw, [])
+        transaction.commit()
+        self.assertEqual(mailer.sent_raw,
+                         [('jim@example.com', toaddrs, message)])
+
+        mailer.sent_raw = []
+        msgid = delivery.send_raw('jim@example.com', toaddrs,
+                                  b'Subject: example\n\nMessage-Id: no\n')
+        self.assertEqual(msgid, None)
+        transaction.abort()
+        self.assertEqual(mailer.sent_raw, [])
+
+    def test_send_raw_not_bytes(self):
+        from email.message import Message
+        delivery = self._makeOne(_makeMailerStub())
+        self.assertRaises(ValueError, delivery.send_raw, 'jim@example.com',
+                          ('guido@example.com',), Message())
+
+    def test_send_raw_batch_w_rate_limit(self):
+        import transaction
+        from repoze.sendmail.tests.test_queue import _makeRawMailerStub
+        mailer = _makeRawMailerStub()
+        limiter = _RateLimiterStub()
+        delivery = self._getTargetClass()(mailer, batch=True,
+                                          rate_limit=limiter)
+        messages = [b'Subject: One\n\n', b'Subject: Two\n\n']
+        for message in messages:
+            delivery.send_raw('jim@example.com', ('guido@example.com',),
+                              message)
+        transaction.commit()
+        self.assertEqual([m for f, t, m in mailer.sent_raw], messages)
+        self.assertEqual(len(limiter.sent), 2)
+
+    def test_send_batch_w_savepoint_before_join(self):
+        import transaction
+        from email.message import Message
+        mailer = _makeMailerStub()
+        delivery = self._getTargetClass()(mailer, batch=True)
+        first, second = Message(), Message()
+        savepoint = transaction.savepoint()
+        delivery.send('jim@example.com', ('guido@example.com',), first)
+        savepoint.rollback()
+        delivery.send('jim@example.com', ('guido@example.com',), second)
+        transaction.commit()
+        self.assertEqual([m for f, t, m in mailer.sent_messages], [second])
+
     def test_send_returns_messageId(self):
         from repoze.sendmail.delivery import DirectMailDelivery
         from email.message import Message
@@ -487,6 +641,56 @@ class TestDirectMailDelivery(unittest.TestCase):
         self.assertEqual(len(mailer.sent_messages), 0)
 
 
+    def test_send_batch(self):
+        import transaction
+        from email.message import Message
+        from repoze.sendmail.delivery import BatchMailDataManager
+        from repoze.sendmail.delivery import DirectMailDelivery
+        mailer = _makeMailerStub()
+        delivery = DirectMailDelivery(mailer, batch=True)
+        messages = [Message() for i in range(3)]
+        for message in messages:
+            delivery.send('jim@example.com', ('guido@example.com',), message)
+        resources = transaction.get()._resources
+        self.assertEqual(len(resources), 1)
+        self.assertTrue(isinstance(resources[0], BatchMailDataManager))
+        self.assertEqual(mailer.sent_messages, [])
+        transaction.commit()
+        self.assertEqual([m for f, t, m in mailer.sent_messages], messages)
+
+        delivery.send('jim@example.com', ('guido@example.com',), Message())
+        transaction.abort()
+        self.assertEqual(len(mailer.sent_messages), 3)
+
+    def test_send_batch_w_session(self):
+        import transaction
+        from email.message import Message
+        from repoze.sendmail.delivery import DirectMailDelivery
+        mailer = _makeMailerStub()
+        sessions = []
+        class Session(object):
+            def __init__(self):
+                self.sent = []
+                self.closed = False
+                sessions.append(self)
+            def __enter__(self):
+                return self
+            def __exit__(self, *exc_info):
+                self.closed = True
+            def send(self, fromaddr, toaddrs, message):
+                self.sent.append(message)
+        mailer.session = Session
+        delivery = DirectMailDelivery(mailer, batch=True)
+        messages = [Message() for i in range(3)]
+        for message in messages:
+            delivery.send('jim@example.com', ('guido@example.com',), message)
+        transaction.commit()
+        self.assertEqual(len(sessions), 1)
+        self.assertEqual(sessions[0].sent, messages)
+        self.assertTrue(sessions[0].closed)
+        self.assertEqual(mailer.sent_messages, [])
+
+
 class TestQueuedMailDelivery(unittest.TestCase):
 
     def setUp(self):
@@ -498,6 +702,7 @@ class TestQueuedMailDelivery(unittest.TestCase):
     def tearDown(self):
         self.mail_delivery_module.Maildir = self.old_Maildir
         MaildirMessageStub.commited_messages = []
+        MaildirMessageStub.commited_headers = []
         MaildirMessageStub.aborted_messages = []
 
     def _getTargetClass(self):
@@ -531,9 +736,30 @@ class TestQueuedMailDelivery(unittest.TestCase):
     def test_ctor(self):
         delivery = self._makeOne('/path/to/mailbox')
         self.assertEqual(delivery.queuePath, '/path/to/mailbox')
+        self.assertEqual(delivery.durability, 'none')
+
+    def test_send_w_durability(self):
+        from repoze.sendmail import delivery as mail_delivery_module
+        made = []
+        def _Maildir(path, create=False, **kw):
+            maildir = MaildirStub(path, create, **kw)
+            made.append(maildir)
+            return maildir
+        mail_delivery_module.Maildir = _Maildir
+        delivery = self._getTargetClass()('/path/to/mailbox',
+                                          durability='full',
+                                          group_commit=0.01)
+        delivery.send('jim@example.com', ('guido@example.com',),
+                      self._makeMessage())
+        self.assertEqual(made[0].kw,
+                         {'durability': 'full', 'group_commit': 0.01})
+        import transaction
+        transaction.abort()
 
     def test_send(self):
         import transaction
+        from email.header import decode_header
+        from email.header import make_header
         from repoze.sendmail.delivery import QueuedMailDelivery
         from repoze.sendmail._compat import text_type
         delivery = QueuedMailDelivery('/path/to/mailbox')
@@ -549,12 +775,18 @@ class TestQueuedMailDelivery(unittest.TestCase):
         transaction.commit()
         self.assertEqual(len(MaildirMessageStub.commited_messages), 1)
         self.assertEqual(MaildirMessageStub.aborted_messages, [])
-        message = MaildirMessageStub.commited_messages[0]
-        self.assertEqual(text_type(message['X-Actually-From']), fromaddr)
-        self.assertEqual(text_type(
-            message['X-Actually-To']), ','.join(toaddrs))
+        queued = MaildirMessageStub.commited_messages[0]
+        self.assertTrue(queued is message)
+        self.assertEqual(message['X-Actually-From'], None)
+        self.assertEqual(message['X-Actually-To'], None)
+        headers = dict(MaildirMessageStub.commited_headers[0])
+        self.assertEqual(text_type(make_header(decode_header(
+            headers['X-Actually-From']))), fromaddr)
+        self.assertEqual(text_type(make_header(decode_header(
+            headers['X-Actually-To']))), ','.join(toaddrs))
 
         MaildirMessageStub.commited_messages = []
+        MaildirMessageStub.commited_headers = []
         message = self._makeMessage()
         msgid = delivery.send(fromaddr, toaddrs, message)
         self.assertTrue('@' in msgid)
@@ -578,6 +810,52 @@ class TestQueuedMailDelivery(unittest.TestCase):
         self.assertEqual(len(MaildirMessageStub.aborted_messages), 1)
 
 
+    def test_send_batch(self):
+        import transaction
+        from repoze.sendmail.delivery import QueuedMailDelivery
+        delivery = QueuedMailDelivery('/path/to/mailbox', batch=True)
+        messages = [self._makeMessage() for i in range(3)]
+        for message in messages:
+            delivery.send('jim@example.com', ('guido@example.com',), message)
+        self.assertEqual(len(transaction.get()._resources), 1)
+        transaction.commit()
+        self.assertEqual(MaildirMessageStub.commited_messages, messages)
+
+        delivery.send('jim@example.com', ('guido@example.com',), messages[0])
+        delivery.send('jim@example.com', ('guido@example.com',), messages[1])
+        transaction.abort()
+        self.assertEqual(MaildirMessageStub.aborted_messages, messages[:2])
+
+    def test_send_batch_w_savepoint(self):
+        import transaction
+        from repoze.sendmail.delivery import QueuedMailDelivery
+        delivery = QueuedMailDelivery('/path/to/mailbox', batch=True)
+        messages = [self._makeMessage() for i in range(3)]
+        delivery.send('jim@example.com', ('guido@example.com',), messages[0])
+        savepoint = transaction.savepoint()
+        delivery.send('jim@example.com', ('guido@example.com',), messages[1])
+        savepoint.rollback()
+        delivery.send('jim@example.com', ('guido@example.com',), messages[2])
+        transaction.commit()
+        self.assertEqual(MaildirMessageStub.aborted_messages, [messages[1]])
+        self.assertEqual(MaildirMessageStub.commited_messages,
+                         [messages[0], messages[2]])
+
+    def test_send_batch_w_savepoint_before_join(self):
+        import transaction
+        from repoze.sendmail.delivery import QueuedMailDelivery
+        delivery = QueuedMailDelivery('/path/to/mailbox', batch=True)
+        messages = [self._makeMessage() for i in range(2)]
+        savepoint = transaction.savepoint()
+        delivery.send('jim@example.com', ('guido@example.com',), messages[0])
+        savepoint.rollback()
+        delivery.send('jim@example.com', ('guido@example.com',), messages[1])
+        self.assertEqual(len(transaction.get()._resources), 1)
+        transaction.commit()
+        self.assertEqual(MaildirMessageStub.aborted_messages, [messages[0]])
+        self.assertEqual(MaildirMessageStub.commited_messages, [messages[1]])
+
+
 class TestQueuedMailDeliveryWithMaildir(unittest.TestCase):
 
     def setUp(self):
@@ -627,19 +905,135 @@ class TestQueuedMailDeliveryWithMaildir(unittest.TestCase):
         self.assertEqual(queued_fromaddr, fromaddr)
         self.assertEqual(queued_toaddrs, toaddrs)
 
+    def test_send_w_header_cache(self):
+        from email.message import Message
+        import transaction
+        from repoze.sendmail.encoding import HeaderCache
+        cache = HeaderCache()
+        delivery = self._getTargetClass()(self.maildir_path,
+                                          header_cache=cache)
+        for i in range(3):
+            message = Message()
+            message['Subject'] = u'Caf\xe9'
+            delivery.send('jim@example.com', ('guido@example.com',), message)
+        transaction.commit()
+        self.assertEqual((cache.hits, cache.misses), (2, 1))
+        self.qp.send_messages()
+        self.assertEqual(len(self.qp.mailer.sent_messages), 3)
+
+    def test_send_marks_queued_message_clean(self):
+        from email.message import Message
+        import transaction
+        from repoze.sendmail.encoding import is_cleaned
+        delivery = self._makeOne(self.maildir_path)
+        message = Message()
+        message['Subject'] = 'Hello'
+        delivery.send('jim@example.com', ('guido@example.com',), message)
+        # the caller may still change its message
+        self.assertFalse(is_cleaned(message))
+        transaction.commit()
+        self.qp.send_messages()
+        queued_message = self.qp.mailer.sent_messages[0][2]
+        self.assertTrue(is_cleaned(queued_message))
+        self.assertEqual(queued_message['X-Actually-Cleaned'], None)
+        self.assertEqual(queued_message['Subject'], 'Hello')
+
+    def test_send_raw(self):
+        import transaction
+        from repoze.sendmail.tests.test_queue import _makeRawMailerStub
+        delivery = self._makeOne(self.maildir_path)
+        self.qp.mailer = _makeRawMailerStub()
+        message = b'Subject: Hello\nMessage-Id: <1@example.com>\n\nBody\n'
+        msgid = delivery.send_raw('jim@example.com', ('guido@example.com',),
+                                  message)
+        self.assertEqual(msgid, '<1@example.com>')
+        transaction.commit()
+        self.qp.send_messages()
+        self.assertEqual(self.qp.mailer.sent_raw,
+                         [('jim@example.com', ('guido@example.com',),
+                           message)])
+
+    def test_send_raw_parsed(self):
+        import transaction
+        from repoze.sendmail.encoding import is_cleaned
+        delivery = self._makeOne(self.maildir_path)
+        delivery.send_raw('jim@example.com', ('guido@example.com',),
+                          b'Subject: Hello\n\nBody\n')
+        transaction.commit()
+        self.qp.send_messages()
+        queued_message = self.qp.mailer.sent_messages[0][2]
+        self.assertTrue(is_cleaned(queued_message))
+        self.assertEqual(queued_message['Subject'], 'Hello')
+        self.assertEqual(queued_message.get_payload(), 'Body\n')
+
+    def test_send_batch(self):
+        import os
+        from email.message import Message
+        import transaction
+        delivery = self._getTargetClass()(self.maildir_path,
+                                          durability='full', batch=True)
+        for i in range(3):
+            delivery.send('jim@example.com', ('guido@example.com',),
+                          Message())
+        self.assertEqual(len(os.listdir(os.path.join(self.maildir_path,
+                                                     'tmp'))), 3)
+        transaction.commit()
+        self.assertFalse(os.listdir(os.path.join(self.maildir_path, 'tmp')))
+        self.assertEqual(len(os.listdir(os.path.join(self.maildir_path,
+                                                     'new'))), 3)
+        self.qp.send_messages()
+        self.assertEqual(len(self.qp.mailer.sent_messages), 3)
+
+    def test_send_w_non_ASCII_addrs_raw(self):
+        from email import message_from_string
+        from email.mime import base
+        import transaction
+        from repoze.sendmail._compat import b
+        from repoze.sendmail.tests.test_queue import _makeRawMailerStub
+        delivery = self._makeOne(self.maildir_path)
+        self.qp.mailer = _makeRawMailerStub()
+
+        non_ascii = b('LaPe\xc3\xb1a').decode('utf-8')
+        fromaddr = non_ascii + ' <jim@example.com>'
+        toaddrs = (non_ascii + ' <guido@recip.com>',)
+        message = base.MIMEBase('text', 'plain')
+        message['From'] = fromaddr
+        message['To'] = ','.join(toaddrs)
+        message.set_payload('Body')
+
+        delivery.send(fromaddr, toaddrs, message)
+        transaction.commit()
+        self.qp.send_messages()
+
+        self.assertEqual(len(self.qp.mailer.sent_raw), 1)
+        queued_fromaddr, queued_toaddrs, queued_message = (
+            self.qp.mailer.sent_raw[0])
+        self.assertEqual(queued_fromaddr, fromaddr)
+        self.assertEqual(queued_toaddrs, toaddrs)
+        self.assertFalse(b('X-Actually') in queued_message)
+        parsed = message_from_string(queued_message.decode('ascii'))
+        # The generated Message-Id may be long enough to be folded.
+        self.assertEqual(parsed['Message-Id'].strip(), message['Message-Id'])
+        self.assertEqual(parsed.get_payload(), 'Body')
+
 
 class MaildirMessageStub(object):
     message = None
     commited_messages = []  # this list is shared among all instances
-    aborted_messages = []   # this one too
+    commited_headers = []   # this one too
+    aborted_messages = []   # and this one
     _closed = False
 
-    def __init__(self, message):
+    def __init__(self, message, headers=()):
         self.message = message
+        self.headers = headers
+
+    _sync = None
 
-    def commit(self):
+    def commit(self, sync=True):
         self._commited = True
         self.commited_messages.append(self.message)
+        self.commited_headers.append(self.headers)
 
     def abort(self):
         self._aborted = True
@@ -648,21 +1042,32 @@ class MaildirMessageStub(object):
 
 class MaildirStub(object):
 
-    def __init__(self, path, create=False):
+    def __init__(self, path, create=False, **kw):
         self.path = path
         self.create = create
+        self.kw = kw
         self.msgs = []
         self.files = []
 
     def __iter__(self):
         return iter(self.files)
 
-    def add(self, message):
-        m = MaildirMessageStub(message)
+    def add(self, message, headers=()):
+        m = MaildirMessageStub(message, headers)
         self.msgs.append(m)
         return m
 
 
+class _RateLimiterStub(object):
+
+    def __init__(self):
+        self.sent = []
+
+    def send(self, send, fromaddr, toaddrs, message):
+        self.sent.append(toaddrs)
+        return send(fromaddr, toaddrs, message)
+
+
 def _makeMailerStub(*args, **kw):
     from zope.interface import implementer
     from repoze.sendmail.interfaces import IMailer
@@ -71,6 +71,21 @@ class TestEncoding(unittest.TestCase):
         self.assertTrue(b('From: ') + from_.encode('ascii') in encoded)
         self.assertTrue(b('Subject: ') + subject.encode('ascii') in encoded)
 
+    def test_encoding_ascii_headers_untouched(self):
+        from repoze.sendmail._compat import b
+        message = self._makeMessage()
+        message['Received'] = 'from a'
+        message['Received'] = 'from b'
+        message['Cc'] = 'chrism@example.com (Chris)'
+        message['Subject'] = 'I know what you did last PyCon ' * 5
+
+        encoded = self._callFUT(message)
+
+        self.assertEqual(message.get_all('Received'), ['from a', 'from b'])
+        self.assertTrue(b('Cc: chrism@example.com (Chris)\n') in encoded)
+        for line in encoded.splitlines():
+            self.assertTrue(len(line) <= 78, line)
+
     def test_encoding_latin_1_headers(self):
         from repoze.sendmail._compat import b
         latin_1_encoded = b('LaPe\xf1a')
@@ -278,3 +293,236 @@ class TestEncoding(unittest.TestCase):
         self.assertEqual(
             encoded.count(quopri.encodestring(plain_string.encode('latin_1'))),
             2)
+
+    def test_cleaned_message_not_cleaned_again(self):
+        from email.mime import multipart
+        from email.mime import text
+        from repoze.sendmail import encoding
+        from repoze.sendmail.encoding import cleanup_message
+        from repoze.sendmail.encoding import is_cleaned
+        from repoze.sendmail.encoding import mark_cleaned
+
+        message = multipart.MIMEMultipart('alternative')
+        message['To'] = 'Chris <chrism@example.com>'
+        message.attach(text.MIMEText('Plain'))
+        self.assertFalse(is_cleaned(message))
+        mark_cleaned(cleanup_message(message))
+        self.assertTrue(is_cleaned(message))
+
+        calls = []
+        original = encoding.cleanup_message
+        def _cleanup(message, *args):
+            calls.append(message)
+            return original(message, *args)
+        encoding.cleanup_message = _cleanup
+        try:
+            encoded = self._callFUT(message)
+            self.assertEqual(calls, [])
+            self._callFUT(self._makeMessage())
+            self.assertEqual(len(calls), 1)
+        finally:
+            encoding.cleanup_message = original
+        self.assertTrue(b'To: Chris <chrism@example.com>' in encoded)
+
+    def test_changed_after_cleanup(self):
+        # cleanup_message does not mark the message, which may change
+        # afterwards.
+        from email.message import Message
+        from repoze.sendmail.encoding import cleanup_message
+        from repoze.sendmail.encoding import is_cleaned
+        message = Message()
+        message['Subject'] = 'Hello'
+        cleanup_message(message)
+        self.assertFalse(is_cleaned(message))
+        message.set_payload(u'caf\xe9')
+        message['To'] = u'J\xf6rg <j@example.com>'
+        encoded = self._callFUT(message)
+        self.assertTrue(b'To: =?iso-8859-1?q?J=F6rg?= <j@example.com>'
+                        in encoded)
+        self.assertTrue(b'caf=E9' in encoded)
+
+
+class Test_encode_cleaned_message(unittest.TestCase):
+
+    def _callFUT(self, message):
+        from repoze.sendmail.encoding import encode_cleaned_message
+        return encode_cleaned_message(message)
+
+    def test_not_cleaned_up(self):
+        from email.message import Message
+        from repoze.sendmail.encoding import is_cleaned
+        message = Message()
+        message['Subject'] = 'Hello'
+        message.set_payload('Body')
+        self.assertEqual(self._callFUT(message),
+                         b'Subject: Hello\n\nBody')
+        self.assertFalse(is_cleaned(message))
+
+
+class Test_write_message(unittest.TestCase):
+
+    def _callFUT(self, message, chunk_size=64):
+        from repoze.sendmail.encoding import write_message
+        out = _ChunkRecorder()
+        written = write_message(message, out, chunk_size=chunk_size)
+        data = b''.join(out.chunks)
+        self.assertEqual(written, len(data))
+        for chunk in out.chunks:
+            self.assertTrue(len(chunk) <= chunk_size)
+        return data
+
+    def _assertSameAsEncoded(self, message):
+        import copy
+        from repoze.sendmail.encoding import encode_message
+        # encoding sets the boundaries, so both get the same ones
+        encoded = encode_message(message)
+        self.assertEqual(self._callFUT(copy.deepcopy(message)), encoded)
+        self.assertEqual(self._callFUT(message, 7), encoded)
+
+    def test_simple(self):
+        from email.message import Message
+        message = Message()
+        message['Subject'] = b'LaPe\xf1a'.decode('iso-8859-1')
+        message.set_payload('Body\n' * 100)
+        self._assertSameAsEncoded(message)
+
+    def test_crlf_payload(self):
+        from email.message import Message
+        message = Message()
+        message['Subject'] = 'Hello'
+        message.set_payload('Body\r\nmore\rend\n' * 10)
+        self._assertSameAsEncoded(message)
+
+    def test_nested_multipart(self):
+        from email.mime import application
+        from email.mime import message as mime_message
+        from email.mime import multipart
+        from email.mime import text
+        inner = multipart.MIMEMultipart('alternative')
+        inner.attach(text.MIMEText(b'mo \xe2\x82\xac'.decode('utf-8'),
+                                   'plain', 'utf-8'))
+        inner.attach(text.MIMEText('<p>Hi</p>', 'html'))
+        forwarded = text.MIMEText('Forwarded')
+        forwarded['Subject'] = 'Fwd'
+        message = multipart.MIMEMultipart('mixed')
+        message.preamble = 'This is a MIME message.'
+        message.epilogue = 'The end.'
+        message.attach(inner)
+        message.attach(application.MIMEApplication(b'\x00\xff' * 500))
+        message.attach(mime_message.MIMEMessage(forwarded))
+        message.attach(multipart.MIMEMultipart('mixed'))
+        self._assertSameAsEncoded(message)
+
+    def test_boundary_not_in_payload(self):
+        from email.generator import Generator
+        from email.mime import multipart
+        from email.mime import text
+        message = multipart.MIMEMultipart('mixed')
+        message.attach(text.MIMEText('--taken\n'))
+        boundaries = ['taken', 'free']
+        original = Generator.__dict__['_make_boundary']
+        Generator._make_boundary = classmethod(
+            lambda cls, text=None: boundaries.pop(0))
+        try:
+            encoded = self._callFUT(message)
+        finally:
+            Generator._make_boundary = original
+        self.assertEqual(message.get_boundary(), 'free')
+        self.assertTrue(encoded.endswith(b'\n--free--\n'))
+
+    def test_surrogates(self):
+        from email import message_from_bytes
+        message = message_from_bytes(
+            b'Content-Type: text/plain; charset="utf-8"\n'
+            b'Content-Transfer-Encoding: 8bit\n\n'
+            b'mo \xe2\x82\xac\n')
+        self._assertSameAsEncoded(message)
+
+
+class _ChunkRecorder(object):
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        assert isinstance(data, bytes)
+        self.chunks.append(data)
+
+
+class TestHeaderCache(unittest.TestCase):
+
+    def _makeOne(self, maxsize=1024):
+        from repoze.sendmail.encoding import HeaderCache
+        return HeaderCache(maxsize)
+
+    def _makeMessage(self, name):
+        from email.message import Message
+        message = Message()
+        message['From'] = name + ' <jim@example.com>'
+        message['Subject'] = name
+        message['X-Plain'] = 'plain'
+        return message
+
+    def test_bad_maxsize(self):
+        self.assertRaises(ValueError, self._makeOne, 0)
+
+    def test_cleanup_message_uses_cache(self):
+        from repoze.sendmail.encoding import cleanup_message
+        cache = self._makeOne()
+        latin_1 = b'LaPe\xf1a'.decode('iso-8859-1')
+        first = cleanup_message(self._makeMessage(latin_1),
+                                header_cache=cache)
+        self.assertEqual((cache.hits, cache.misses, len(cache)), (0, 2, 2))
+        second = cleanup_message(self._makeMessage(latin_1),
+                                 header_cache=cache)
+        self.assertEqual((cache.hits, cache.misses, len(cache)), (2, 2, 2))
+        self.assertEqual(first.items(), second.items())
+        self.assertEqual(second['From'],
+                         '=?iso-8859-1?q?LaPe=F1a?= <jim@example.com>')
+        uncached = cleanup_message(self._makeMessage(latin_1))
+        self.assertEqual(uncached.items(), second.items())
+
+    def test_least_recently_used_dropped(self):
+        cache = self._makeOne(2)
+        cache.get('Subject', u'\xe9 one')
+        cache.get('Subject', u'\xe9 two')
+        cache.get('Subject', u'\xe9 one')
+        cache.get('Subject', u'\xe9 three')
+        self.assertEqual(len(cache), 2)
+        self.assertEqual((cache.hits, cache.misses), (1, 3))
+        cache.get('Subject', u'\xe9 one')
+        cache.get('Subject', u'\xe9 two')
+        self.assertEqual((cache.hits, cache.misses), (2, 4))
+
+    def test_address_and_name_in_key(self):
+        cache = self._makeOne()
+        value = u'R\xe9my <remy@example.com>'
+        address = cache.get('To', value, True)
+        other = cache.get('Subject', value)
+        self.assertEqual(cache.misses, 2)
+        self.assertTrue(address.endswith('<remy@example.com>'))
+        self.assertNotEqual(address, other)
+
+    def test_clear(self):
+        cache = self._makeOne()
+        cache.get('Subject', u'\xe9')
+        cache.get('Subject', u'\xe9')
+        cache.clear()
+        self.assertEqual((cache.hits, cache.misses, len(cache)), (0, 0, 0))
+
+    def test_threads(self):
+        import threading
+        cache = self._makeOne(8)
+        results = []
+
+        def run():
+            for i in range(200):
+                results.append(cache.get('Subject', u'\xe9 %d' % (i % 16)))
+        threads = [threading.Thread(target=run) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(results), 800)
+        self.assertEqual(cache.hits + cache.misses, 800)
+        self.assertTrue(len(cache) <= 8)
@@ -77,6 +77,65 @@ class TestMaildir(unittest.TestCase):
         self.assertTrue(tx_message._pending_path,
                      '/path/to/maildir/tmp/1234500002.4242.myhostname.')
 
+    def test_add_w_headers(self):
+        from email.message import Message
+        from repoze.sendmail.maildir import Maildir
+        written = []
+        m = Maildir('/path/to/maildir')
+        message = Message()
+        message['Subject'] = 'Pants'
+        message.set_payload('Nice pants, mister!')
+        fdopen = self.fake_os_module.fdopen
+        def _fdopen(fd, mode='r', buffering=-1):
+            f = fdopen(fd, mode, buffering)
+            written.append(f)
+            return f
+        self.fake_os_module.fdopen = _fdopen
+        m.add(message, [('X-Actually-From', 'foo@example.com'),
+                        ('X-Actually-To', 'bar@example.com')])
+        self.assertEqual(written[0]._written,
+                         b'X-Actually-From: foo@example.com\n'
+                         b'X-Actually-To: bar@example.com\n'
+                         b'Subject: Pants\n'
+                         b'\n'
+                         b'Nice pants, mister!')
+        self.assertEqual(message.keys(), ['Subject'])
+
+    def test_ctor_bad_durability(self):
+        from repoze.sendmail.maildir import Maildir
+        self.assertRaises(ValueError, Maildir, '/path/to/maildir',
+                          durability='always')
+
+    def test_add_durability_none(self):
+        from email.message import Message
+        from repoze.sendmail.maildir import Maildir
+        m = Maildir('/path/to/maildir')
+        tx_message = m.add(Message())
+        tx_message.commit()
+        self.assertEqual(self.fake_os_module._synced, ())
+
+    def test_add_durability_file(self):
+        from email.message import Message
+        from repoze.sendmail.maildir import Maildir
+        m = Maildir('/path/to/maildir', durability='file')
+        tx_message = m.add(Message())
+        self.assertEqual(self.fake_os_module._synced,
+                         (tx_message._pending_path,))
+        tx_message.commit()
+        self.assertEqual(len(self.fake_os_module._synced), 1)
+
+    def test_add_durability_full(self):
+        from email.message import Message
+        from repoze.sendmail.maildir import Maildir
+        m = Maildir('/path/to/maildir', durability='full')
+        tx_message = m.add(Message())
+        tx_message.commit()
+        self.assertEqual(self.fake_os_module._synced,
+                         (tx_message._pending_path, '/path/to/maildir/new'))
+        self.assertEqual(self.fake_os_module._renamed_files,
+                         ((tx_message._pending_path,
+                           tx_message._committed_path),))
+
     def test_add_no_good_filenames(self):
         from email.message import Message
         from repoze.sendmail.maildir import Maildir
@@ -122,6 +181,22 @@ class TestMaildir(unittest.TestCase):
         self.assertRaises(RuntimeError, tx_msg.abort)
         self.assertRaises(RuntimeError, tx_msg.commit)
 
+    def test_commit_messages(self):
+        from repoze.sendmail.maildir import MaildirTransactionalMessage
+        from repoze.sendmail.maildir import commit_messages
+        synced = []
+        def _sync():
+            synced.append(len(self.fake_os_module._renamed_files))
+        tx_msgs = [MaildirTransactionalMessage(
+                        '/path/to/maildir/tmp/%d' % i,
+                        '/path/to/maildir/new/%d' % i, _sync)
+                   for i in range(3)]
+        commit_messages(tx_msgs)
+        self.assertEqual(len(self.fake_os_module._renamed_files), 3)
+        self.assertEqual(synced, [3])
+        for tx_msg in tx_msgs:
+            self.assertTrue(tx_msg._committed)
+
     def test_mx_msg_delete(self):
         from repoze.sendmail.maildir import MaildirTransactionalMessage
         filename1 = '/path/to/maildir/tmp/1234500002.4242.myhostname'
@@ -133,6 +208,217 @@ class TestMaildir(unittest.TestCase):
         self.assertEqual(self.fake_os_module._removed_files, (filename1,))
 
 
+class TestMaildirOrder(unittest.TestCase):
+
+    def setUp(self):
+        import os
+        import tempfile
+        self.tmpdir = tempfile.mkdtemp()
+        self.dir = os.path.join(self.tmpdir, 'Maildir')
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.tmpdir)
+
+    def _makeOne(self, order):
+        from repoze.sendmail.maildir import Maildir
+        return Maildir(self.dir, True, order=order)
+
+    def _write(self, subdir, name, mtime):
+        import os
+        path = os.path.join(self.dir, subdir, name)
+        with open(path, 'w'):
+            pass
+        os.utime(path, (mtime, mtime))
+        return path
+
+    def test_ctor_bad_order(self):
+        self.assertRaises(ValueError, self._makeOne, 'size')
+
+    def test_iteration_mtime(self):
+        m = self._makeOne('mtime')
+        first = self._write('cur', '1234500002.1.host.1', 10)
+        third = self._write('new', '1234500000.1.host.1', 30)
+        second = self._write('new', '1234500001.1.host.1', 20)
+        self._write('new', '.hidden', 5)
+        self.assertEqual(list(m), [first, second, third])
+
+    def test_iteration_name(self):
+        m = self._makeOne('name')
+        third = self._write('cur', '1234500002.1.host.1', 10)
+        first = self._write('new', '1234500000.1.host.1', 30)
+        second = self._write('new', 'foreign', 1234500001)
+        self._write('cur', '.hidden', 5)
+        self.assertEqual(list(m), [first, second, third])
+
+    def test_iteration_name_no_stat(self):
+        import os
+        from repoze.sendmail import maildir
+        m = self._makeOne('name')
+        self._write('new', '1234500001.1.host.1', 10)
+        self._write('cur', '1234500000.1.host.1', 10)
+        def _mtime(path, entry):
+            raise AssertionError('stat called for %s' % path)
+        old_mtime, maildir._mtime = maildir._mtime, _mtime
+        try:
+            self.assertEqual([os.path.basename(x) for x in m],
+                             ['1234500000.1.host.1', '1234500001.1.host.1'])
+        finally:
+            maildir._mtime = old_mtime
+
+    def test_iteration_filter_before_stat(self):
+        import os
+        from repoze.sendmail import maildir
+        m = self._makeOne('mtime')
+        kept = self._write('new', 'kept', 10)
+        self._write('cur', 'skipped', 10)
+        m.filter = lambda path: os.path.basename(path) != 'skipped'
+        stated = []
+        def _mtime(path, entry):
+            stated.append(path)
+            return 0
+        old_mtime, maildir._mtime = maildir._mtime, _mtime
+        try:
+            self.assertEqual(list(m), [kept])
+        finally:
+            maildir._mtime = old_mtime
+        self.assertEqual(stated, [kept])
+
+    def test_iteration_unordered_streams(self):
+        import types
+        m = self._makeOne(None)
+        first = self._write('new', 'a', 10)
+        second = self._write('cur', 'b', 5)
+        self._write('cur', '.hidden', 5)
+        messages = iter(m)
+        self.assertTrue(isinstance(messages, types.GeneratorType))
+        self.assertEqual(list(messages), [first, second])
+
+    def test_iteration_removed_while_sorting(self):
+        import os
+        m = self._makeOne('mtime')
+        gone = self._write('new', 'a', 10)
+        kept = self._write('new', 'b', 10)
+        messages = m._messages
+        def _messages():
+            for path, entry in messages():
+                if path == gone:
+                    os.remove(gone)
+                yield path, entry
+        m._messages = _messages
+        self.assertEqual(list(m), [kept])
+
+
+class TestDirectorySync(unittest.TestCase):
+
+    def setUp(self):
+        import repoze.sendmail.maildir as maildir_module
+        self.maildir_module = maildir_module
+        self.old_fsync_dir = maildir_module._fsync_dir
+        self.synced = []
+        maildir_module._fsync_dir = self._fsync_dir
+
+    def tearDown(self):
+        self.maildir_module._fsync_dir = self.old_fsync_dir
+
+    def _fsync_dir(self, path):
+        import time
+        time.sleep(0.02)
+        self.synced.append(path)
+
+    def _makeOne(self, window=0):
+        from repoze.sendmail.maildir import _DirectorySync
+        return _DirectorySync('/path/to/maildir/new', window)
+
+    def test_single(self):
+        sync = self._makeOne()
+        sync()
+        sync()
+        self.assertEqual(self.synced, ['/path/to/maildir/new'] * 2)
+
+    def test_group_commit(self):
+        import threading
+        sync = self._makeOne(window=0.05)
+        threads = [threading.Thread(target=sync) for i in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertTrue(1 <= len(self.synced) < 10)
+
+    def test_failure_is_retried(self):
+        sync = self._makeOne()
+        def _fsync_dir(path):
+            self.maildir_module._fsync_dir = self._fsync_dir
+            raise OSError('EIO')
+        self.maildir_module._fsync_dir = _fsync_dir
+        self.assertRaises(OSError, sync)
+        sync()
+        self.assertEqual(self.synced, ['/path/to/maildir/new'])
+
+    def test_shared(self):
+        from repoze.sendmail.maildir import _directory_sync
+        self.assertTrue(_directory_sync('/a', 0) is _directory_sync('/a', 0))
+        self.assertFalse(_directory_sync('/a', 0) is _directory_sync('/b', 0))
+
+    def test_fsync_dir(self):
+        import tempfile
+        import shutil
+        self.maildir_module._fsync_dir = self.old_fsync_dir
+        path = tempfile.mkdtemp()
+        try:
+            self.maildir_module._fsync_dir(path)
+        finally:
+            shutil.rmtree(path)
+
+
+class TestMaildirAdd(unittest.TestCase):
+
+    def setUp(self):
+        import tempfile
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.dir)
+
+    def test_add_writes_bytes(self):
+        import os
+        from email.mime import application
+        from email.mime import multipart
+        from repoze.sendmail.maildir import Maildir
+        from repoze.sendmail._compat import BytesGenerator
+        from repoze.sendmail._compat import from_octets
+        from io import BytesIO
+        message = multipart.MIMEMultipart()
+        message['Subject'] = 'Binary'
+        message.attach(application.MIMEApplication(
+            from_octets(range(256)) * 10))
+        expected = BytesIO()
+        BytesGenerator(expected).flatten(message)
+
+        m = Maildir(os.path.join(self.dir, 'Maildir'), True)
+        tx_message = m.add(message, [('X-Actually-To', 'bar@example.com')])
+        with open(tx_message._pending_path, 'rb') as f:
+            written = f.read()
+        self.assertEqual(written,
+                         b'X-Actually-To: bar@example.com\n' +
+                         expected.getvalue())
+        tx_message.abort()
+
+    def test_add_encoded(self):
+        import os
+        from repoze.sendmail.maildir import Maildir
+        message = b'Subject: Encoded\n\nBody\n'
+        m = Maildir(os.path.join(self.dir, 'Maildir'), True)
+        tx_message = m.add(message, [('X-Actually-To', 'bar@example.com')])
+        with open(tx_message._pending_path, 'rb') as f:
+            written = f.read()
+        self.assertEqual(written,
+                         b'X-Actually-To: bar@example.com\n' + message)
+        tx_message.abort()
+
+
 class FakeSocketModule(object):
 
     def gethostname(self):
@@ -205,6 +491,7 @@ class FakeOsModule(object):
     _made_directories = ()
     _removed_files = ()
     _renamed_files = ()
+    _synced = ()
 
     _all_files_exist = False
     _exception = None
@@ -216,6 +503,7 @@ class FakeOsModule(object):
         self.O_EXCL = os.O_EXCL
         self.O_WRONLY = os.O_WRONLY
         self.O_RDWR = os.O_RDWR
+        self.O_RDONLY = os.O_RDONLY
 
     def access(self, path, mode):
         modes = dict(_stat_files())
@@ -256,23 +544,30 @@ class FakeOsModule(object):
         self._descriptors[fd] = filename, flags, mode
         return fd
 
-    def fdopen(self, fd, mode='r'):
+    def fsync(self, fd):
+        self._synced += (self._descriptors[fd][0], )
+
+    def close(self, fd):
+        pass
+
+    def fdopen(self, fd, mode='r', buffering=-1):
         filename, flags, permissions = self._descriptors[fd]
-        if mode == 'w':
+        if mode == 'wb':
             assert flags & self.O_WRONLY
             assert not flags & self.O_RDWR
         else: #pragma NO COVERAGE defensive programming
             raise AssertionError("don't know how to verify if flags match"
                                  " mode %r" % mode)
-        return FakeFile(filename, mode)
+        return FakeFile(filename, mode, fd)
 
 
 class FakeFile(object):
 
-    def __init__(self, filename, mode):
+    def __init__(self, filename, mode, fd=None):
         self._filename = filename
         self._mode = mode
-        self._written = ''
+        self._fd = fd
+        self._written = b''
         self._closed = False
 
     def close(self):
@@ -281,6 +576,12 @@ class FakeFile(object):
     def write(self, data):
         self._written += data
 
+    def flush(self):
+        pass
+
+    def fileno(self):
+        return self._fd
+
     def __enter__(self):
         return self
 
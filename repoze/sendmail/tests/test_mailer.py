@@ -58,6 +58,68 @@ class TestSMTPMailer(unittest.TestCase):
         mailer, smtp = self._makeOne()
         self.assertRaises(ValueError, mailer.send, fromaddr, toaddrs, b'')
 
+    def test_send_raw(self):
+        mailer, smtp = self._makeOne()
+        fromaddr = 'me@example.com'
+        toaddrs = ('you@example.com', 'him@example.com')
+        msgtext = b'Headers: headers\n\nbodybodybody\n'
+        mailer.send_raw(fromaddr, toaddrs, msgtext)
+        self.assertEqual(len(smtp._inst), 1)
+        inst = smtp._inst[0]
+        self.assertEqual(inst.fromaddr, fromaddr)
+        self.assertEqual(inst.toaddrs, toaddrs)
+        self.assertEqual(inst.msgtext, msgtext)
+        self.assertTrue(inst.quitted)
+
+    def test_send_raw_w_rate_limit(self):
+        mailer, smtp = self._makeOne()
+        mailer.rate_limit = limiter = _RateLimiterStub()
+        mailer.send_raw('me@example.com', ('you@example.com',), b'Message')
+        self.assertEqual(limiter.calls,
+                         [('acquire', ('you@example.com',),
+                           ('localhost', 25)),
+                          ('succeeded', ('you@example.com',),
+                           ('localhost', 25))])
+        self.assertEqual(smtp._inst[0].msgtext, b'Message')
+
+    def test_destination(self):
+        mailer, smtp = self._makeOne()
+        self.assertTrue(mailer.fixed_destination)
+        self.assertEqual(mailer.destination(['a@x.com', 'b@y.com']), None)
+
+    def test_send_raw_w_rate_limit_connect_refused(self):
+        from smtplib import SMTPConnectError
+        from repoze.sendmail.ratelimit import RateLimiter
+        mailer, smtp = self._makeOne()
+        mailer.rate_limit = limiter = RateLimiter(rate=10, relay_rate=20)
+
+        def busy():
+            raise SMTPConnectError(421, 'Too many connections')
+        mailer.smtp_factory = busy
+        self.assertRaises(SMTPConnectError, mailer.send_raw,
+                          'me@example.com', ('you@example.com',), b'Message')
+        self.assertEqual(limiter.bucket.rate, 5)
+        self.assertEqual(limiter._relays[('localhost', 25)].rate, 10)
+
+    def test_send_raw_w_file(self):
+        from io import BytesIO
+        mailer, smtp = self._makeOne()
+        msgtext = b'Headers: headers\n\nbodybodybody\n'
+        mailer.send_raw('me@example.com', ('you@example.com',),
+                        BytesIO(msgtext))
+        self.assertEqual(smtp._inst[0].msgtext, msgtext)
+
+    def test_send_raw_w_non_bytes(self):
+        from email.message import Message
+        mailer, smtp = self._makeOne()
+        self.assertRaises(ValueError, mailer.send_raw,
+                          'me@example.com', ('you@example.com',), Message())
+
+    def test_class_conforms_to_IMailer(self):
+        from zope.interface.verify import verifyClass
+        from repoze.sendmail.interfaces import IMailer
+        verifyClass(IMailer, self._getTargetClass())
+
     def test_fail_ehlo(self):
         from email.message import Message
         mailer, smtp = self._makeOne(ehlo_status=100)
@@ -154,6 +216,148 @@ class TestSMTPMailer(unittest.TestCase):
         connection = mailer.smtp_factory()
         self.assertTrue(connection.debuglevel)
 
+    def test_send_pooled_reuses_connection(self):
+        from email.message import Message
+        mailer, smtp = self._makeOne()
+        mailer.pool = self._makePool()
+        fromaddr = 'me@example.com'
+        toaddrs = ('you@example.com', 'him@example.com')
+        msg = Message()
+        msg['Headers'] = 'headers'
+        msg.set_payload('bodybodybody\n-- \nsig\n')
+        mailer.send(fromaddr, toaddrs, msg)
+        mailer.send(fromaddr, toaddrs, msg)
+        self.assertEqual(len(smtp._inst), 1)
+        inst = smtp._inst[0]
+        self.assertEqual(inst.sent, 2)
+        self.assertEqual(inst.rsets, 1)
+        self.assertFalse(inst.quitted)
+        mailer.close()
+        self.assertTrue(inst.quitted)
+        self.assertTrue(inst.closed)
+
+    def test_send_pooled_replaces_dead_connection(self):
+        from email.message import Message
+        mailer, smtp = self._makeOne()
+        mailer.pool = self._makePool()
+        msg = Message()
+        mailer.send('me@example.com', ('you@example.com',), msg)
+        smtp._inst[0].fail_on_rset = True
+        mailer.send('me@example.com', ('you@example.com',), msg)
+        self.assertEqual(len(smtp._inst), 2)
+        self.assertTrue(smtp._inst[0].closed)
+        self.assertEqual(smtp._inst[0].sent, 1)
+        self.assertEqual(smtp._inst[1].sent, 1)
+
+    def test_send_pooled_max_messages(self):
+        from email.message import Message
+        mailer, smtp = self._makeOne()
+        mailer.pool = self._makePool(max_messages=2)
+        msg = Message()
+        for i in range(3):
+            mailer.send('me@example.com', ('you@example.com',), msg)
+        self.assertEqual(len(smtp._inst), 2)
+        self.assertTrue(smtp._inst[0].quitted)
+        self.assertEqual(smtp._inst[0].sent, 2)
+        self.assertEqual(smtp._inst[1].sent, 1)
+
+    def test_send_pooled_refused_keeps_connection(self):
+        import smtplib
+        from email.message import Message
+        mailer, smtp = self._makeOne()
+        mailer.pool = self._makePool()
+        msg = Message()
+        mailer.send('me@example.com', ('you@example.com',), msg)
+        inst = smtp._inst[0]
+        inst.sendmail_error = smtplib.SMTPRecipientsRefused({})
+        self.assertRaises(smtplib.SMTPRecipientsRefused, mailer.send,
+                          'me@example.com', ('you@example.com',), msg)
+        inst.sendmail_error = None
+        mailer.send('me@example.com', ('you@example.com',), msg)
+        self.assertEqual(len(smtp._inst), 1)
+
+    def test_send_pooled_disconnect_drops_connection(self):
+        import smtplib
+        from email.message import Message
+        mailer, smtp = self._makeOne()
+        mailer.pool = self._makePool()
+        msg = Message()
+        mailer.send('me@example.com', ('you@example.com',), msg)
+        inst = smtp._inst[0]
+        inst.sendmail_error = smtplib.SMTPServerDisconnected()
+        self.assertRaises(smtplib.SMTPServerDisconnected, mailer.send,
+                          'me@example.com', ('you@example.com',), msg)
+        self.assertTrue(inst.closed)
+        mailer.send('me@example.com', ('you@example.com',), msg)
+        self.assertEqual(len(smtp._inst), 2)
+
+    def test_session(self):
+        from email.message import Message
+        mailer, smtp = self._makeOne()
+        msg = Message()
+        with mailer.session() as session:
+            session.send('me@example.com', ('you@example.com',), msg)
+            session.send_raw('me@example.com', ('him@example.com',), b'')
+            inst = smtp._inst[0]
+            self.assertFalse(inst.quitted)
+        self.assertEqual(len(smtp._inst), 1)
+        self.assertEqual(inst.sent, 2)
+        self.assertEqual(inst.rsets, 0)
+        self.assertTrue(inst.quitted)
+
+    def test_session_w_non_message(self):
+        mailer, smtp = self._makeOne()
+        with mailer.session() as session:
+            self.assertRaises(ValueError, session.send,
+                              'me@example.com', ('you@example.com',), b'')
+        self.assertEqual(smtp._inst, [])
+
+    def test_session_reconnects_after_disconnect(self):
+        import smtplib
+        from email.message import Message
+        mailer, smtp = self._makeOne()
+        msg = Message()
+        with mailer.session() as session:
+            session.send('me@example.com', ('you@example.com',), msg)
+            inst = smtp._inst[0]
+            inst.sendmail_error = smtplib.SMTPServerDisconnected()
+            self.assertRaises(smtplib.SMTPServerDisconnected, session.send,
+                              'me@example.com', ('you@example.com',), msg)
+            self.assertTrue(inst.closed)
+            self.assertFalse(inst.quitted)
+            session.send('me@example.com', ('you@example.com',), msg)
+        self.assertEqual(len(smtp._inst), 2)
+        self.assertTrue(smtp._inst[1].quitted)
+
+    def test_session_pooled(self):
+        from email.message import Message
+        mailer, smtp = self._makeOne()
+        mailer.pool = self._makePool()
+        msg = Message()
+        for i in range(2):
+            with mailer.session() as session:
+                session.send('me@example.com', ('you@example.com',), msg)
+                session.send('me@example.com', ('you@example.com',), msg)
+        self.assertEqual(len(smtp._inst), 1)
+        inst = smtp._inst[0]
+        self.assertEqual(inst.sent, 4)
+        self.assertEqual(inst.rsets, 1)
+        self.assertFalse(inst.quitted)
+
+    def test_ctor_w_pool_size(self):
+        klass = self._getTargetClass()
+        mailer = klass(pool_size=3, pool_idle_timeout=5,
+                       pool_max_messages=10, pool_max_age=20)
+        self.assertEqual(mailer.pool.size, 3)
+        self.assertEqual(mailer.pool.idle_timeout, 5)
+        self.assertEqual(mailer.pool.max_messages, 10)
+        self.assertEqual(mailer.pool.max_age, 20)
+        self.assertEqual(klass().pool, None)
+
+    def _makePool(self, **kw):
+        from repoze.sendmail.mailer import SMTPConnectionPool
+        return SMTPConnectionPool(**kw)
+
 
 class TestSMTPMailerWithNoEHLO(TestSMTPMailer):
 
@@ -187,6 +391,110 @@ class TestSMTPMailerWithNoEHLO(TestSMTPMailer):
         pass
 
 
+class TestSMTPConnectionPool(unittest.TestCase):
+
+    def _makeOne(self, **kw):
+        from repoze.sendmail.mailer import SMTPConnectionPool
+        return SMTPConnectionPool(**kw)
+
+    def _connect(self):
+        return _makeSMTP()('localhost', '25')
+
+    def test_ctor_bad_size(self):
+        self.assertRaises(ValueError, self._makeOne, size=0)
+
+    def test_acquire_release_reuses(self):
+        pool = self._makeOne()
+        entry = pool.acquire('key', self._connect)
+        pool.release(entry)
+        self.assertTrue(pool.acquire('key', self._connect) is entry)
+
+    def test_acquire_other_key_opens_new(self):
+        pool = self._makeOne()
+        entry = pool.acquire('key', self._connect)
+        pool.release(entry)
+        other = pool.acquire('other', self._connect)
+        self.assertFalse(other is entry)
+        self.assertEqual(other.key, 'other')
+
+    def test_acquire_full_evicts_other_key(self):
+        pool = self._makeOne(size=1)
+        entry = pool.acquire('key', self._connect)
+        pool.release(entry)
+        other = pool.acquire('other', self._connect)
+        self.assertFalse(other is entry)
+        self.assertTrue(entry.connection.quitted)
+
+    def test_acquire_blocks_until_released(self):
+        import threading
+        pool = self._makeOne(size=1)
+        entry = pool.acquire('key', self._connect)
+        got = []
+        t = threading.Thread(
+            target=lambda: got.append(pool.acquire('key', self._connect)))
+        t.start()
+        t.join(0.05)
+        self.assertEqual(got, [])
+        pool.release(entry)
+        t.join(5)
+        self.assertEqual(got, [entry])
+
+    def test_acquire_idle_timeout(self):
+        pool = self._makeOne(idle_timeout=10)
+        entry = pool.acquire('key', self._connect)
+        pool.release(entry)
+        entry.last_used -= 11
+        other = pool.acquire('key', self._connect)
+        self.assertFalse(other is entry)
+        self.assertTrue(entry.connection.quitted)
+
+    def test_sweep(self):
+        pool = self._makeOne(idle_timeout=10)
+        old = pool.acquire('key', self._connect)
+        new = pool.acquire('other', self._connect)
+        self.assertEqual(pool.leased, 2)
+        pool.release(old)
+        pool.release(new)
+        self.assertEqual(pool.leased, 0)
+        old.last_used -= 11
+        pool.sweep()
+        self.assertTrue(old.connection.quitted)
+        self.assertFalse(new.connection.quitted)
+        self.assertTrue(pool.acquire('other', self._connect) is new)
+
+    def test_acquire_max_age(self):
+        pool = self._makeOne(max_age=10)
+        entry = pool.acquire('key', self._connect)
+        pool.release(entry)
+        entry.created -= 11
+        self.assertFalse(pool.acquire('key', self._connect) is entry)
+        self.assertTrue(entry.connection.quitted)
+
+    def test_release_max_messages(self):
+        pool = self._makeOne(max_messages=1)
+        entry = pool.acquire('key', self._connect)
+        entry.messages = 1
+        pool.release(entry)
+        self.assertTrue(entry.connection.quitted)
+        self.assertFalse(pool.acquire('key', self._connect) is entry)
+
+    def test_acquire_connect_fails(self):
+        pool = self._makeOne(size=1)
+        def _connect():
+            raise IOError('refused')
+        self.assertRaises(IOError, pool.acquire, 'key', _connect)
+        # the failed attempt must not use up the only slot
+        pool.acquire('key', self._connect)
+
+    def test_discard(self):
+        pool = self._makeOne(size=1)
+        entry = pool.acquire('key', self._connect)
+        pool.discard(entry)
+        self.assertTrue(entry.connection.closed)
+        self.assertFalse(entry.connection.quitted)
+        self.assertFalse(pool.acquire('key', self._connect) is entry)
+
+
 class TestSendmailMailer(unittest.TestCase):
 
     def _getTargetClass(self):
@@ -249,6 +557,97 @@ class TestSendmailMailer(unittest.TestCase):
         mailer = self._makeOne()
         self.assertRaises(ValueError, mailer.send, fromaddr, toaddrs, b'')
 
+    def test_send_raw(self):
+        from io import BytesIO
+        mailer = self._makeOne()
+        fromaddr = 'me@example.com'
+        toaddrs = ('you@example.com', 'him@example.com')
+        msgtext = b'Headers: headers\n\nbodybodybody\n'
+        mailer.send_raw(fromaddr, toaddrs, msgtext)
+        mailer.send_raw(fromaddr, toaddrs, BytesIO(msgtext))
+        self.assertEqual(len(mailer.popens), 2)
+        for p in mailer.popens:
+            self.assertEqual(p.inputs, [msgtext])
+            self.assertEqual(
+                ["/usr/sbin/sendmail", "-t", "-i", "-f", "me@example.com",
+                 "you@example.com", "him@example.com"], p.args[0])
+
+    def test_send_streams_message(self):
+        from email.message import Message
+        from repoze.sendmail.encoding import encode_message
+        mailer = self._makeOne()
+        msg = Message()
+        msg['Subject'] = 'Big'
+        msg.set_payload('line\n' * 100000)
+        mailer.send('me@example.com', ('you@example.com',), msg)
+        p = mailer.popens[0]
+        self.assertTrue(p.waited)
+        self.assertTrue(len(p.stdin.writes) > 1)
+        self.assertEqual(p.inputs, [encode_message(msg)])
+
+    def test_send_raw_broken_pipe(self):
+        import errno
+        import subprocess
+        mailer = self._makeOne(returncode=75)
+
+        def _popen(*args, **kw):
+            p = PopenStub(*args, returncode=75)
+            p.stdin.fail = IOError(errno.EPIPE, 'Broken pipe')
+            mailer.popens += (p,)
+            return p
+        mailer._popen = _popen
+        self.assertRaises(subprocess.CalledProcessError, mailer.send_raw,
+                          'me@example.com', ('you@example.com',), b'Message')
+        self.assertTrue(mailer.popens[0].waited)
+
+    def test_send_cleaned_up_before_popen(self):
+        from email.message import Message
+        mailer = self._makeOne()
+        msg = Message()
+        msg.set_payload(u'caf\xe9')
+        popen = mailer._popen
+        def _popen(*args, **kw):
+            self.assertEqual(msg.get_content_charset(), 'iso-8859-1')
+            return popen(*args, **kw)
+        mailer._popen = _popen
+        mailer.send('me@example.com', ('you@example.com',), msg)
+        self.assertTrue(b'caf=E9' in mailer.popens[0].inputs[0])
+
+    def test_send_write_fails(self):
+        from email.message import Message
+        from repoze.sendmail.encoding import mark_cleaned
+        mailer = self._makeOne()
+        msg = Message()
+        msg.set_payload(u'caf\xe9' * 100)
+        mark_cleaned(msg)  # wrongly
+        self.assertRaises(UnicodeError, mailer.send, 'me@example.com',
+                          ('you@example.com',), msg)
+        p = mailer.popens[0]
+        self.assertTrue(p.killed)
+        self.assertTrue(p.waited)
+        self.assertEqual(p.inputs, [])
+
+    def test_send_raw_read_fails(self):
+        import errno
+        mailer = self._makeOne()
+
+        class _File(object):
+            def read(self, size=-1):
+                raise IOError(errno.EIO, 'I/O error')
+
+        self.assertRaises(IOError, mailer.send_raw, 'me@example.com',
+                          ('you@example.com',), _File())
+        p = mailer.popens[0]
+        self.assertTrue(p.killed)
+        self.assertTrue(p.waited)
+        self.assertEqual(p.inputs, [])
+
+    def test_class_conforms_to_IMailer(self):
+        from zope.interface.verify import verifyClass
+        from repoze.sendmail.interfaces import IMailer
+        from repoze.sendmail.mailer import SendmailMailer
+        verifyClass(IMailer, SendmailMailer)
+
 
 class PopenStub(object):
 
@@ -257,14 +656,664 @@ class PopenStub(object):
         self.kw = kw
         self.inputs = []
         self.returncode = kw.get('returncode', 0)
+        self.stdin = _PipeStub(self.inputs)
+        self.waited = False
+        self.killed = False
+
+    def wait(self):
+        self.waited = True
+        return self.returncode
+
+    def kill(self):
+        # the input is not read any more
+        self.killed = True
+        self.stdin.inputs = []
+
+
+class _PipeStub(object):
 
-    def communicate(self, input):
-        # 'input' must be bytes.  See:
-        # http://docs.python.org/3/library/subprocess.html
-        #                                    #subprocess.Popen.communicate
-        assert isinstance(input, bytes)
-        self.inputs.append(input)
-        return '', ''
+    def __init__(self, inputs, fail=None):
+        self.inputs = inputs
+        self.writes = []
+        self.fail = fail
+
+    def write(self, data):
+        # only bytes may be written to the pipe
+        assert isinstance(data, bytes)
+        if self.fail is not None:
+            raise self.fail
+        self.writes.append(data)
+
+    def close(self):
+        self.inputs.append(b''.join(self.writes))
+
+
+class TestSMTPMailerPipelining(unittest.TestCase):
+
+    def _makeOne(self, replies, extns=('pipelining', 'size'), **kw):
+        from repoze.sendmail.mailer import SMTPMailer
+        mailer = SMTPMailer(**kw)
+        smtp = _makeSMTP(extns=set(extns))
+        class PipeliningSMTP(smtp):
+            def __init__(self, *args, **kw):
+                smtp.__init__(self, *args, **kw)
+                self.replies = list(replies)
+                self.written = []
+                self.rsets = 0
+            def send(self, data):
+                if not isinstance(data, bytes):
+                    data = data.encode('ascii')
+                self.written.append(data)
+            def getreply(self):
+                from smtplib import SMTPServerDisconnected
+                if not self.replies:
+                    raise SMTPServerDisconnected('Connection unexpectedly '
+                                                 'closed')
+                return self.replies.pop(0)
+        mailer.smtp = PipeliningSMTP
+        return mailer, smtp
+
+    def _send(self, mailer, toaddrs=('you@example.com', 'him@example.com'),
+              message=b'Subject: hi\n\n.dot\n'):
+        mailer.send_raw('me@example.com', toaddrs, message)
+
+    def test_pipelined(self):
+        mailer, smtp = self._makeOne([(250, 'OK'), (250, 'OK'), (251, 'OK'),
+                                      (354, 'Go'), (250, 'OK')])
+        self._send(mailer)
+        inst = smtp._inst[0]
+        self.assertEqual(inst.written, [
+            b'mail FROM:<me@example.com> size=18\r\n'
+            b'rcpt TO:<you@example.com>\r\n'
+            b'rcpt TO:<him@example.com>\r\n'
+            b'data\r\n',
+            b'Subject: hi\n\n..dot\n\r\n.\r\n'])
+        self.assertEqual(inst.sent, 0)
+        self.assertEqual(inst.replies, [])
+        self.assertTrue(inst.quitted)
+
+    def test_not_advertised(self):
+        mailer, smtp = self._makeOne([], extns=())
+        self._send(mailer)
+        inst = smtp._inst[0]
+        self.assertEqual(inst.written, [])
+        self.assertEqual(inst.sent, 1)
+
+    def test_disabled(self):
+        mailer, smtp = self._makeOne([], pipelining=False)
+        self._send(mailer)
+        self.assertEqual(smtp._inst[0].sent, 1)
+
+    def test_some_recipients_refused(self):
+        from repoze.sendmail.mailer import _sendmail_pipelined
+        mailer, smtp = self._makeOne([(250, 'OK'), (550, 'Unknown'),
+                                      (250, 'OK'), (354, 'Go'), (250, 'OK')],
+                                     extns=('pipelining',))
+        connection = mailer._connect()
+        result = _sendmail_pipelined(connection, 'me@example.com',
+                                     ('you@example.com', 'him@example.com'),
+                                     b'')
+        self.assertEqual(result, {'you@example.com': (550, 'Unknown')})
+        self.assertTrue(connection.written[0].startswith(
+            b'mail FROM:<me@example.com>\r\n'))
+
+    def test_sender_refused(self):
+        import smtplib
+        mailer, smtp = self._makeOne([(553, 'No'), (503, 'No'), (503, 'No'),
+                                      (503, 'No')])
+        self.assertRaises(smtplib.SMTPSenderRefused, self._send, mailer)
+        inst = smtp._inst[0]
+        self.assertEqual(inst.replies, [])
+        self.assertEqual(inst.rsets, 1)
+
+    def test_sender_refused_421(self):
+        import smtplib
+        # The server hangs up after its reply to MAIL.
+        mailer, smtp = self._makeOne([(421, 'Bye')])
+        try:
+            self._send(mailer)
+        except smtplib.SMTPSenderRefused as e:
+            self.assertEqual(e.smtp_code, 421)
+            self.assertEqual(e.sender, 'me@example.com')
+        else: #pragma NO COVER
+            self.fail('SMTPSenderRefused not raised')
+        inst = smtp._inst[0]
+        self.assertTrue(inst.closed)
+        self.assertEqual(inst.rsets, 0)
+
+    def test_recipients_refused(self):
+        import smtplib
+        mailer, smtp = self._makeOne([(250, 'OK'), (550, 'Unknown'),
+                                      (550, 'Unknown'), (554, 'No valid')])
+        try:
+            self._send(mailer)
+        except smtplib.SMTPRecipientsRefused as e:
+            self.assertEqual(e.recipients,
+                             {'you@example.com': (550, 'Unknown'),
+                              'him@example.com': (550, 'Unknown')})
+        else: #pragma NO COVER
+            self.fail('SMTPRecipientsRefused not raised')
+        self.assertEqual(smtp._inst[0].rsets, 1)
+
+    def test_recipients_refused_data_accepted(self):
+        import smtplib
+        mailer, smtp = self._makeOne([(250, 'OK'), (550, 'Unknown'),
+                                      (354, 'Go'), (554, 'Empty')])
+        self.assertRaises(smtplib.SMTPRecipientsRefused, self._send, mailer,
+                          ('you@example.com',))
+        inst = smtp._inst[0]
+        self.assertEqual(inst.written[-1], b'.\r\n')
+        self.assertEqual(inst.replies, [])
+
+    def test_recipient_421(self):
+        import smtplib
+        mailer, smtp = self._makeOne([(250, 'OK'), (421, 'Bye')])
+        self.assertRaises(smtplib.SMTPRecipientsRefused, self._send, mailer)
+        self.assertTrue(smtp._inst[0].closed)
+
+    def test_data_refused(self):
+        import smtplib
+        mailer, smtp = self._makeOne([(250, 'OK'), (250, 'OK'), (250, 'OK'),
+                                      (451, 'Later')])
+        self.assertRaises(smtplib.SMTPDataError, self._send, mailer)
+        self.assertEqual(smtp._inst[0].rsets, 1)
+
+    def test_data_refused_session_reused(self):
+        import smtplib
+        mailer, smtp = self._makeOne([(250, 'OK'), (250, 'OK'), (250, 'OK'),
+                                      (451, 'Later'),
+                                      (250, 'OK'), (250, 'OK'), (250, 'OK'),
+                                      (354, 'Go'), (250, 'OK')])
+        with mailer.session() as session:
+            self.assertRaises(smtplib.SMTPDataError, session.send_raw,
+                              'me@example.com',
+                              ('you@example.com', 'him@example.com'),
+                              b'Subject: one\n\n')
+            session.send_raw('me@example.com',
+                             ('you@example.com', 'him@example.com'),
+                             b'Subject: two\n\n')
+        inst, = smtp._inst
+        self.assertEqual(inst.rsets, 1)
+        self.assertEqual(inst.replies, [])
+        self.assertEqual(inst.written[-1], b'Subject: two\n\n\r\n.\r\n')
+
+    def test_data_refused_421(self):
+        import smtplib
+        mailer, smtp = self._makeOne([(250, 'OK'), (250, 'OK'), (250, 'OK'),
+                                      (421, 'Bye')])
+        self.assertRaises(smtplib.SMTPDataError, self._send, mailer)
+        self.assertTrue(smtp._inst[0].closed)
+        self.assertEqual(smtp._inst[0].rsets, 0)
+
+    def test_421_session_reconnects(self):
+        import smtplib
+        mailer, smtp = self._makeOne([(250, 'OK'), (421, 'Bye')])
+        with mailer.session() as session:
+            self.assertRaises(smtplib.SMTPRecipientsRefused,
+                              session.send_raw, 'me@example.com',
+                              ('you@example.com',), b'Subject: one\n\n')
+            # the second message goes over a new connection
+            self.assertRaises(smtplib.SMTPRecipientsRefused,
+                              session.send_raw, 'me@example.com',
+                              ('you@example.com',), b'Subject: two\n\n')
+        self.assertEqual(len(smtp._inst), 2)
+        self.assertTrue(smtp._inst[0].closed)
+
+    def test_message_refused(self):
+        import smtplib
+        for code, rsets in ((554, 1), (421, 0)):
+            mailer, smtp = self._makeOne([(250, 'OK'), (250, 'OK'),
+                                          (250, 'OK'), (354, 'Go'),
+                                          (code, 'Spam')])
+            try:
+                self._send(mailer)
+            except smtplib.SMTPDataError as e:
+                self.assertEqual(e.smtp_code, code)
+            else: #pragma NO COVER
+                self.fail('SMTPDataError not raised')
+            self.assertEqual(smtp._inst[-1].rsets, rsets)
+
+
+class TestSMTPMailerStreaming(unittest.TestCase):
+
+    def _makeOne(self, replies, extns=('size',), **kw):
+        from repoze.sendmail.mailer import SMTPMailer
+        mailer = SMTPMailer(**kw)
+        mailer.spool_size = 100
+        smtp = _makeSMTP(extns=set(extns))
+        class StreamingSMTP(smtp):
+            does_esmtp = True
+            def __init__(self, *args, **kw):
+                smtp.__init__(self, *args, **kw)
+                self.replies = list(replies)
+                self.commands = []
+                self.written = []
+            def ehlo_or_helo_if_needed(self):
+                pass
+            def mail(self, sender, options=()):
+                self.commands.append(('mail', sender, list(options)))
+                return self.replies.pop(0)
+            def rcpt(self, recip):
+                self.commands.append(('rcpt', recip))
+                return self.replies.pop(0)
+            def putcmd(self, cmd):
+                self.commands.append((cmd,))
+            def send(self, data):
+                self.written.append(data)
+            def getreply(self):
+                return self.replies.pop(0)
+        mailer.smtp = StreamingSMTP
+        return mailer, smtp
+
+    def _makeMessage(self):
+        from email.message import Message
+        message = Message()
+        message['Subject'] = 'Big'
+        message.set_payload('.line\n' * 50)
+        return message
+
+    def test_small_message_not_streamed(self):
+        mailer, smtp = self._makeOne([])
+        mailer.send_raw('me@example.com', ['you@example.com'], b'Small')
+        inst = smtp._inst[0]
+        self.assertEqual(inst.sent, 1)
+        self.assertEqual(inst.msgtext, b'Small')
+
+    def test_send_streams_large_message(self):
+        from repoze.sendmail.encoding import encode_message
+        from repoze.sendmail.mailer import _quote_data
+        mailer, smtp = self._makeOne([(250, 'OK'), (250, 'OK'),
+                                      (354, 'Go'), (250, 'OK')])
+        message = self._makeMessage()
+        mailer.send('me@example.com', ['you@example.com'], message)
+        inst = smtp._inst[0]
+        encoded = encode_message(message)
+        self.assertEqual(inst.sent, 0)
+        self.assertEqual(inst.commands, [
+            ('mail', 'me@example.com', ['size=%d' % len(encoded)]),
+            ('rcpt', 'you@example.com'),
+            ('data',)])
+        self.assertEqual(b''.join(inst.written), _quote_data(encoded))
+        self.assertTrue(inst.quitted)
+
+    def test_send_raw_file_pipelined(self):
+        from io import BytesIO
+        mailer, smtp = self._makeOne([(250, 'OK'), (250, 'OK'),
+                                      (354, 'Go'), (250, 'OK')],
+                                     extns=('pipelining',))
+        data = b'Subject: Big\r\n\r\n' + b'.x\r\n' * 50
+        mailer.send_raw('me@example.com', ['you@example.com'],
+                        BytesIO(data))
+        inst = smtp._inst[0]
+        self.assertEqual(inst.commands, [])
+        self.assertEqual(b''.join(inst.written[1:]),
+                         data.replace(b'\n.', b'\n..') + b'.\r\n')
+
+    def test_recipients_refused(self):
+        import smtplib
+        mailer, smtp = self._makeOne([(250, 'OK'), (550, 'Unknown')])
+        self.assertRaises(smtplib.SMTPRecipientsRefused, mailer.send,
+                          'me@example.com', ['you@example.com'],
+                          self._makeMessage())
+        inst = smtp._inst[0]
+        self.assertEqual(inst.rsets, 1)
+        self.assertEqual(inst.written, [])
+
+    def test_data_refused(self):
+        import smtplib
+        mailer, smtp = self._makeOne([(250, 'OK'), (250, 'OK'),
+                                      (354, 'Go'), (552, 'Too big')])
+        self.assertRaises(smtplib.SMTPDataError, mailer.send,
+                          'me@example.com', ['you@example.com'],
+                          self._makeMessage())
+        self.assertEqual(smtp._inst[0].rsets, 1)
+
+    def test_send_data_quotes_across_chunks(self):
+        from io import BytesIO
+        from repoze.sendmail.mailer import _MessageFile
+        from repoze.sendmail.mailer import _quote_data
+        from repoze.sendmail.mailer import _send_data
+        data = b'.a\n.b..\n\n.\nc.\n.'
+        for chunk_size in range(1, len(data) + 1):
+            connection = _ConnectionStub()
+            message = _MessageFile(BytesIO(b'xx' + data), 2, len(data),
+                                   chunk_size)
+            _send_data(connection, message)
+            self.assertEqual(b''.join(connection.written),
+                             _quote_data(data), chunk_size)
+
+
+class _ConnectionStub(object):
+
+    def __init__(self):
+        self.written = []
+
+    def send(self, data):
+        self.written.append(data)
+
+
+class TestRelaySet(unittest.TestCase):
+
+    def _makeOne(self, relays, strategy='round-robin', **kw):
+        from repoze.sendmail.mailer import RelaySet
+        return RelaySet(relays, strategy, **kw)
+
+    def test_parse_relays(self):
+        from repoze.sendmail.mailer import parse_relays
+        relays = parse_relays('a, b:587 c*3\n d:2525*2')
+        self.assertEqual([(r.hostname, r.port, r.weight) for r in relays],
+                         [('a', 25, 1), ('b', 587, 1), ('c', 25, 3),
+                          ('d', 2525, 2)])
+        self.assertRaises(ValueError, parse_relays, 'a:port')
+        self.assertRaises(ValueError, parse_relays, 'a*0')
+
+    def test_ctor(self):
+        from repoze.sendmail.mailer import Relay
+        relay = Relay('c')
+        relays = self._makeOne([('a', 25), ('b', 587, 2), relay, 'd:26'])
+        self.assertEqual([(r.hostname, r.port, r.weight)
+                          for r in relays.relays],
+                         [('a', 25, 1), ('b', 587, 2), ('c', 25, 1),
+                          ('d', 26, 1)])
+        self.assertTrue(relays.relays[2] is relay)
+        self.assertEqual(len(relays), 4)
+        self.assertEqual(len(self._makeOne('a b')), 2)
+        self.assertRaises(ValueError, self._makeOne, [])
+        self.assertRaises(ValueError, self._makeOne, 'a', 'random')
+
+    def test_round_robin_weighted(self):
+        relays = self._makeOne('a*2 b')
+        chosen = [relays.choose().hostname for i in range(6)]
+        self.assertEqual(chosen.count('a'), 4)
+        self.assertEqual(chosen.count('b'), 2)
+        self.assertNotEqual(chosen[:2], ['a', 'a'])
+
+    def test_least_in_flight(self):
+        relays = self._makeOne('a b*2', 'least-in-flight')
+        a, b = relays.relays
+        self.assertTrue(relays.choose() is a)
+        relays.started(a)
+        self.assertTrue(relays.choose() is b)
+        relays.started(b)
+        relays.started(b)
+        self.assertTrue(relays.choose() is a)
+        relays.finished(b)
+        self.assertTrue(relays.choose() is b)
+
+    def test_latency(self):
+        relays = self._makeOne('a b', 'latency')
+        a, b = relays.relays
+        relays.started(a)
+        relays.finished(a, 2.0)
+        # b has not been tried yet
+        self.assertTrue(relays.choose() is b)
+        relays.started(b)
+        relays.finished(b, 1.0)
+        self.assertTrue(relays.choose() is b)
+        relays.started(b)
+        relays.finished(b, 11.0)
+        self.assertEqual(b.latency, 4.0)
+        self.assertTrue(relays.choose() is a)
+
+    def test_eject(self):
+        relays = self._makeOne('a b', ejection_time=30)
+        a, b = relays.relays
+        relays.eject(a)
+        self.assertEqual([relays.choose() for i in range(3)], [b, b, b])
+        self.assertTrue(relays.choose(exclude=[b]) is a)
+        relays.eject(b)
+        b.ejected_until += 1
+        # All ejected: the one back soonest is used.
+        self.assertTrue(relays.choose() is a)
+        a.ejected_until = b.ejected_until = 0
+        self.assertEqual(set([relays.choose(), relays.choose()]),
+                         set([a, b]))
+
+
+class TestSMTPMailerRelays(unittest.TestCase):
+
+    def _makeOne(self, relays='a b:587', refused=(), **kw):
+        from repoze.sendmail.mailer import SMTPMailer
+        mailer = SMTPMailer(relays=relays, **kw)
+        smtp = _makeSMTP()
+        class RelaySMTP(smtp):
+            def __init__(self, h, p, **params):
+                if h in refused:
+                    raise IOError('Connection refused')
+                smtp.__init__(self, h, p, **params)
+        mailer.smtp = RelaySMTP
+        return mailer, smtp
+
+    def _send(self, mailer):
+        mailer.send_raw('me@example.com', ('you@example.com',), b'')
+
+    def test_round_robin(self):
+        mailer, smtp = self._makeOne()
+        self._send(mailer)
+        self._send(mailer)
+        self.assertEqual([(i.hostname, i.port) for i in smtp._inst],
+                         [('a', '25'), ('b', '587')])
+
+    def test_connection_refused_fails_over(self):
+        mailer, smtp = self._makeOne(refused=('a',))
+        self._send(mailer)
+        self._send(mailer)
+        self.assertEqual([i.hostname for i in smtp._inst], ['b', 'b'])
+        a = mailer.relays.relays[0]
+        self.assertTrue(a.ejected_until > 0)
+
+    def test_all_refused(self):
+        mailer, smtp = self._makeOne(refused=('a', 'b'))
+        self.assertRaises(IOError, self._send, mailer)
+
+    def test_transient_error_fails_over(self):
+        import smtplib
+        mailer, smtp = self._makeOne()
+        class FlakySMTP(mailer.smtp):
+            def sendmail(self, f, t, m):
+                if self.hostname == 'a':
+                    raise smtplib.SMTPSenderRefused(451, 'Later', f)
+                return smtp.sendmail(self, f, t, m)
+        mailer.smtp = FlakySMTP
+        self._send(mailer)
+        self.assertEqual([(i.hostname, i.sent) for i in smtp._inst],
+                         [('a', 0), ('b', 1)])
+        self.assertTrue(smtp._inst[0].quitted)
+
+    def test_rate_limit_per_relay(self):
+        import smtplib
+        limiter = _RateLimiterStub()
+        mailer, smtp = self._makeOne(rate_limit=limiter)
+        class FlakySMTP(mailer.smtp):
+            def sendmail(self, f, t, m):
+                if self.hostname == 'a':
+                    raise smtplib.SMTPSenderRefused(421, 'Slow down', f)
+                return smtp.sendmail(self, f, t, m)
+        mailer.smtp = FlakySMTP
+        self._send(mailer)
+        self.assertEqual(limiter.calls,
+                         [('acquire', ('you@example.com',), ('a', 25)),
+                          ('failed', ('you@example.com',), ('a', 25)),
+                          ('acquire', ('you@example.com',), ('b', 587)),
+                          ('succeeded', ('you@example.com',), ('b', 587))])
+
+    def test_transient_recipients_refused_fails_over(self):
+        import smtplib
+        mailer, smtp = self._makeOne()
+        class FlakySMTP(mailer.smtp):
+            def sendmail(self, f, t, m):
+                if self.hostname == 'a':
+                    raise smtplib.SMTPRecipientsRefused(
+                        {t[0]: (450, 'Greylisted')})
+                return smtp.sendmail(self, f, t, m)
+        mailer.smtp = FlakySMTP
+        self._send(mailer)
+        self.assertEqual([i.sent for i in smtp._inst], [0, 1])
+
+    def test_permanent_error_does_not_fail_over(self):
+        import smtplib
+        mailer, smtp = self._makeOne()
+        class RefusingSMTP(mailer.smtp):
+            def sendmail(self, f, t, m):
+                raise smtplib.SMTPRecipientsRefused(
+                    {t[0]: (550, 'Unknown')})
+        mailer.smtp = RefusingSMTP
+        self.assertRaises(smtplib.SMTPRecipientsRefused, self._send, mailer)
+        self.assertEqual(len(smtp._inst), 1)
+        self.assertEqual(mailer.relays.relays[0].ejected_until, 0)
+
+    def test_transient_error_on_every_relay(self):
+        import smtplib
+        mailer, smtp = self._makeOne()
+        class BusySMTP(mailer.smtp):
+            def sendmail(self, f, t, m):
+                raise smtplib.SMTPDataError(421, 'Busy')
+        mailer.smtp = BusySMTP
+        self.assertRaises(smtplib.SMTPDataError, self._send, mailer)
+        self.assertEqual(len(smtp._inst), 2)
+
+    def test_pooled_per_relay(self):
+        mailer, smtp = self._makeOne(pool_size=4)
+        for i in range(4):
+            self._send(mailer)
+        self.assertEqual([(i.hostname, i.sent) for i in smtp._inst],
+                         [('a', 2), ('b', 2)])
+        for relay in mailer.relays.relays:
+            self.assertEqual(relay.in_flight, 0)
+            self.assertFalse(relay.latency is None)
+
+
+class TestBackgroundMailer(unittest.TestCase):
+
+    def _getTargetClass(self):
+        from repoze.sendmail.mailer import BackgroundMailer
+        return BackgroundMailer
+
+    def _makeOne(self, mailer=None, **kw):
+        if mailer is None:
+            mailer = _RawMailerStub()
+        return self._getTargetClass()(mailer, **kw)
+
+    def test_class_conforms_to_IMailer(self):
+        from zope.interface.verify import verifyClass
+        from repoze.sendmail.interfaces import IMailer
+        verifyClass(IMailer, self._getTargetClass())
+
+    def test_ctor_w_no_workers(self):
+        self.assertRaises(ValueError, self._makeOne, workers=0)
+
+    def test_send(self):
+        from email.message import Message
+        mailer = self._makeOne(workers=2)
+        msg = Message()
+        msg['Subject'] = 'first'
+        mailer.send('me@example.com', ('you@example.com',), msg)
+        msg.replace_header('Subject', 'changed')
+        mailer.send_raw('me@example.com', ('him@example.com',), b'raw')
+        self.assertTrue(mailer.flush(5))
+        sent = sorted(mailer.mailer.sent)
+        self.assertEqual(sent[0], ('me@example.com', ('him@example.com',),
+                                   b'raw'))
+        self.assertTrue(b'Subject: first' in sent[1][2])
+        self.assertTrue(mailer.close())
+        self.assertTrue(mailer.mailer.closed)
+        self.assertRaises(RuntimeError, mailer.send_raw,
+                          'me@example.com', ('you@example.com',), b'raw')
+
+    def test_send_w_non_message(self):
+        mailer = self._makeOne()
+        self.assertRaises(ValueError, mailer.send,
+                          'me@example.com', ('you@example.com',), b'')
+
+    def test_send_returns_before_sent(self):
+        import threading
+        stub = _RawMailerStub()
+        stub.gate = threading.Event()
+        mailer = self._makeOne(stub)
+        mailer.send_raw('me@example.com', ('you@example.com',), b'raw')
+        self.assertEqual(stub.sent, [])
+        self.assertFalse(mailer.flush(0.05))
+        stub.gate.set()
+        self.assertTrue(mailer.flush(5))
+        self.assertEqual(len(stub.sent), 1)
+        mailer.close()
+
+    def test_full_queue_sends_in_caller(self):
+        import threading
+        import time
+        stub = _RawMailerStub()
+        stub.gate = threading.Event()
+        mailer = self._makeOne(stub, queue_size=1, timeout=0.01)
+        mailer.send_raw('me@example.com', ('you@example.com',), b'1')
+        while not mailer._queue.empty():  # wait for the worker to take it
+            time.sleep(0.001)
+        mailer.send_raw('me@example.com', ('you@example.com',), b'2')
+        mailer.send_raw('me@example.com', ('you@example.com',), b'3')
+        self.assertEqual([m for f, t, m in stub.sent], [b'3'])
+        stub.gate.set()
+        self.assertTrue(mailer.close(5))
+        self.assertEqual(sorted([m for f, t, m in stub.sent]),
+                         [b'1', b'2', b'3'])
+
+    def test_on_error(self):
+        stub = _RawMailerStub()
+        stub.error = ValueError('boom')
+        errors = []
+        def on_error(fromaddr, toaddrs, message, exc_info):
+            errors.append((fromaddr, toaddrs, message, exc_info[1]))
+        mailer = self._makeOne(stub, on_error=on_error)
+        mailer.send_raw('me@example.com', ('you@example.com',), b'raw')
+        self.assertTrue(mailer.close(5))
+        self.assertEqual(errors, [('me@example.com', ('you@example.com',),
+                                   b'raw', stub.error)])
+
+    def test_on_error_default_logs(self):
+        stub = _RawMailerStub()
+        stub.error = ValueError('boom')
+        mailer = self._makeOne(stub)
+        logged = []
+        mailer.log = _LoggerStub(logged)
+        mailer.send_raw('me@example.com', ('you@example.com',), b'raw')
+        self.assertTrue(mailer.close(5))
+        self.assertEqual(len(logged), 1)
+        self.assertTrue(logged[0][2]['exc_info'][1] is stub.error)
+
+    def test_close_unused(self):
+        mailer = self._makeOne()
+        self.assertTrue(mailer.close())
+        self.assertEqual(mailer._threads, [])
+
+
+class _RawMailerStub(object):
+    gate = None
+    error = None
+    closed = False
+
+    def __init__(self):
+        self.sent = []
+
+    def send_raw(self, fromaddr, toaddrs, message):
+        import threading
+        worker = threading.current_thread().name.startswith('Background')
+        if self.gate is not None and worker:
+            self.gate.wait(5)
+        if self.error is not None:
+            raise self.error
+        self.sent.append((fromaddr, toaddrs, message))
+
+    def close(self):
+        self.closed = True
+
+
+class _LoggerStub(object):
+
+    def __init__(self, logged):
+        self.logged = logged
+
+    def error(self, msg, *args, **kw):
+        self.logged.append((msg, args, kw))
+
+    exception = error
 
 
 def _makeSMTP(ehlo_status=200, extns=set(['starttls'])):
@@ -280,15 +1329,28 @@ def _makeSMTP(ehlo_status=200, extns=set(['starttls'])):
             self.closed = False
             self.debuglevel = 0
             self.params = params
+            self.sent = 0
+            self.rsets = 0
+            self.fail_on_rset = False
+            self.sendmail_error = None
             SMTP._inst.append(self)
 
         def set_debuglevel(self, lvl):
             self.debuglevel = bool(lvl)
 
         def sendmail(self, f, t, m):
+            if self.sendmail_error is not None:
+                raise self.sendmail_error
             self.fromaddr = f
             self.toaddrs = t
             self.msgtext = m
+            self.sent += 1
+
+        def rset(self):
+            from smtplib import SMTPServerDisconnected
+            if self.fail_on_rset:
+                raise SMTPServerDisconnected('gone')
+            self.rsets += 1
 
         def login(self, username, password):
             self.username = username
@@ -321,6 +1383,21 @@ def _makeSMTP(ehlo_status=200, extns=set(['starttls'])):
     return SMTP
 
 
+class _RateLimiterStub(object):
+
+    def __init__(self):
+        self.calls = []
+
+    def acquire(self, toaddrs=(), relay=None):
+        self.calls.append(('acquire', tuple(toaddrs), relay))
+
+    def succeeded(self, toaddrs=(), relay=None):
+        self.calls.append(('succeeded', tuple(toaddrs), relay))
+
+    def failed(self, error, toaddrs=(), relay=None):
+        self.calls.append(('failed', tuple(toaddrs), relay))
+
+
 def _makeSMTPNoEHLO(extns):
     SMTP = _makeSMTP(None, extns)
 
@@ -339,4 +1416,10 @@ def test_suite():
     return unittest.TestSuite((
         unittest.makeSuite(TestSMTPMailer),
         unittest.makeSuite(TestSMTPMailerWithNoEHLO),
+        unittest.makeSuite(TestSMTPConnectionPool),
+        unittest.makeSuite(TestSMTPMailerPipelining),
+        unittest.makeSuite(TestSMTPMailerStreaming),
+        unittest.makeSuite(TestRelaySet),
+        unittest.makeSuite(TestSMTPMailerRelays),
+        unittest.makeSuite(TestBackgroundMailer),
     ))
@@ -0,0 +1,349 @@
+import unittest
+
+from repoze.sendmail.tests.test_mailer import _makeSMTP
+
+
+class _ResolverStub(object):
+
+    def __init__(self, answers):
+        self.answers = answers
+        self.lookups = []
+
+    def __call__(self, domain):
+        self.lookups.append(domain)
+        answer = self.answers[domain]
+        if isinstance(answer, Exception):
+            raise answer
+        return answer
+
+
+class TestMXCache(unittest.TestCase):
+
+    def _makeOne(self, answers, **kw):
+        from repoze.sendmail.mx import MXCache
+        resolver = _ResolverStub(answers)
+        return MXCache(resolver, **kw), resolver
+
+    def test_lookup_sorts_by_preference(self):
+        cache, resolver = self._makeOne(
+            {'example.com': (60, [(20, 'mx2'), (10, 'mx1'), (30, 'mx3')])})
+        self.assertEqual(cache.lookup('Example.COM'), ['mx1', 'mx2', 'mx3'])
+        self.assertEqual(resolver.lookups, ['example.com'])
+
+    def test_lookup_without_mx_uses_domain(self):
+        cache, resolver = self._makeOne({'example.com': (None, [])})
+        self.assertEqual(cache.lookup('example.com'), ['example.com'])
+
+    def test_null_mx_is_permanent(self):
+        import time
+        from repoze.sendmail.mx import MXLookupError
+        cache, resolver = self._makeOne(
+            {'example.com': (60, [(0, '.')]),
+             'example.org': (60, [(0, '')])}, negative_ttl=300)
+        for domain in ('example.com', 'example.org', 'example.com'):
+            try:
+                cache.lookup(domain)
+            except MXLookupError as e:
+                self.assertTrue(e.permanent)
+                self.assertEqual(e.domain, domain)
+            else:
+                self.fail('null MX accepted')
+        self.assertEqual(resolver.lookups, ['example.com', 'example.org'])
+        expires = cache._entries['example.com'][0] - time.time()
+        self.assertTrue(200 < expires <= 300)
+
+    def test_lookup_is_cached_for_ttl(self):
+        cache, resolver = self._makeOne(
+            {'example.com': (60, [(10, 'mx1')])})
+        cache.lookup('example.com')
+        cache.lookup('example.com')
+        self.assertEqual(len(resolver.lookups), 1)
+        expires, records, error = cache._entries['example.com']
+        cache._entries['example.com'] = (expires - 61, records, error)
+        cache.lookup('example.com')
+        self.assertEqual(len(resolver.lookups), 2)
+
+    def test_ttl_capped(self):
+        import time
+        cache, resolver = self._makeOne(
+            {'example.com': (10 ** 9, [(10, 'mx1')])}, max_ttl=100)
+        cache.lookup('example.com')
+        expires = cache._entries['example.com'][0]
+        self.assertTrue(expires <= time.time() + 100)
+
+    def test_negative_caching(self):
+        import time
+        from repoze.sendmail.mx import MXLookupError
+        cache, resolver = self._makeOne(
+            {'nowhere.example': MXLookupError('nowhere.example', True),
+             'flaky.example': MXLookupError('flaky.example', False)},
+            negative_ttl=300, error_ttl=30)
+        for domain in ('nowhere.example', 'nowhere.example',
+                       'flaky.example', 'flaky.example'):
+            self.assertRaises(MXLookupError, cache.lookup, domain)
+        self.assertEqual(resolver.lookups,
+                         ['nowhere.example', 'flaky.example'])
+        now = time.time()
+        nowhere = cache._entries['nowhere.example'][0] - now
+        flaky = cache._entries['flaky.example'][0] - now
+        self.assertTrue(200 < nowhere <= 300)
+        self.assertTrue(0 < flaky <= 30)
+
+    def test_clear(self):
+        cache, resolver = self._makeOne(
+            {'example.com': (60, [(10, 'mx1')])})
+        cache.lookup('example.com')
+        cache.clear()
+        cache.lookup('example.com')
+        self.assertEqual(len(resolver.lookups), 2)
+
+
+class TestMXMailer(unittest.TestCase):
+
+    def _makeOne(self, answers, **kw):
+        from repoze.sendmail.mx import MXMailer
+        resolver = _ResolverStub(answers)
+        mailer = MXMailer(resolver, **kw)
+        smtp = mailer.smtp = _makeSMTP(extns=set())
+        return mailer, smtp, resolver
+
+    def _sent(self, smtp):
+        return sorted((inst.hostname, tuple(inst.toaddrs))
+                      for inst in smtp._inst if inst.sent)
+
+    def test_interface(self):
+        from zope.interface.verify import verifyObject
+        from repoze.sendmail.interfaces import IMailer
+        mailer, smtp, resolver = self._makeOne({})
+        verifyObject(IMailer, mailer)
+
+    def test_send_groups_by_domain(self):
+        mailer, smtp, resolver = self._makeOne(
+            {'example.com': (60, [(10, 'mx.example.com')]),
+             'example.org': (60, [(10, 'mx.example.org')])}, port=2525)
+        refused = mailer.send_raw(
+            'me@example.com',
+            ['a@example.com', 'b@example.org', 'c@Example.com'],
+            b'Message')
+        self.assertEqual(refused, {})
+        self.assertEqual(self._sent(smtp),
+                         [('mx.example.com', ('a@example.com',
+                                              'c@Example.com')),
+                          ('mx.example.org', ('b@example.org',))])
+        self.assertEqual(smtp._inst[0].port, '2525')
+
+    def test_send_message(self):
+        from email.message import Message
+        mailer, smtp, resolver = self._makeOne(
+            {'example.com': (60, [(10, 'mx.example.com')])})
+        message = Message()
+        message['Subject'] = 'Hello'
+        mailer.send('me@example.com', ['you@example.com'], message)
+        self.assertTrue(b'Subject: Hello' in smtp._inst[0].msgtext)
+        self.assertRaises(ValueError, mailer.send, 'me@example.com',
+                          ['you@example.com'], b'Not a Message')
+
+    def test_connections_reused_per_host(self):
+        mailer, smtp, resolver = self._makeOne(
+            {'example.com': (60, [(10, 'mx.example.com')])})
+        mailer.send_raw('me@example.com', ['a@example.com'], b'One')
+        mailer.send_raw('me@example.com', ['b@example.com'], b'Two')
+        self.assertEqual(len(smtp._inst), 1)
+        self.assertEqual(smtp._inst[0].sent, 2)
+        self.assertEqual(resolver.lookups, ['example.com'])
+        mailer.close()
+        self.assertTrue(smtp._inst[0].quitted)
+
+    def test_max_hosts(self):
+        mailer, smtp, resolver = self._makeOne(
+            {'a.com': (60, [(10, 'mx.a.com')]),
+             'b.com': (60, [(10, 'mx.b.com')]),
+             'c.com': (60, [(10, 'mx.c.com')])}, max_hosts=2)
+        mailer.send_raw('me@example.com', ['x@a.com'], b'One')
+        mailer.send_raw('me@example.com', ['x@b.com'], b'Two')
+        mailer.send_raw('me@example.com', ['x@a.com'], b'Three')
+        mailer.send_raw('me@example.com', ['x@c.com'], b'Four')
+        self.assertEqual(list(mailer._mailers), ['mx.a.com', 'mx.c.com'])
+        b = [inst for inst in smtp._inst if inst.hostname == 'mx.b.com']
+        self.assertTrue(b[0].quitted)
+
+    def test_max_hosts_keeps_leased(self):
+        mailer, smtp, resolver = self._makeOne({}, max_hosts=1)
+        entry = mailer._mailer('mx1')._lease()
+        mailer._mailer('mx2')
+        self.assertEqual(list(mailer._mailers), ['mx1', 'mx2'])
+        mailer._mailer('mx1')._release(entry)
+        mailer._mailer('mx3')
+        self.assertEqual(list(mailer._mailers), ['mx3'])
+
+    def test_sweeps_expired_connections(self):
+        mailer, smtp, resolver = self._makeOne(
+            {'a.com': (60, [(10, 'mx.a.com')]),
+             'b.com': (60, [(10, 'mx.b.com')])}, pool_idle_timeout=60)
+        mailer.send_raw('me@example.com', ['x@a.com'], b'One')
+        mailer._mailers['mx.a.com'].pool._idle[0].last_used -= 61
+        mailer.send_raw('me@example.com', ['x@b.com'], b'Two')
+        self.assertFalse(smtp._inst[0].quitted)
+        mailer._swept -= mailer.sweep_interval
+        mailer.send_raw('me@example.com', ['x@b.com'], b'Three')
+        self.assertTrue(smtp._inst[0].quitted)
+        self.assertEqual(mailer._mailers['mx.a.com'].pool._idle, [])
+        self.assertEqual(len(mailer._mailers['mx.b.com'].pool._idle), 1)
+
+    def test_falls_back_to_next_mx(self):
+        mailer, smtp, resolver = self._makeOne(
+            {'example.com': (60, [(10, 'mx1'), (20, 'mx2')])})
+
+        def refuse(relay=None):
+            raise EnvironmentError('connection refused')
+        mailer._mailer('mx1').smtp_factory = refuse
+        mailer.send_raw('me@example.com', ['a@example.com'], b'Message')
+        self.assertEqual(self._sent(smtp), [('mx2', ('a@example.com',))])
+
+    def test_permanent_error_not_retried(self):
+        from smtplib import SMTPSenderRefused
+        mailer, smtp, resolver = self._makeOne(
+            {'example.com': (60, [(10, 'mx1'), (20, 'mx2')])})
+        error = SMTPSenderRefused(550, 'No', 'me@example.com')
+
+        class RefusingSMTP(smtp):
+            def sendmail(self, f, t, m):
+                raise error
+        mailer.smtp = RefusingSMTP
+        try:
+            mailer.send_raw('me@example.com', ['a@example.com'], b'Message')
+        except SMTPSenderRefused as e:
+            self.assertTrue(e is error)
+        else:  # pragma NO COVER
+            self.fail('SMTPSenderRefused not raised')
+        self.assertEqual([inst.hostname for inst in smtp._inst], ['mx1'])
+
+    def test_partial_permanent_failure_returns_refused(self):
+        from repoze.sendmail.mx import MXLookupError
+        mailer, smtp, resolver = self._makeOne(
+            {'example.com': (60, [(10, 'mx.example.com')]),
+             'nowhere.example': MXLookupError('nowhere.example', True,
+                                              'No such domain')})
+        refused = mailer.send_raw(
+            'me@example.com', ['a@example.com', 'b@nowhere.example'],
+            b'Message')
+        self.assertEqual(refused,
+                         {'b@nowhere.example': (550, 'No such domain')})
+        self.assertEqual(self._sent(smtp),
+                         [('mx.example.com', ('a@example.com',))])
+
+    def test_partial_transient_failure_defers_recipients(self):
+        from repoze.sendmail.mx import DeferredRecipients
+        from repoze.sendmail.mx import MXLookupError
+        mailer, smtp, resolver = self._makeOne(
+            {'example.com': (60, [(10, 'mx.example.com')]),
+             'flaky.example': MXLookupError('flaky.example', False,
+                                            'Timeout'),
+             'nowhere.example': MXLookupError('nowhere.example', True,
+                                              'No such domain')})
+        try:
+            mailer.send_raw('me@example.com',
+                            ['a@example.com', 'b@flaky.example',
+                             'c@nowhere.example'], b'Message')
+        except DeferredRecipients as e:
+            self.assertEqual(e.recipients,
+                             {'b@flaky.example': (451, 'Timeout')})
+            self.assertEqual(e.refused,
+                             {'c@nowhere.example': (550, 'No such domain')})
+        else:  # pragma NO COVER
+            self.fail('DeferredRecipients not raised')
+        self.assertEqual(self._sent(smtp),
+                         [('mx.example.com', ('a@example.com',))])
+
+    def test_partial_connection_failure_defers_recipients(self):
+        from repoze.sendmail.mx import DeferredRecipients
+        mailer, smtp, resolver = self._makeOne(
+            {'example.com': (60, [(10, 'mx.example.com')]),
+             'example.org': (60, [(10, 'mx.example.org')])})
+
+        def refuse(relay=None):
+            raise EnvironmentError('connection refused')
+        mailer._mailer('mx.example.org').smtp_factory = refuse
+        try:
+            mailer.send_raw('me@example.com',
+                            ['a@example.com', 'b@example.org'], b'Message')
+        except DeferredRecipients as e:
+            self.assertEqual(list(e.recipients), ['b@example.org'])
+            self.assertEqual(e.recipients['b@example.org'][0], 451)
+            self.assertEqual(e.refused, {})
+        else:  # pragma NO COVER
+            self.fail('DeferredRecipients not raised')
+
+    def test_transient_recipient_refusal_deferred(self):
+        from repoze.sendmail.mx import DeferredRecipients
+        mailer, smtp, resolver = self._makeOne(
+            {'example.com': (60, [(10, 'mx.example.com')])})
+
+        class RefusingSMTP(smtp):
+            def sendmail(self, f, t, m):
+                smtp.sendmail(self, f, t, m)
+                return {'b@example.com': (452, 'Mailbox full'),
+                        'c@example.com': (550, 'No such user')}
+        mailer.smtp = RefusingSMTP
+        try:
+            mailer.send_raw('me@example.com',
+                            ['a@example.com', 'b@example.com',
+                             'c@example.com'], b'Message')
+        except DeferredRecipients as e:
+            self.assertEqual(e.recipients,
+                             {'b@example.com': (452, 'Mailbox full')})
+            self.assertEqual(e.refused,
+                             {'c@example.com': (550, 'No such user')})
+        else:  # pragma NO COVER
+            self.fail('DeferredRecipients not raised')
+
+    def test_total_failure_raises_transient_first(self):
+        from repoze.sendmail.mx import MXLookupError
+        mailer, smtp, resolver = self._makeOne(
+            {'nowhere.example': MXLookupError('nowhere.example', True),
+             'flaky.example': MXLookupError('flaky.example', False)})
+        try:
+            mailer.send_raw('me@example.com',
+                            ['a@nowhere.example', 'b@flaky.example'],
+                            b'Message')
+        except MXLookupError as e:
+            self.assertEqual(e.domain, 'flaky.example')
+        else:  # pragma NO COVER
+            self.fail('MXLookupError not raised')
+
+    def test_destination(self):
+        mailer, smtp, resolver = self._makeOne({})
+        self.assertFalse(getattr(mailer, 'fixed_destination', False))
+        self.assertEqual(
+            mailer.destination(['a@y.org', 'b@X.com', 'c@x.com']),
+            ('x.com', 'y.org'))
+
+    def test_session_keeps_connection_per_host(self):
+        mailer, smtp, resolver = self._makeOne(
+            {'example.com': (60, [(10, 'mx.example.com')]),
+             'example.org': (60, [(10, 'mx.example.org')])}, pool_size=0)
+        with mailer.session() as session:
+            session.send_raw('me@example.com', ['a@example.com'], b'One')
+            session.send_raw('me@example.com',
+                             ['b@example.com', 'c@example.org'], b'Two')
+            self.assertEqual(len(smtp._inst), 2)
+            self.assertFalse(smtp._inst[0].closed)
+        self.assertEqual(smtp._inst[0].sent, 2)
+        self.assertEqual(smtp._inst[1].sent, 1)
+        self.assertTrue(smtp._inst[0].quitted)
+        self.assertTrue(smtp._inst[1].quitted)
+
+    def test_session_releases_pooled_connections(self):
+        mailer, smtp, resolver = self._makeOne(
+            {'example.com': (60, [(10, 'mx.example.com')]),
+             'example.org': (60, [(10, 'mx.example.org')])}, pool_size=1)
+        with mailer.session() as session:
+            session.send_raw('me@example.com',
+                             ['a@example.com', 'b@example.org'], b'One')
+            for host in ('mx.example.com', 'mx.example.org'):
+                self.assertEqual(mailer._mailers[host].pool.leased, 0)
+            session.send_raw('me@example.com',
+                             ['c@example.org', 'd@example.com'], b'Two')
+        self.assertEqual(len(smtp._inst), 2)
+        self.assertEqual([inst.sent for inst in smtp._inst], [2, 2])
+        self.assertFalse(smtp._inst[0].quitted)
@@ -2,6 +2,7 @@ import os.path
 import shutil
 import smtplib
 import sys
+import threading
 from tempfile import mkdtemp
 from unittest import TestCase
 
@@ -79,16 +80,94 @@ class TestQueueProcessor(TestCase):
         shutil.rmtree(self.dir)
 
     def test_parseMessage(self):
+        from io import BytesIO
         hdr = ('X-Actually-From: foo@example.com\n'
                'X-Actually-To: bar@example.com, baz@example.com\n')
         msg = ('Header: value\n'
                '\n'
                'Body\n')
-        f, t, m = self.qp._parseMessage(StringIO(u(hdr + msg)))
+        f, t, m = self.qp._parseMessage(BytesIO(b(hdr + msg)))
         self.assertEqual(f, 'foo@example.com')
         self.assertEqual(t, ('bar@example.com', 'baz@example.com'))
         self.assertEqual(m.as_string(), msg)
 
+    def test_parseMessage_cleaned(self):
+        from io import BytesIO
+        from repoze.sendmail.encoding import is_cleaned
+        msg = 'Header: value\n\nBody\n'
+        f, t, m = self.qp._parseMessage(BytesIO(b(msg)))
+        self.assertFalse(is_cleaned(m))
+        hdr = ('X-Actually-From: foo@example.com\n'
+               'X-Actually-To: bar@example.com\n'
+               'X-Actually-Cleaned: yes\n')
+        f, t, m = self.qp._parseMessage(BytesIO(b(hdr + msg)))
+        self.assertTrue(is_cleaned(m))
+        self.assertEqual(m.as_string(), msg)
+
+    def test_readMessage_cleaned(self):
+        from io import BytesIO
+        hdr = b('X-Actually-From: foo@example.com\n'
+                'X-Actually-Cleaned: yes\n')
+        msg = b('Header: value\n\nBody\n')
+        f, t, m = self.qp._readMessage(BytesIO(hdr + msg))
+        self.assertEqual(m, msg)
+
+    def test_readMessage(self):
+        from io import BytesIO
+        hdr = (b('X-Actually-From: foo@example.com\n') +
+               b('X-Actually-To: bar@example.com,\n baz@example.com\n'))
+        msg = b('Header: value\n'
+                'Folded: header\n'
+                '\tvalue\n'
+                '\n'
+                'Body\n'
+                'X-Actually-To: not@a.header\n')
+        f, t, m = self.qp._readMessage(BytesIO(hdr + msg))
+        self.assertEqual(f, 'foo@example.com')
+        self.assertEqual(t, ('bar@example.com', 'baz@example.com'))
+        self.assertEqual(m, msg)
+
+    def test_readMessage_encoded_envelope(self):
+        from io import BytesIO
+        from email.header import Header
+        fromaddr = u('LaPe\xf1a <foo@example.com>')
+        toaddrs = ','.join(['bar%d@example.com' % i for i in range(10)])
+        msg = b('Header: value\r\n\r\nBody\r\n')
+        hdr = b('X-Actually-From: %s\r\nX-Actually-To: %s\r\n' % (
+            Header(fromaddr, 'utf-8').encode(linesep='\r\n'),
+            Header(toaddrs, 'utf-8').encode(linesep='\r\n')))
+        f, t, m = self.qp._readMessage(BytesIO(msg[:15] + hdr + msg[15:]))
+        self.assertEqual(f, fromaddr)
+        self.assertEqual(t, tuple(toaddrs.split(',')))
+        self.assertEqual(m, msg)
+
+    def test_readMessage_no_envelope(self):
+        from io import BytesIO
+        msg = b('Header: value\n\nBody\n')
+        f, t, m = self.qp._readMessage(BytesIO(msg))
+        self.assertEqual(f, '')
+        self.assertEqual(t, ())
+        self.assertEqual(m, msg)
+
+    def test_delivery_raw(self):
+        self.qp.mailer = _makeRawMailerStub()
+        self.filename = os.path.join(self.dir, 'message')
+        temp = open(self.filename, "w+b")
+        temp.write(b('X-Actually-From: foo@example.com\n')+
+                   b('X-Actually-To: bar@example.com, baz@example.com\n')+
+                   b('Header: value\n\nBody\n'))
+        temp.close()
+        self.qp.maildir.files.append(self.filename)
+        self.qp.send_messages()
+
+        self.assertEqual(self.qp.mailer.sent_messages, [])
+        self.assertEqual(self.qp.mailer.sent_raw,
+                         [('foo@example.com',
+                           ('bar@example.com', 'baz@example.com'),
+                           b('Header: value\n\nBody\n'))])
+        self.assertFalse(os.path.exists(self.filename), 'File exists')
+        self.assertEqual(len(self.qp.log.infos), 1)
+
     def test_delivery(self):
         self.filename = os.path.join(self.dir, 'message')
         temp = open(self.filename, "w+b")
@@ -264,6 +343,641 @@ class TestQueueProcessor(TestCase):
                             {})])
         self.assertFalse(os.path.exists(tmp_filename))
 
+    def _writeMessages(self, count):
+        filenames = []
+        for i in range(count):
+            filename = os.path.join(self.dir, 'message%d' % i)
+            temp = open(filename, "w+b")
+            temp.write(b('X-Actually-From: foo@example.com\n')+
+                       b('X-Actually-To: bar%d@example.com\n' % i)+
+                       b('Header: value\n\nBody\n'))
+            temp.close()
+            self.qp.maildir.files.append(filename)
+            filenames.append(filename)
+        return filenames
+
+    def test_send_messages_w_workers(self):
+        filenames = self._writeMessages(10)
+        self.qp.workers = 3
+        self.qp.send_messages()
+
+        sent = sorted(m[1] for m in self.qp.mailer.sent_messages)
+        self.assertEqual(sent,
+                         sorted(('bar%d@example.com' % i,) for i in range(10)))
+        for filename in filenames:
+            self.assertFalse(os.path.exists(filename))
+        self.assertEqual(len(self.qp.log.infos), 10)
+        self.assertEqual(self.qp.log.errors, [])
+
+    def _writeTo(self, *toaddrs):
+        filenames = []
+        for i, to in enumerate(toaddrs):
+            filename = os.path.join(self.dir, 'message%d' % i)
+            with open(filename, 'wb') as f:
+                f.write(b('X-Actually-From: foo@example.com\n') +
+                        b('X-Actually-To: %s\n' % to) +
+                        b('Header: value\n\nBody\n'))
+            self.qp.maildir.files.append(filename)
+            filenames.append(filename)
+        return filenames
+
+    def test_bad_schedule(self):
+        from repoze.sendmail.queue import QueueProcessor
+        self.assertRaises(ValueError, QueueProcessor, _makeMailerStub(),
+                          '/foo/bar/baz', MaildirStub, schedule='random')
+
+    def test_order(self):
+        from repoze.sendmail.queue import QueueProcessor
+        path = os.path.join(self.dir, 'queue')
+        qp = QueueProcessor(_makeMailerStub(), path, order='name')
+        self.assertEqual(qp.maildir.order, 'name')
+        qp = QueueProcessor(_makeMailerStub(), path, order=None)
+        self.assertEqual(qp.maildir.order, None)
+        self.assertRaises(ValueError, QueueProcessor, _makeMailerStub(),
+                          path, order='random')
+
+    def test_send_messages_by_domain(self):
+        self.qp.mailer = _SessionMailerStub()
+        self.qp.schedule = 'domain'
+        self.qp.session_limit = 2
+        filenames = self._writeTo('a@x.com', 'b@y.com', 'c@X.com',
+                                  'd@x.com', 'e@x.com, f@y.com')
+        self.qp.send_messages()
+        self.assertEqual(self.qp.mailer.sessions,
+                         [[('a@x.com',), ('c@X.com',)],
+                          [('b@y.com',)],
+                          [('e@x.com', 'f@y.com')],
+                          [('d@x.com',)]])
+        for filename in filenames:
+            self.assertFalse(os.path.exists(filename))
+        self.assertEqual(len(self.qp.log.infos), 5)
+        self.assertEqual(self.qp.log.errors, [])
+
+    def test_send_messages_by_domain_w_mailer_destination(self):
+        self.qp.mailer = _SessionMailerStub()
+        self.qp.mailer.destination = lambda toaddrs: None
+        self.qp.schedule = 'domain'
+        self._writeTo('a@x.com', 'b@y.com', 'c@x.com')
+        self.qp.send_messages()
+        self.assertEqual(self.qp.mailer.sessions,
+                         [[('a@x.com',), ('b@y.com',), ('c@x.com',)]])
+
+    def test_send_messages_by_domain_w_fixed_destination(self):
+        self.qp.mailer = _SessionMailerStub()
+        self.qp.mailer.fixed_destination = True
+        read = []
+        self.qp._destination = read.append
+        self.qp.schedule = 'domain'
+        self.qp.session_limit = 2
+        self._writeTo('a@x.com', 'b@y.com', 'c@x.com')
+        self.qp.send_messages()
+        self.assertEqual(read, [])
+        self.assertEqual(self.qp.mailer.sessions,
+                         [[('a@x.com',), ('b@y.com',)], [('c@x.com',)]])
+
+    def test_send_messages_by_domain_w_workers(self):
+        self.qp.mailer = _SessionMailerStub()
+        self.qp.schedule = 'domain'
+        self.qp.session_limit = 1
+        self.qp.workers = 2
+        self._writeTo('a@x.com', 'b@y.com', 'c@x.com')
+        self.qp.send_messages()
+        self.assertEqual(sorted(self.qp.mailer.sessions),
+                         [[('a@x.com',)], [('b@y.com',)], [('c@x.com',)]])
+
+    def test_send_messages_by_domain_wo_session(self):
+        self.qp.schedule = 'domain'
+        filenames = self._writeTo('a@x.com', 'b@y.com', 'c@x.com')
+        self.qp.send_messages()
+        self.assertEqual([m[1] for m in self.qp.mailer.sent_messages],
+                         [('a@x.com',), ('c@x.com',), ('b@y.com',)])
+
+    def test_send_messages_by_domain_missing_file(self):
+        self.qp.mailer = _SessionMailerStub()
+        self.qp.schedule = 'domain'
+        self._writeTo('a@x.com')
+        self.qp.maildir.files.append(os.path.join(self.dir, 'gone'))
+        self.qp.send_messages()
+        self.assertEqual(self.qp.mailer.sessions, [[('a@x.com',)], []])
+
+    def test_send_message_w_rate_limit(self):
+        from repoze.sendmail.tests.test_delivery import _RateLimiterStub
+        self.qp.rate_limit = _RateLimiterStub()
+        filenames = self._writeTo('a@x.com')
+        self.qp.send_messages()
+        self.assertEqual(self.qp.rate_limit.sent, [('a@x.com',)])
+        self.assertEqual(len(self.qp.mailer.sent_messages), 1)
+        self.assertFalse(os.path.exists(filenames[0]))
+
+    def _retryPolicy(self, **kw):
+        from repoze.sendmail.queue import RetryPolicy
+        self.qp.maildir.path = self.dir
+        self.qp.retry = RetryPolicy(jitter=0, **kw)
+        self.qp.mailer = SMTPResponseExceptionMailerStub(451)
+
+    def test_retry_later(self):
+        import time
+        from repoze.sendmail.queue import retry_info
+        self._retryPolicy(initial=60)
+        queued = int(time.time()) - 10
+        unique = '%d.5.host.6' % queued
+        filename, = self._writeTo('a@example.com')
+        os.rename(filename, os.path.join(self.dir, unique))
+        self.qp.maildir.files = [os.path.join(self.dir, unique)]
+        self.qp.send_messages()
+        names = os.listdir(self.dir)
+        self.assertEqual(len(names), 1)
+        self.assertTrue(names[0].startswith(unique))
+        attempts, due, since = retry_info(names[0])
+        self.assertEqual(attempts, 1)
+        self.assertTrue(abs(due - time.time() - 60) < 2)
+        self.assertEqual(since, queued)
+        self.assertEqual(len(self.qp.log.errors), 1)
+
+        # Not due yet: neither claimed nor read
+        self.qp.maildir.files = [os.path.join(self.dir, names[0])]
+        self.qp.log = LoggerStub()
+        self.qp.send_messages()
+        self.assertEqual(os.listdir(self.dir), names)
+        self.assertEqual(self.qp.log.errors, [])
+
+    def test_retry_backs_off(self):
+        import time
+        from repoze.sendmail.queue import RETRY_SEP
+        from repoze.sendmail.queue import retry_info
+        self._retryPolicy(initial=60, max_age=None)
+        self.qp.ignore_transient = True
+        now = int(time.time())
+        name = 'message%sR3.%d.%d' % (RETRY_SEP, now - 1, now - 1000)
+        filename = os.path.join(self.dir, name)
+        with open(filename, 'wb') as f:
+            f.write(b('X-Actually-To: a@example.com\n\nBody\n'))
+        self.qp.maildir.files = [filename]
+        self.qp.send_messages()
+        name, = os.listdir(self.dir)
+        attempts, due, since = retry_info(name)
+        self.assertEqual(attempts, 4)
+        self.assertTrue(abs(due - time.time() - 480) < 2)
+        self.assertEqual(since, now - 1000)
+        self.assertTrue(name.startswith('message%sR4.' % RETRY_SEP))
+        self.assertEqual(self.qp.log.errors, [])
+
+    def test_retry_moves_new_to_cur(self):
+        self._retryPolicy()
+        os.mkdir(os.path.join(self.dir, 'new'))
+        os.mkdir(os.path.join(self.dir, 'cur'))
+        filename = os.path.join(self.dir, 'new', 'message')
+        with open(filename, 'wb') as f:
+            f.write(b('X-Actually-To: a@example.com\n\nBody\n'))
+        self.qp.maildir.files = [filename]
+        self.qp.send_messages()
+        self.assertEqual(os.listdir(os.path.join(self.dir, 'new')), [])
+        self.assertEqual(len(os.listdir(os.path.join(self.dir, 'cur'))), 1)
+
+    def test_retry_gives_up(self):
+        self._retryPolicy(max_attempts=1)
+        filename, = self._writeTo('a@example.com')
+        self.qp.send_messages()
+        self.assertFalse(os.path.exists(filename))
+        dead = os.path.join(self.dir, 'dead')
+        self.assertEqual(os.listdir(dead), ['message0'])
+        self.assertEqual(sorted(os.listdir(self.dir)), ['dead'])
+        self.assertEqual(len(self.qp.log.errors), 2)
+
+    def test_retry_other_errors(self):
+        self._retryPolicy(dead_letter=os.path.join(self.dir, 'd'),
+                          max_age=0)
+        self.qp.mailer = BrokenMailerStub()
+        filename, = self._writeTo('a@example.com')
+        self.qp.send_messages()
+        self.assertEqual(os.listdir(os.path.join(self.dir, 'd')),
+                         ['message0'])
+
+    def test_stop(self):
+        filenames = self._writeMessages(2)
+        self.qp.stop()
+        self.qp.send_messages()
+        self.assertEqual(self.qp.mailer.sent_messages, [])
+        for filename in filenames:
+            self.assertTrue(os.path.exists(filename))
+
+    def test_stop_w_workers(self):
+        filenames = self._writeMessages(2)
+        self.qp.workers = 2
+        self.qp.stop()
+        self.qp.send_messages()
+        self.assertEqual(self.qp.mailer.sent_messages, [])
+        for filename in filenames:
+            self.assertTrue(os.path.exists(filename))
+
+
+class TestQueueProcessorClaims(TestCase):
+
+    def setUp(self):
+        from repoze.sendmail.maildir import Maildir
+        self.tmp = mkdtemp()
+        self.dir = os.path.join(self.tmp, 'queue')
+        self.maildir = Maildir(self.dir, create=True)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def _makeOne(self, claim, mailer=None):
+        from repoze.sendmail.queue import QueueProcessor
+        if mailer is None:
+            mailer = _makeRawMailerStub()
+        qp = QueueProcessor(mailer, self.dir, claim=claim)
+        qp.log = LoggerStub()
+        return qp
+
+    def _queue(self, name='message'):
+        filename = os.path.join(self.dir, 'new', name)
+        with open(filename, 'wb') as f:
+            f.write(b('X-Actually-From: foo@example.com\n') +
+                    b('X-Actually-To: bar@example.com\n') +
+                    b('Header: value\n\nBody\n'))
+        return filename
+
+    def _listdir(self, *names):
+        return sorted(os.listdir(os.path.join(self.dir, *names)))
+
+    def test_bad_claim(self):
+        self.assertRaises(ValueError, self._makeOne, 'steal')
+
+    def test_rename(self):
+        qp = self._makeOne('rename')
+        filename = self._queue()
+        qp.send_messages()
+        self.assertEqual(qp.mailer.sent_raw,
+                         [('foo@example.com', ('bar@example.com',),
+                           b('Header: value\n\nBody\n'))])
+        self.assertFalse(os.path.exists(filename))
+        claim_dir, = self._listdir('cur')
+        self.assertTrue(claim_dir.startswith('.sending-'))
+        self.assertEqual(self._listdir('cur', claim_dir), [])
+        self.assertEqual(self._listdir('new'), [])
+
+    def test_rename_claimed_elsewhere(self):
+        qp = self._makeOne('rename')
+        filename = self._queue()
+        self.assertTrue(qp._claim(filename) is not None)
+        self.assertEqual(qp._claim(filename), None)
+        self.assertEqual(qp.mailer.sent_raw, [])
+
+    def test_rename_released_on_failure(self):
+        qp = self._makeOne('rename', SMTPResponseExceptionMailerStub(451))
+        filename = self._queue()
+        qp.send_messages()
+        self.assertTrue(os.path.exists(filename))
+        self.assertEqual(len(qp.log.errors), 1)
+
+    def test_rename_reject(self):
+        qp = self._makeOne('rename', SMTPResponseExceptionMailerStub(550))
+        filename = self._queue()
+        qp.send_messages()
+        self.assertEqual(self._listdir('new'), ['.rejected-message'])
+
+    def test_rename_recovers_stale_claims(self):
+        import time
+        from repoze.sendmail import queue
+        qp = self._makeOne('rename')
+        stale_dir = os.path.join(self.dir, 'cur', '.sending-elsewhere.1.x')
+        os.mkdir(stale_dir)
+        with open(os.path.join(stale_dir, 'stale'), 'wb') as f:
+            f.write(b('X-Actually-To: bar@example.com\n\nBody\n'))
+        qp._recover()
+        self.assertEqual(self._listdir('cur', '.sending-elsewhere.1.x'),
+                         ['stale'])
+        monkey = _Monkey(queue, MAX_SEND_TIME=-1)
+        monkey.__enter__()
+        try:
+            qp._recover()
+        finally:
+            monkey.__exit__()
+        self.assertEqual(self._listdir('cur'), ['stale'])
+        qp.send_messages()
+        self.assertEqual(len(qp.mailer.sent_raw), 1)
+
+    def test_flock(self):
+        qp = self._makeOne('flock')
+        filename = self._queue()
+        qp.send_messages()
+        self.assertEqual(len(qp.mailer.sent_raw), 1)
+        self.assertFalse(os.path.exists(filename))
+        self.assertEqual(self._listdir('new'), [])
+
+    def test_flock_claimed_elsewhere(self):
+        qp = self._makeOne('flock')
+        filename = self._queue()
+        claim = qp._claim(filename)
+        try:
+            self.assertEqual(qp._claim(filename), None)
+            qp.send_messages()
+            self.assertEqual(qp.mailer.sent_raw, [])
+        finally:
+            claim.close()
+        qp.send_messages()
+        self.assertEqual(len(qp.mailer.sent_raw), 1)
+
+    def test_flock_sent_meanwhile(self):
+        qp = self._makeOne('flock')
+        filename = self._queue()
+        os.link(filename, filename + '.keep')
+        f = open(filename, 'rb')
+        os.remove(filename)
+        os.remove(filename + '.keep')
+        f.close()
+        self.assertEqual(qp._claim(filename), None)
+
+    def test_flock_released_on_failure(self):
+        qp = self._makeOne('flock', SMTPResponseExceptionMailerStub(451))
+        qp.ignore_transient = True
+        filename = self._queue()
+        qp.send_messages()
+        self.assertTrue(os.path.exists(filename))
+        claim = qp._claim(filename)
+        self.assertTrue(claim is not None)
+        claim.close()
+
+    def test_flock_retry_later(self):
+        from repoze.sendmail.queue import RetryPolicy
+        qp = self._makeOne('flock', SMTPResponseExceptionMailerStub(451))
+        qp.retry = RetryPolicy()
+        self._queue()
+        qp.send_messages()
+        self.assertEqual(self._listdir('new'), [])
+        name, = self._listdir('cur')
+        self.assertTrue(name.startswith('message'))
+
+    def _queueTo(self, *toaddrs):
+        filename = os.path.join(self.dir, 'new', 'message')
+        with open(filename, 'wb') as f:
+            f.write(b('X-Actually-From: foo@example.com\n') +
+                    b('X-Actually-To: ') +
+                    b(',\n ').join(b(addr) for addr in toaddrs) + b('\n') +
+                    b('X-Actually-Cleaned: yes\n') +
+                    b('Header: value\n\nBody\n'))
+        return filename
+
+    def test_deferred_recipients_stay_queued(self):
+        mailer = _DeferringMailerStub(
+            {'b@example.org': (451, 'Try later')},
+            {'c@example.net': (550, 'No such user')})
+        qp = self._makeOne('rename', mailer)
+        filename = self._queueTo('a@example.com', 'b@example.org',
+                                 'c@example.net')
+        qp.send_messages()
+        with open(filename, 'rb') as f:
+            data = f.read()
+            f.seek(0)
+            self.assertEqual(qp._readMessage(f),
+                             ('foo@example.com', ('b@example.org',),
+                              b('Header: value\n\nBody\n')))
+        self.assertTrue(data.endswith(b('\nX-Actually-From: foo@example.com\n'
+                                        'X-Actually-Cleaned: yes\n'
+                                        'Header: value\n\nBody\n')))
+        self.assertEqual(self._listdir('new'), ['message'])
+        self.assertEqual(
+            qp.log.errors,
+            [('Mail from %s to %s refused: %s %s',
+              ('foo@example.com', 'c@example.net', 550, 'No such user'),
+              {})])
+        self.assertEqual(
+            qp.log.infos,
+            [('Mail from %s to %s deferred: %s %s',
+              ('foo@example.com', 'b@example.org', 451, 'Try later'), {})])
+
+        mailer.deferred = None
+        qp.send_messages()
+        self.assertEqual([toaddrs for f, toaddrs, m in mailer.sent_raw],
+                         [('a@example.com', 'b@example.org',
+                           'c@example.net'),
+                          ('b@example.org',)])
+        self.assertEqual(self._listdir('new'), [])
+
+    def test_deferred_recipients_retried_later(self):
+        from repoze.sendmail.queue import RetryPolicy
+        from repoze.sendmail.queue import retry_info
+        mailer = _DeferringMailerStub({'b@example.org': (421, 'Busy')})
+        qp = self._makeOne('flock', mailer)
+        qp.retry = RetryPolicy()
+        self._queueTo('a@example.com', 'b@example.org')
+        qp.send_messages()
+        self.assertEqual(self._listdir('new'), [])
+        name, = self._listdir('cur')
+        self.assertEqual(retry_info(name)[0], 1)
+        with open(os.path.join(self.dir, 'cur', name), 'rb') as f:
+            fromaddr, toaddrs, message = qp._readMessage(f)
+        self.assertEqual(toaddrs, ('b@example.org',))
+
+    def test_refused_recipients_logged(self):
+        mailer = _DeferringMailerStub(None,
+                                      {'c@example.net': (550, 'No')})
+        qp = self._makeOne('link', mailer)
+        self._queueTo('a@example.com', 'c@example.net')
+        qp.send_messages()
+        self.assertEqual(self._listdir('new'), [])
+        self.assertEqual(len(qp.log.errors), 1)
+        self.assertEqual(qp.log.errors[0][1][1], 'c@example.net')
+
+
+class TestQueueProcessorShards(TestCase):
+
+    def setUp(self):
+        from repoze.sendmail.maildir import Maildir
+        self.tmp = mkdtemp()
+        self.dir = os.path.join(self.tmp, 'queue')
+        self.maildir = Maildir(self.dir, create=True)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def _makeOne(self, shard, lease_timeout=300):
+        from repoze.sendmail.queue import QueueProcessor
+        qp = QueueProcessor(_makeRawMailerStub(), self.dir, shard=shard,
+                            lease_timeout=lease_timeout)
+        qp.log = LoggerStub()
+        return qp
+
+    def _queue(self, count):
+        for i in range(count):
+            filename = os.path.join(self.dir, 'new',
+                                    '1234.%d.host.%d' % (i, i))
+            with open(filename, 'wb') as f:
+                f.write(b('X-Actually-To: bar%d@example.com\n\nBody\n' % i))
+
+    def _sent(self, qp):
+        return set(toaddrs[0] for fromaddr, toaddrs, message in
+                   qp.mailer.sent_raw)
+
+    def test_parse_shard(self):
+        from repoze.sendmail.queue import parse_shard
+        self.assertEqual(parse_shard('2/3'), (2, 3))
+        for value in ('0/3', '4/3', '3', 'a/b', '1/2/3'):
+            self.assertRaises(ValueError, parse_shard, value)
+
+    def test_shard_of(self):
+        from repoze.sendmail.queue import RETRY_SEP
+        from repoze.sendmail.queue import shard_of
+        shards = [shard_of('/q/new/1234.%d.host.1' % i, 4)
+                  for i in range(100)]
+        self.assertEqual(set(shards), set([1, 2, 3, 4]))
+        # retry information does not move a message to another shard
+        self.assertEqual(
+            shard_of('/q/cur/1234.1.host.1%sR1.2.3' % RETRY_SEP, 4),
+            shard_of('/q/new/1234.1.host.1', 4))
+
+    def test_shards_split_queue(self):
+        self._queue(20)
+        first = self._makeOne((1, 2))
+        second = self._makeOne((2, 2))
+        first.send_messages()
+        self.assertTrue(0 < len(first.mailer.sent_raw) < 20)
+        second.send_messages()
+        sent = self._sent(first) | self._sent(second)
+        self.assertEqual(len(sent), 20)
+        self.assertFalse(self._sent(first) & self._sent(second))
+        self.assertEqual(sorted(os.listdir(os.path.join(self.dir, 'shards'))),
+                         ['1-of-2', '2-of-2'])
+
+    def test_takes_over_stale_shard(self):
+        import time
+        self._queue(20)
+        first = self._makeOne((1, 2), lease_timeout=60)
+        second = self._makeOne((2, 2), lease_timeout=60)
+        second._renew_lease(time.time())
+        first.send_messages()
+        self.assertTrue(len(first.mailer.sent_raw) < 20)
+        lease = second._lease(2)
+        os.utime(lease, (time.time() - 120, time.time() - 120))
+        first.send_messages()
+        self.assertEqual(len(self._sent(first)), 20)
+        self.assertTrue(("Taking over shards %s of %d.", ('2', 2), {})
+                        in first.log.infos)
+
+    def test_missing_lease_taken_over_after_timeout(self):
+        self._queue(20)
+        first = self._makeOne((1, 2), lease_timeout=60)
+        first.send_messages()
+        self.assertTrue(len(first.mailer.sent_raw) < 20)
+        first._started -= 120
+        first.send_messages()
+        self.assertEqual(len(self._sent(first)), 20)
+
+    def test_lease_renewed_during_pass(self):
+        qp = self._makeOne((1, 1), lease_timeout=60)
+        qp._renew_lease(0)
+        qp._in_shards('/q/new/1234.1.host.1')
+        self.assertTrue(qp._renewed > 0)
+
+    def test_lease_renewed_while_sending(self):
+        self._queue(3)
+        qp = self._makeOne((1, 1), lease_timeout=60)
+        renewals = []
+        renew_lease = qp._renew_lease
+        def _renew_lease(now):
+            renewals.append(now)
+            renew_lease(now)
+        qp._renew_lease = _renew_lease
+        send_raw = qp.mailer.send_raw
+        def _send_raw(fromaddr, toaddrs, message):
+            send_raw(fromaddr, toaddrs, message)
+            # each message takes half the lease to send
+            qp._renewed -= 30
+        qp.mailer.send_raw = _send_raw
+        qp.send_messages()
+        self.assertEqual(len(qp.mailer.sent_raw), 3)
+        # once at the start of the pass, then before the 2nd and 3rd
+        self.assertEqual(len(renewals), 3)
+
+
+class TestRetryPolicy(TestCase):
+
+    def _makeOne(self, **kw):
+        from repoze.sendmail.queue import RetryPolicy
+        return RetryPolicy(**kw)
+
+    def test_delay(self):
+        policy = self._makeOne(initial=10, factor=3, maximum=100, jitter=0)
+        self.assertEqual([policy.delay(n) for n in range(1, 5)],
+                         [10, 30, 90, 100])
+
+    def test_delay_jitter(self):
+        policy = self._makeOne(initial=100, jitter=0.1)
+        for i in range(20):
+            self.assertTrue(90 <= policy.delay(1) <= 110)
+
+    def test_expired(self):
+        policy = self._makeOne(max_age=100, max_attempts=5)
+        self.assertFalse(policy.expired(1, 1000, 1050))
+        self.assertTrue(policy.expired(1, 1000, 1101))
+        self.assertTrue(policy.expired(5, 1000, 1001))
+        policy = self._makeOne(max_age=None)
+        self.assertFalse(policy.expired(1000, 0, 10 ** 9))
+
+    def test_retry_info(self):
+        from repoze.sendmail.queue import RETRY_SEP
+        from repoze.sendmail.queue import retry_info
+        self.assertEqual(retry_info('/q/cur/123.4.host.5'), (0, 0, 0))
+        self.assertEqual(
+            retry_info('/q/cur/123.4.host.5%sR2.300.123' % RETRY_SEP),
+            (2, 300, 123))
+        self.assertEqual(retry_info('123.4.host.5%s2,S' % RETRY_SEP),
+                         (0, 0, 0))
+        self.assertEqual(retry_info('123.4.host.5%sRx.y.z' % RETRY_SEP),
+                         (0, 0, 0))
+
+
+class TestQueueWatcher(TestCase):
+
+    def setUp(self):
+        self.dir = mkdtemp()
+        os.mkdir(os.path.join(self.dir, 'new'))
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def _makeOne(self, interval=5):
+        from repoze.sendmail.queue import QueueWatcher
+        watcher = QueueWatcher(self.dir, interval)
+        watcher.poll_interval = 0.01
+        self.addCleanup(watcher.close)
+        return watcher
+
+    def _touch(self):
+        with open(os.path.join(self.dir, 'new', 'message'), 'w'):
+            pass
+
+    def test_wait_timeout(self):
+        watcher = self._makeOne(interval=0.05)
+        self.assertFalse(watcher.wait())
+
+    def test_wake(self):
+        import time
+        watcher = self._makeOne()
+        watcher.wake()
+        start = time.time()
+        self.assertFalse(watcher.wait())
+        self.assertTrue(time.time() - start < 1)
+
+    def test_wait_new_message(self):
+        import threading
+        watcher = self._makeOne()
+        threading.Timer(0.05, self._touch).start()
+        self.assertTrue(watcher.wait())
+
+    def test_wait_new_message_polling(self):
+        import threading
+        with _Monkey(queue, HAVE_INOTIFY=False):
+            watcher = self._makeOne()
+        self.assertEqual(watcher._inotify, None)
+        # make sure the directory's mtime will differ
+        os.utime(watcher.path, (1, 1))
+        watcher._mtime = 1
+        threading.Timer(0.05, self._touch).start()
+        self.assertTrue(watcher.wait())
+
+
 class TestConsoleApp(TestCase):
     def setUp(self):
         from repoze.sendmail.delivery import QueuedMailDelivery
@@ -309,6 +1023,27 @@ class TestConsoleApp(TestCase):
         self.assertFalse(app.force_tls)
         self.assertFalse(app.no_tls)
         self.assertFalse(app.debug_smtp)
+        self.assertEqual(1, app.workers)
+        self.assertEqual(None, app.mailer.pool)
+
+    def test_args_relays(self):
+        cmdline = ("qp --relay a:587*2 --relay b --relay-strategy latency %s"
+                   % self.dir)
+        app = ConsoleApp(cmdline.split())
+        self.assertFalse(app._error)
+        self.assertEqual("a:587*2 b", app.relays)
+        relays = app.mailer.relays
+        self.assertEqual(relays.strategy, "latency")
+        self.assertEqual([(r.hostname, r.port, r.weight)
+                          for r in relays.relays],
+                         [("a", 587, 2), ("b", 25, 1)])
+
+    def test_args_relays_error(self):
+        for args in ("--relay", "--relay a:b", "--relay-strategy random",
+                     "--relay-strategy"):
+            cmdline = "qp %s %s" % (args, self.dir)
+            app, logged = self._captureLoggedErrors(cmdline)
+            self.assertTrue(app._error, args)
 
     def test_args_simple_error(self):
         # Simplest case that doesn't work
@@ -346,6 +1081,135 @@ class TestConsoleApp(TestCase):
         self.assertFalse(app.no_tls)
         self.assertTrue(app.debug_smtp)
 
+    def test_args_workers(self):
+        cmdline = "qp --workers 4 %s" % self.dir
+        app = ConsoleApp(cmdline.split())
+        self.assertFalse(app._error)
+        self.assertEqual(4, app.workers)
+        self.assertEqual(4, app.mailer.pool.size)
+
+    def test_args_bad_workers(self):
+        for workers in ('foo', '0'):
+            cmdline = 'qp --workers %s %s' % (workers, self.dir)
+            app, logged = self._captureLoggedErrors(cmdline)
+            self.assertTrue(app._error)
+            self.assertEqual(len(logged), 1)
+
+    def test_args_schedule(self):
+        cmdline = "qp --schedule domain --session-limit 5 %s" % self.dir
+        app = ConsoleApp(cmdline.split())
+        self.assertFalse(app._error)
+        self.assertEqual("domain", app.schedule)
+        self.assertEqual(5, app.session_limit)
+
+    def test_args_bad_schedule(self):
+        for args in ("--schedule", "--schedule random",
+                     "--session-limit 0", "--session-limit foo"):
+            cmdline = "qp %s %s" % (args, self.dir)
+            app, logged = self._captureLoggedErrors(cmdline)
+            self.assertTrue(app._error, args)
+
+    def test_args_shard(self):
+        cmdline = "qp --shard 2/3 --lease-timeout 60 %s" % self.dir
+        app = ConsoleApp(cmdline.split())
+        self.assertFalse(app._error)
+        self.assertEqual((2, 3), app._make_shard())
+        self.assertEqual(60, app.lease_timeout)
+        for args in ("--shard", "--shard 4/3", "--lease-timeout 0"):
+            cmdline = "qp %s %s" % (args, self.dir)
+            app, logged = self._captureLoggedErrors(cmdline)
+            self.assertTrue(app._error, args)
+
+    def test_args_claim(self):
+        cmdline = "qp --claim rename %s" % self.dir
+        app = ConsoleApp(cmdline.split())
+        self.assertFalse(app._error)
+        self.assertEqual("rename", app.claim)
+        for args in ("--claim", "--claim steal"):
+            cmdline = "qp %s %s" % (args, self.dir)
+            app, logged = self._captureLoggedErrors(cmdline)
+            self.assertTrue(app._error, args)
+
+    def test_args_order(self):
+        cmdline = "qp --order name %s" % os.path.join(self.dir, 'queue')
+        app = ConsoleApp(cmdline.split())
+        self.assertFalse(app._error)
+        self.assertEqual("name", app.order)
+        app.mailer = _makeMailerStub()
+        app._send_messages()
+        self.assertEqual("name", app._qp.maildir.order)
+        cmdline = "qp --order none %s" % self.dir
+        app = ConsoleApp(cmdline.split())
+        self.assertFalse(app._error)
+        self.assertEqual(None, app.order)
+        for args in ("--order", "--order random"):
+            cmdline = "qp %s %s" % (args, self.dir)
+            app, logged = self._captureLoggedErrors(cmdline)
+            self.assertTrue(app._error, args)
+
+    def test_args_retry(self):
+        cmdline = "qp --backoff 30 --max-age 3600 %s" % self.dir
+        app = ConsoleApp(cmdline.split())
+        self.assertFalse(app._error)
+        retry = app._make_retry()
+        self.assertEqual(retry.initial, 30)
+        self.assertEqual(retry.max_age, 3600)
+        app = ConsoleApp(("qp %s" % self.dir).split())
+        self.assertEqual(app._make_retry(), None)
+        for args in ("--backoff", "--backoff 0", "--max-age foo"):
+            cmdline = "qp %s %s" % (args, self.dir)
+            app, logged = self._captureLoggedErrors(cmdline)
+            self.assertTrue(app._error, args)
+
+    def test_args_rates(self):
+        cmdline = "qp --rate 10 --relay-rate 2.5 --domain-rate 1 %s" % (
+            self.dir)
+        app = ConsoleApp(cmdline.split())
+        self.assertFalse(app._error)
+        limiter = app.mailer.rate_limit
+        self.assertEqual(limiter.bucket.rate, 10)
+        self.assertEqual(limiter.relay_rate, 2.5)
+        self.assertEqual(limiter.domain_rate, 1)
+        app = ConsoleApp(("qp %s" % self.dir).split())
+        self.assertEqual(app.mailer.rate_limit, None)
+
+    def test_args_bad_rates(self):
+        for args in ("--rate", "--rate foo", "--relay-rate 0",
+                     "--domain-rate -1"):
+            cmdline = "qp %s %s" % (args, self.dir)
+            app, logged = self._captureLoggedErrors(cmdline)
+            self.assertTrue(app._error, args)
+
+    def test_args_daemon(self):
+        cmdline = "qp --daemon --interval 5 %s" % self.dir
+        app = ConsoleApp(cmdline.split())
+        self.assertFalse(app._error)
+        self.assertTrue(app.daemon)
+        self.assertEqual(5, app.interval)
+
+    def test_args_bad_interval(self):
+        for interval in ('foo', '0', '-5', 'nan'):
+            cmdline = 'qp --interval %s %s' % (interval, self.dir)
+            app, logged = self._captureLoggedErrors(cmdline)
+            self.assertTrue(app._error, interval)
+            self.assertEqual(len(logged), 1)
+
+    def test_ini_bad_interval(self):
+        ini_path = os.path.join(self.dir, "qp.ini")
+        for interval in ('foo', '0', '-5'):
+            with open(ini_path, "w") as f:
+                f.write("[app:qp]\ninterval = %s\nqueue_path = %s\n"
+                        % (interval, self.dir))
+            cmdline = "qp --config %s" % ini_path
+            app, logged = self._captureLoggedErrors(cmdline)
+            self.assertTrue(app._error, interval)
+            self.assertEqual(len(logged), 1)
+        # the command line overrides the config file
+        cmdline = "qp --config %s --interval 5" % ini_path
+        app = ConsoleApp(cmdline.split())
+        self.assertFalse(app._error)
+        self.assertEqual(5, app.interval)
+
     def test_args_username_no_password(self):
         # Test username without password
         cmdline = "qp --username chris %s" % self.dir
@@ -427,6 +1291,27 @@ class TestConsoleApp(TestCase):
         self.assertFalse(app.force_tls)
         self.assertTrue(app.no_tls)
         self.assertIs(app.debug_smtp, True)
+        self.assertEqual(3, app.workers)
+        self.assertEqual(33, app.interval)
+        self.assertFalse(app.daemon)
+        self.assertEqual("relay1 relay2:587*3", app.relays)
+        self.assertEqual("least-in-flight", app.relay_strategy)
+        self.assertEqual(2, len(app.mailer.relays))
+        self.assertEqual("domain", app.schedule)
+        self.assertEqual(50, app.session_limit)
+        self.assertEqual(20, app.rate)
+        self.assertEqual(None, app.relay_rate)
+        self.assertEqual(20, app.mailer.rate_limit.bucket.rate)
+        self.assertEqual(120, app.backoff)
+        self.assertEqual(86400, app.max_age)
+        self.assertEqual("flock", app.claim)
+        self.assertEqual("1/2", app.shard)
+        self.assertEqual(None, app.order)
+
+        # Relays on the command line replace those from the config file
+        cmdline = "qp --config %s --relay relay3" % ini_path
+        app = ConsoleApp(cmdline.split())
+        self.assertEqual("relay3", app.relays)
 
         # Override nothing, make sure defaults come through
         f = open(ini_path, "w")
@@ -446,6 +1331,7 @@ class TestConsoleApp(TestCase):
         self.assertFalse(app.no_tls)
         self.assertFalse(app.debug_smtp)
         self.assertIs(app.debug_smtp, False)
+        self.assertEqual("mtime", app.order)
 
     def test_delivery(self):
         from email.message import Message
@@ -474,6 +1360,176 @@ class TestConsoleApp(TestCase):
         self.assertEqual(0, len(queued_messages))
         self.assertEqual(2, len(self.mailer.sent_messages))
 
+    def test_delivery_w_workers(self):
+        from email.message import Message
+        import transaction
+        transaction.manager.begin()
+        for i in range(5):
+            message = Message()
+            message['Subject'] = 'Pants %d' % i
+            message.set_payload('Nice pants, mister!')
+            self.delivery.send("foo@bar.foo", ["bar@foo.bar"], message)
+        transaction.manager.commit()
+
+        cmdline = "qp --workers 3 %s" % self.queue_dir
+        app = ConsoleApp(cmdline.split())
+        app.mailer = self.mailer
+        app.main()
+
+        self.assertEqual(0, len(list(self.maildir)))
+        self.assertEqual(5, len(self.mailer.sent_messages))
+
+    def _queueMessages(self, count):
+        from email.message import Message
+        import transaction
+        transaction.manager.begin()
+        for i in range(count):
+            message = Message()
+            message['Subject'] = 'Pants %d' % i
+            message.set_payload('Nice pants, mister!')
+            self.delivery.send("foo@bar.foo", ["bar@foo.bar"], message)
+        transaction.manager.commit()
+
+    def test_daemon_stop(self):
+        import signal
+        self._queueMessages(2)
+        cmdline = "qp --daemon %s" % self.queue_dir
+        app = ConsoleApp(cmdline.split())
+        app.mailer = mailer = _SignallingMailerStub(app, signal.SIGTERM)
+        before = signal.getsignal(signal.SIGTERM)
+        app.main()
+
+        # the message being sent is finished, the other one is left alone
+        self.assertEqual(1, len(mailer.sent_messages))
+        self.assertEqual(1, len(list(self.maildir)))
+        self.assertEqual(before, signal.getsignal(signal.SIGTERM))
+
+    def test_processor_kept_between_passes(self):
+        cmdline = "qp --shard 1/2 %s" % self.queue_dir
+        app = ConsoleApp(cmdline.split())
+        app.mailer = self.mailer
+        app._send_messages()
+        qp = app._qp
+        qp.log = LoggerStub()
+        app._send_messages()
+        self.assertTrue(app._qp is qp)
+        # shard 2 never had a lease; it is taken over once
+        qp._started -= 600
+        app._send_messages()
+        app._send_messages()
+        self.assertEqual(qp.log.infos,
+                         [("Taking over shards %s of %d.", ('2', 2), {})])
+
+    def test_daemon_reload(self):
+        import signal
+        self._queueMessages(2)
+        ini_path = os.path.join(self.dir, "qp.ini")
+        with open(ini_path, "w") as f:
+            f.write("[app:qp]\nhostname = first\n")
+        cmdline = "qp --daemon --config %s %s" % (ini_path, self.queue_dir)
+        app = ConsoleApp(cmdline.split())
+        self.assertEqual('first', app.hostname)
+        app.mailer = first = _SignallingMailerStub(app, signal.SIGHUP)
+        second = _SignallingMailerStub(app, signal.SIGTERM)
+        def _make_mailer():
+            self.assertEqual('second', app.hostname)
+            qps.append(app._qp)
+            return second
+        qps = []
+        app._make_mailer = _make_mailer
+        with open(ini_path, "w") as f:
+            f.write("[app:qp]\nhostname = second\n")
+        app.main()
+
+        self.assertEqual(1, len(first.sent_messages))
+        self.assertEqual(1, len(second.sent_messages))
+        self.assertEqual(0, len(list(self.maildir)))
+        # a new processor for the new configuration
+        self.assertEqual(len(qps), 1)
+        self.assertTrue(app._qp is not qps[0])
+
+    def test_daemon_waits_for_messages(self):
+        import signal
+        import threading
+        cmdline = "qp --daemon %s" % self.queue_dir
+        app = ConsoleApp(cmdline.split())
+        app.mailer = self.mailer
+        def _deliver():
+            self._queueMessages(1)
+            # give the daemon a chance to pick up the message before
+            # asking it to stop
+            threading.Timer(
+                0.5, app._handle_signal, (signal.SIGTERM, None)).start()
+        threading.Timer(0.1, _deliver).start()
+        app.main()
+        self.assertEqual(1, len(self.mailer.sent_messages))
+
+
+def _makeRawMailerStub():
+    mailer = _makeMailerStub()
+    mailer.sent_raw = []
+    def send_raw(fromaddr, toaddrs, message):
+        mailer.sent_raw.append((fromaddr, toaddrs, message))
+    mailer.send_raw = send_raw
+    return mailer
+
+
+class _DeferringMailerStub(object):
+    # Refuses `refused` for good, and `deferred` for now, if given.
+
+    def __init__(self, deferred, refused=None):
+        self.deferred = deferred
+        self.refused = refused
+        self.sent_raw = []
+
+    def send_raw(self, fromaddr, toaddrs, message):
+        from repoze.sendmail.mx import DeferredRecipients
+        self.sent_raw.append((fromaddr, toaddrs, message))
+        if self.deferred:
+            raise DeferredRecipients(self.deferred, self.refused)
+        return self.refused
+
+
+class _SessionMailerStub(object):
+
+    def __init__(self):
+        self.sessions = []
+        self._lock = threading.Lock()
+
+    def session(self):
+        with self._lock:
+            sent = []
+            self.sessions.append(sent)
+        return _SessionStub(sent)
+
+
+class _SessionStub(object):
+
+    def __init__(self, sent):
+        self.sent = sent
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+    def send_raw(self, fromaddr, toaddrs, message):
+        self.sent.append(toaddrs)
+
+
+class _SignallingMailerStub(object):
+
+    def __init__(self, app, signum):
+        self.app = app
+        self.signum = signum
+        self.sent_messages = []
+
+    def send(self, fromaddr, toaddrs, message):
+        self.sent_messages.append((fromaddr, toaddrs, message))
+        self.app._handle_signal(self.signum, None)
+
+
 TEST_INI = """\
 [app:qp]
 interval = 33
@@ -485,6 +1541,17 @@ force_tls = False
 no_tls = True
 queue_path = hammer/dont/hurt/em
 debug_smtp = True
+workers = 3
+relays = relay1 relay2:587*3
+relay_strategy = least-in-flight
+schedule = domain
+session_limit = 50
+rate = 20
+backoff = 120
+max_age = 86400
+claim = flock
+shard = 1/2
+order = none
 """
 
 
@@ -0,0 +1,161 @@
+import unittest
+
+
+class TestIsThrottling(unittest.TestCase):
+
+    def _callFUT(self, error):
+        from repoze.sendmail.ratelimit import is_throttling
+        return is_throttling(error)
+
+    def test_codes(self):
+        from smtplib import SMTPDataError
+        from smtplib import SMTPRecipientsRefused
+        self.assertTrue(self._callFUT(SMTPDataError(421, 'Slow down')))
+        self.assertTrue(self._callFUT(SMTPDataError(451, 'Try later')))
+        self.assertFalse(self._callFUT(SMTPDataError(550, 'No')))
+        self.assertFalse(self._callFUT(IOError('gone')))
+        self.assertTrue(self._callFUT(SMTPRecipientsRefused(
+            {'a@example.com': (450, 'Later')})))
+        self.assertFalse(self._callFUT(SMTPRecipientsRefused(
+            {'a@example.com': (450, 'Later'), 'b@example.com': (550, 'No')})))
+
+
+class TestTokenBucket(unittest.TestCase):
+
+    def _makeOne(self, *args, **kw):
+        from repoze.sendmail.ratelimit import TokenBucket
+        return TokenBucket(*args, **kw)
+
+    def test_bad_rate(self):
+        self.assertRaises(ValueError, self._makeOne, 0)
+
+    def test_burst_then_wait(self):
+        bucket = self._makeOne(10, burst=2)
+        self.assertEqual(bucket.reserve(), 0)
+        self.assertEqual(bucket.reserve(), 0)
+        wait = bucket.reserve()
+        self.assertTrue(0.05 < wait <= 0.1, wait)
+        wait = bucket.reserve()
+        self.assertTrue(0.15 < wait <= 0.2, wait)
+
+    def test_refill(self):
+        bucket = self._makeOne(10, burst=1)
+        bucket.reserve()
+        bucket._updated -= 1
+        self.assertEqual(bucket.reserve(), 0)
+        self.assertEqual(bucket._tokens, 0)
+
+    def test_throttle_and_recover(self):
+        bucket = self._makeOne(10, burst=5, min_rate=3)
+        bucket.throttle()
+        self.assertEqual(bucket.rate, 5)
+        self.assertTrue(bucket._tokens <= 0)
+        self.assertTrue(bucket.reserve() > 0)
+        bucket.throttle()
+        self.assertEqual(bucket.rate, 3)
+        bucket.recover()
+        self.assertEqual(bucket.rate, 4)
+        for i in range(10):
+            bucket.recover()
+        self.assertEqual(bucket.rate, 10)
+
+    def test_idle(self):
+        bucket = self._makeOne(10, burst=1)
+        self.assertTrue(bucket.idle)
+        bucket.reserve()
+        self.assertFalse(bucket.idle)
+
+
+class TestRateLimiter(unittest.TestCase):
+
+    def _makeOne(self, **kw):
+        from repoze.sendmail.ratelimit import RateLimiter
+        limiter = RateLimiter(**kw)
+        limiter.slept = []
+        limiter.sleep = limiter.slept.append
+        return limiter
+
+    def test_no_limits(self):
+        limiter = self._makeOne()
+        self.assertEqual(limiter.buckets(['a@example.com'], 'relay'), [])
+        for i in range(100):
+            self.assertEqual(limiter.acquire(['a@example.com'], 'relay'), 0)
+        self.assertEqual(limiter.slept, [])
+
+    def test_global_limit(self):
+        limiter = self._makeOne(rate=10, burst=1)
+        limiter.acquire()
+        wait = limiter.acquire(['a@example.com'])
+        self.assertTrue(wait > 0)
+        self.assertEqual(limiter.slept, [wait])
+
+    def test_reserve_does_not_wait(self):
+        limiter = self._makeOne(rate=10, burst=1)
+        self.assertEqual(limiter.reserve(), 0)
+        wait = limiter.reserve(['a@example.com'])
+        self.assertTrue(wait > 0)
+        self.assertTrue(limiter.reserve() > wait)
+        self.assertEqual(limiter.slept, [])
+
+    def test_relay_limit(self):
+        limiter = self._makeOne(relay_rate=10, relay_burst=1)
+        limiter.acquire((), 'relay1')
+        self.assertEqual(limiter.acquire((), 'relay2'), 0)
+        self.assertEqual(limiter.acquire(), 0)
+        self.assertTrue(limiter.acquire((), 'relay1') > 0)
+
+    def test_domain_limit(self):
+        limiter = self._makeOne(domain_rate=10, domain_burst=1)
+        limiter.acquire(['a@example.com'])
+        self.assertEqual(limiter.acquire(['b@example.org']), 0)
+        self.assertTrue(limiter.acquire(['c@Example.COM']) > 0)
+        self.assertEqual(len(limiter.buckets(['x@a.com', 'y@b.com',
+                                              'z@a.com'])), 2)
+
+    def test_max_buckets(self):
+        limiter = self._makeOne(domain_rate=10)
+        limiter.max_buckets = 2
+        limiter.acquire(['a@a.com'])
+        limiter.buckets(['b@b.com'])
+        limiter.buckets(['c@c.com'])
+        self.assertEqual(sorted(limiter._domains), ['a.com', 'c.com'])
+
+    def test_send_adapts(self):
+        from smtplib import SMTPDataError
+        limiter = self._makeOne(rate=10, relay_rate=20)
+        sent = []
+
+        def send(fromaddr, toaddrs, message):
+            sent.append(message)
+            return 'result'
+
+        def throttled(fromaddr, toaddrs, message):
+            raise SMTPDataError(421, 'Slow down')
+        self.assertRaises(SMTPDataError, limiter.send, throttled,
+                          'me@example.com', ['a@example.com'], b'One',
+                          relay='relay')
+        relay = limiter._relays['relay']
+        self.assertEqual(limiter.bucket.rate, 5)
+        self.assertEqual(relay.rate, 10)
+        self.assertEqual(limiter.send(send, 'me@example.com',
+                                      ['a@example.com'], b'Two',
+                                      relay='relay'), 'result')
+        self.assertEqual(sent, [b'Two'])
+        self.assertEqual(limiter.bucket.rate, 6)
+        self.assertEqual(relay.rate, 12)
+
+    def test_send_permanent_error_not_adapted(self):
+        from smtplib import SMTPDataError
+        limiter = self._makeOne(rate=10)
+
+        def refused(fromaddr, toaddrs, message):
+            raise SMTPDataError(550, 'No')
+        self.assertRaises(SMTPDataError, limiter.send, refused,
+                          'me@example.com', ['a@example.com'], b'One')
+        self.assertEqual(limiter.bucket.rate, 10)
+
+    def test_not_adaptive(self):
+        from smtplib import SMTPDataError
+        limiter = self._makeOne(rate=10, adaptive=False)
+        limiter.failed(SMTPDataError(421, 'Slow down'))
+        self.assertEqual(limiter.bucket.rate, 10)
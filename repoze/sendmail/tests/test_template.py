@@ -0,0 +1,204 @@
+import unittest
+
+
+class Test_substitute(unittest.TestCase):
+
+    def _callFUT(self, text, values):
+        from repoze.sendmail.template import substitute
+        return substitute(text, values)
+
+    def test_substitute(self):
+        self.assertEqual(self._callFUT(u'${a}, ${b_1} $a ${a}',
+                                       {'a': u'A', 'b_1': 1}),
+                         u'A, 1 $a A')
+        self.assertRaises(KeyError, self._callFUT, u'${a}', {})
+
+
+class TestMessageTemplate(unittest.TestCase):
+
+    def _makeOne(self, message, **kw):
+        from repoze.sendmail.template import MessageTemplate
+        return MessageTemplate(message, **kw)
+
+    def _makeMessage(self):
+        from email.mime import application
+        from email.mime import multipart
+        from email.mime import text
+        message = multipart.MIMEMultipart('mixed')
+        message['From'] = u'Caf\xe9 <news@example.com>'
+        message['To'] = u'${name} <${email}>'
+        message['Subject'] = u'Hello ${name}'
+        alternative = multipart.MIMEMultipart('alternative')
+        alternative.attach(text.MIMEText(u'Dear ${name},\nhi\n', 'plain'))
+        alternative.attach(text.MIMEText(u'<p>${name} €</p>', 'html',
+                                         'utf-8'))
+        message.attach(alternative)
+        attachment = application.MIMEApplication(b'x' * 1000)
+        attachment.add_header('Content-Disposition', 'attachment',
+                              filename='${name}.txt')
+        message.attach(attachment)
+        return message
+
+    def _parse(self, rendered):
+        from repoze.sendmail._compat import PY_2
+        if PY_2:  # pragma NO COVER
+            from email import message_from_string as parse
+        else:
+            from email import message_from_bytes as parse
+        return parse(rendered)
+
+    def _texts(self, message):
+        return [part.get_payload(decode=True).decode(
+                    part.get_content_charset())
+                for part in message.walk()
+                if part.get_content_maintype() == 'text']
+
+    def test_ctor_not_message(self):
+        self.assertRaises(ValueError, self._makeOne, b'Not a Message')
+
+    def test_message_unchanged(self):
+        message = self._makeMessage()
+        before = message.as_string()
+        self._makeOne(message)
+        self.assertEqual(message.as_string(), before)
+
+    def test_render(self):
+        template = self._makeOne(self._makeMessage())
+        rendered = template.render({'name': 'Chris',
+                                    'email': 'chris@example.com'})
+        self.assertTrue(isinstance(rendered, bytes))
+        rendered.decode('ascii')
+        self.assertTrue(b'\nTo: Chris <chris@example.com>\n' in rendered)
+        self.assertTrue(b'\nSubject: Hello Chris\n' in rendered)
+        self.assertFalse(b'${' in rendered)
+        message = self._parse(rendered)
+        self.assertEqual(message['From'],
+                         '=?iso-8859-1?q?Caf=E9?= <news@example.com>')
+        self.assertEqual(self._texts(message),
+                         [u'Dear Chris,\nhi\n', u'<p>Chris €</p>'])
+        parts = list(message.walk())
+        self.assertEqual(parts[2].get_content_charset(), 'us-ascii')
+        self.assertEqual(parts[4].get_filename(), 'Chris.txt')
+        self.assertEqual(parts[4].get_payload(decode=True), b'x' * 1000)
+
+    def test_render_non_ascii(self):
+        template = self._makeOne(self._makeMessage())
+        rendered = template.render({'name': u'R\xe9my',
+                                    'email': 'remy@example.com'})
+        rendered.decode('ascii')
+        message = self._parse(rendered)
+        self.assertEqual(message['To'],
+                         '=?iso-8859-1?q?R=E9my?= <remy@example.com>')
+        self.assertEqual(message['Subject'], '=?iso-8859-1?q?Hello_R=E9my?=')
+        self.assertEqual(self._texts(message),
+                         [u'Dear R\xe9my,\nhi\n', u'<p>R\xe9my €</p>'])
+        parts = list(message.walk())
+        # us-ascii does not fit any more, utf-8 still does.
+        self.assertEqual(parts[2].get_content_charset(), 'iso-8859-1')
+        self.assertEqual(parts[3].get_content_charset(), 'utf-8')
+
+    def test_render_invariant_parts(self):
+        template = self._makeOne(self._makeMessage())
+        one = template.render({'name': 'One', 'email': 'one@example.com'})
+        two = template.render({'name': 'Two', 'email': 'two@example.com'})
+        attachment = b'eHh4' * 19
+        one = one[one.index(attachment):]
+        two = two[two.index(attachment):]
+        self.assertEqual(one, two)
+        self.assertTrue(len(one) > 1000)
+
+    def test_render_message_id_and_date(self):
+        from email.message import Message
+        message = Message()
+        message['Subject'] = '${subject}'
+        template = self._makeOne(message)
+        one = self._parse(template.render({'subject': 'One'}))
+        two = self._parse(template.render({'subject': 'Two'}))
+        self.assertTrue('@' in one['Message-Id'])
+        self.assertNotEqual(one['Message-Id'], two['Message-Id'])
+        self.assertTrue(one['Date'])
+        message['Message-Id'] = '<1@example.com>'
+        message['Date'] = 'Mon, 19 May 2003 10:17:36 -0400'
+        template = self._makeOne(message)
+        one = self._parse(template.render({'subject': 'One'}))
+        self.assertEqual(one['Message-Id'], '<1@example.com>')
+        self.assertEqual(one['Date'], 'Mon, 19 May 2003 10:17:36 -0400')
+
+    def test_render_single_part(self):
+        from email.mime import text
+        message = text.MIMEText(u'${greeting}\n', 'plain', 'iso-8859-1')
+        message['Subject'] = 'Greeting'
+        template = self._makeOne(message)
+        rendered = self._parse(template.render({'greeting': u'Ol\xe1'}))
+        self.assertEqual(rendered.get_content_charset(), 'iso-8859-1')
+        self.assertEqual(self._texts(rendered), [u'Ol\xe1\n'])
+        rendered = self._parse(template.render({'greeting': u'€'}))
+        self.assertEqual(rendered.get_content_charset(), 'utf-8')
+        self.assertEqual(self._texts(rendered), [u'€\n'])
+
+    def test_render_parsed(self):
+        source = (u'Subject: Hi ${name}\n'
+                  u'Content-Type: text/plain; charset=utf-8\n'
+                  u'Content-Transfer-Encoding: 8bit\n\n'
+                  u'Hello ${name} \u20ac\n').encode('utf-8')
+        template = self._makeOne(self._parse(source))
+        rendered = template.render({'name': 'Chris'})
+        self.assertEqual(rendered.count(b'Content-Type:'), 1)
+        self.assertTrue(b'\nContent-Type: text/plain; charset="utf-8"\n'
+                        in rendered)
+        self.assertEqual(rendered.count(b'MIME-Version:'), 1)
+        message = self._parse(rendered)
+        self.assertEqual(message.get_params(),
+                         [('text/plain', ''), ('charset', 'utf-8')])
+        self.assertEqual(self._texts(message), [u'Hello Chris \u20ac\n'])
+
+    def test_render_wo_content_type(self):
+        from email.message import Message
+        message = Message()
+        message['Subject'] = 'Hi'
+        message.set_payload('Hello ${name}\n')
+        template = self._makeOne(message)
+        rendered = template.render({'name': 'Chris'})
+        self.assertEqual(rendered.count(b'charset'), 1)
+        self.assertTrue(b'\nContent-Type: text/plain; charset="us-ascii"\n'
+                        in rendered)
+        self.assertTrue(b'\nMIME-Version: 1.0\n' in rendered)
+        self.assertEqual(self._texts(self._parse(rendered)),
+                         [u'Hello Chris\n'])
+
+    def test_render_missing_value(self):
+        template = self._makeOne(self._makeMessage())
+        self.assertRaises(KeyError, template.render, {'name': 'Chris'})
+
+    def test_render_header_injection(self):
+        template = self._makeOne(self._makeMessage())
+        self.assertRaises(ValueError, template.render,
+                          {'name': 'Chris\nBcc: all@example.com',
+                           'email': 'chris@example.com'})
+
+    def test_render_w_header_cache(self):
+        from repoze.sendmail.encoding import HeaderCache
+        cache = HeaderCache()
+        template = self._makeOne(self._makeMessage(), header_cache=cache)
+        misses = cache.misses
+        for i in range(3):
+            template.render({'name': u'R\xe9my', 'email': 'r@example.com'})
+        self.assertEqual(cache.misses - misses, 2)
+        self.assertEqual(cache.hits, 4)
+
+    def test_send_raw(self):
+        import transaction
+        from repoze.sendmail.delivery import DirectMailDelivery
+        from repoze.sendmail.tests.test_queue import _makeRawMailerStub
+        mailer = _makeRawMailerStub()
+        delivery = DirectMailDelivery(mailer)
+        template = self._makeOne(self._makeMessage())
+        rendered = template.render({'name': 'Chris',
+                                    'email': 'chris@example.com'})
+        msgid = delivery.send_raw('news@example.com', ['chris@example.com'],
+                                  rendered)
+        self.assertEqual(msgid, self._parse(rendered)['Message-Id'])
+        transaction.commit()
+        self.assertEqual(mailer.sent_raw, [('news@example.com',
+                                            ['chris@example.com'],
+                                            rendered)])
@@ -67,5 +67,6 @@ setup(name='repoze.sendmail',
       extras_require = {
         'testing': requires + testing_extras,
         'docs': requires + docs_extras,
+        'mx': requires + ['dnspython'],
       },
 )